@@ -0,0 +1,83 @@
+"""Helpers shared by the benchmarks, results are plain JSON documents."""
+
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections.abc import Callable, Sequence
+from typing import Any
+
+from shared_lib.model import DATE_FORMAT, ReadingInput
+
+# 2024-01-01T00:00:00Z, generated readings are never in the future
+READINGS_START_EPOCH = 1704067200
+
+
+def make_readings(count: int, sites: int = 1000, seed: int = 0) -> list[ReadingInput]:
+    rng = random.Random(seed)
+    return [
+        ReadingInput(
+            site_id=f"site-{rng.randrange(sites):04d}",
+            device_id=f"meter-{rng.randrange(100):02d}",
+            power_reading=round(rng.uniform(0, 5000), 2),
+            timestamp=time.strftime(DATE_FORMAT, time.gmtime(READINGS_START_EPOCH + i)),
+        )
+        for i in range(count)
+    ]
+
+
+def percentiles(values: Sequence[float], *points: int) -> dict[str, float]:
+    """p50/p99 style summary in milliseconds of values in seconds."""
+    if not values:
+        return {f"p{p}_ms": 0.0 for p in points}
+    ordered = sorted(values)
+    return {
+        f"p{p}_ms": round(
+            ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1e3, 3
+        )
+        for p in points
+    }
+
+
+def per_second(func: Callable[[], Any], items: int, repeat: int) -> float:
+    """Best of `repeat` runs of func, which handles `items` items per run."""
+    best = min(_timed(func) for _ in range(repeat))
+    return round(items / best, 1)
+
+
+def _timed(func: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def metadata() -> dict[str, str]:
+    """Identifies the run, so results of two commits can be diffed."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.strftime(DATE_FORMAT, time.gmtime()),
+    }
+
+
+def write_result(result: dict[str, Any], output: str | None) -> None:
+    document = {"meta": metadata(), **result}
+    if output is None:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    with open(output, "w") as f:
+        json.dump(document, f, indent=2)
+        f.write("\n")
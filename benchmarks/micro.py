@@ -0,0 +1,151 @@
+"""
+Micro benchmarks of ReadingInput validation and serialization.
+
+Reports operations per second (best of --repeat runs) for:
+- validation: model_validate of a dict / of JSON, alone and inside batch_now,
+  parse_timestamp against the strptime it replaces
+- serialization: model_dump, model_dump_json, json.dumps of the stored fields,
+  stream entry encode/decode per format
+- metrics: redis_timer around an empty block, the cost added to a Redis call
+- analytics: stored readings to arrays, statistics over the arrays, against the
+  same statistics with a python loop over json.loads dicts
+
+run from project root: `uv run python -m benchmarks.micro`
+prints one JSON document (or --output), so results can be diffed between commits.
+"""
+
+import argparse
+import json
+from datetime import datetime
+from typing import Any
+
+from benchmarks.common import make_readings, per_second, write_result
+from services.consumer.analytics import site_analytics, to_arrays
+from shared_lib.metrics import redis_timer
+from shared_lib.model import DATE_FORMAT, ReadingInput, batch_now, parse_timestamp
+from shared_lib.stream import StreamFormat, decode_stream_entry, to_stream_entry
+
+
+def run(count: int, repeat: int) -> dict[str, Any]:
+    readings = make_readings(count)
+    dicts = [r.model_dump() for r in readings]
+    documents = [r.model_dump_json() for r in readings]
+    timestamps = [r.timestamp for r in readings]
+    # the fields the consumer stores, stream values come back as strings
+    fields = [
+        decode_stream_entry({k: str(v) for k, v in to_stream_entry(r).items()})[1]
+        for r in readings
+    ]
+
+    def validate() -> None:
+        for d in dicts:
+            ReadingInput.model_validate(d)
+
+    def validate_batch() -> None:
+        with batch_now():
+            for d in dicts:
+                ReadingInput.model_validate(d)
+
+    def validate_json() -> None:
+        for document in documents:
+            ReadingInput.model_validate_json(document)
+
+    def parse() -> None:
+        for timestamp in timestamps:
+            parse_timestamp(timestamp)
+
+    def strptime() -> None:
+        for timestamp in timestamps:
+            datetime.strptime(timestamp, DATE_FORMAT)
+
+    def dump() -> None:
+        for reading in readings:
+            reading.model_dump()
+
+    def dump_json() -> None:
+        for reading in readings:
+            reading.model_dump_json()
+
+    def dumps_fields() -> None:
+        # what the consumer stores per reading
+        for f in fields:
+            json.dumps(f)
+
+    validation = {
+        "model_validate": per_second(validate, count, repeat),
+        "model_validate_batch_now": per_second(validate_batch, count, repeat),
+        "model_validate_json": per_second(validate_json, count, repeat),
+        "parse_timestamp": per_second(parse, count, repeat),
+        "strptime": per_second(strptime, count, repeat),
+    }
+    serialization: dict[str, float] = {
+        "model_dump": per_second(dump, count, repeat),
+        "model_dump_json": per_second(dump_json, count, repeat),
+        "json_dumps_fields": per_second(dumps_fields, count, repeat),
+    }
+    for stream_format in StreamFormat:
+        payloads = [
+            {k: str(v) for k, v in to_stream_entry(r, stream_format).items()}
+            for r in readings
+        ]
+
+        def encode(f: StreamFormat = stream_format) -> None:
+            for reading in readings:
+                to_stream_entry(reading, f)
+
+        def decode(p: list[dict[str, str]] = payloads) -> None:
+            for payload in p:
+                decode_stream_entry(payload)
+
+        serialization[f"stream_encode_{stream_format}"] = per_second(
+            encode, count, repeat
+        )
+        serialization[f"stream_decode_{stream_format}"] = per_second(
+            decode, count, repeat
+        )
+
+    def timer() -> None:
+        for _ in range(count):
+            with redis_timer("benchmark"):
+                pass
+
+    stored = [json.dumps(f) for f in fields]
+    arrays = to_arrays(stored)
+
+    def python_loop() -> None:
+        # what a client did with the JSON rows: avg and peak
+        rows = [json.loads(value) for value in stored]
+        total, peak = 0.0, float("-inf")
+        for row in rows:
+            power = float(row["power_reading"])
+            total += power
+            peak = max(peak, power)
+
+    analytics = {
+        "to_arrays": per_second(lambda: to_arrays(stored), count, repeat),
+        "site_analytics": per_second(lambda: site_analytics(arrays), count, repeat),
+        "python_loop": per_second(python_loop, count, repeat),
+    }
+
+    return {
+        "benchmark": "micro",
+        "readings": count,
+        "unit": "per_second",
+        "validation": validation,
+        "serialization": serialization,
+        "metrics": {"redis_timer": per_second(timer, count, repeat)},
+        "analytics": analytics,
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--readings", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the JSON result to a file")
+    args = parser.parse_args(argv)
+    write_result(run(args.readings, args.repeat), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Load test of the whole pipeline: producer API -> stream -> consumer -> read API.
+
+Runs both FastAPI apps in-process (httpx ASGITransport, no HTTP server) against
+an in-process fakeredis, or a real Redis with --redis-url. Use a throwaway
+Redis, the run writes to the configured stream and site keys.
+
+Reports:
+- ingest_per_second: readings accepted by the producer per second
+- end_to_end_per_second: readings stored by the consumer per second
+- ingest_to_queryable: p50/p99 from the POST of a reading until the consumer
+  committed it (it is then returned by GET /sites/{site_id}/readings)
+- read: p50/p99 of GET /sites/{site_id}/readings
+- redis_commands_per_reading: commands sent by the client (MULTI/EXEC included)
+
+run from project root: `uv run --group bench python -m benchmarks.pipeline`
+prints one JSON document (or --output), so results can be diffed between commits.
+"""
+
+import argparse
+import asyncio
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+import httpx
+import redis.asyncio as redis
+from redis.asyncio.connection import AbstractConnection
+from redis.exceptions import ResponseError
+
+from benchmarks.common import make_readings, percentiles, write_result
+from services.consumer import main as consumer
+from services.producer import main as producer
+from shared_lib.config import CONSUMER_GROUP, STREAM_NAME, STREAM_PARTITIONS
+from shared_lib.model import ReadingInput
+from shared_lib.partitions import stream_keys
+from shared_lib.redis_client import create_redis
+
+BASE_URL = "http://bench"
+# Wait at most this long for the consumer to catch up after the last POST
+DRAIN_TIMEOUT_S = 60
+
+
+class CommandCounter:
+    """Counts commands packed by every redis.asyncio connection."""
+
+    def __init__(self) -> None:
+        self.commands = 0
+
+    @contextmanager
+    def patch(self) -> Iterator["CommandCounter"]:
+        pack_command = AbstractConnection.pack_command
+        pack_commands = AbstractConnection.pack_commands
+
+        def count_command(conn: AbstractConnection, *args: Any) -> list[bytes]:  # noqa: ANN401
+            self.commands += 1
+            return pack_command(conn, *args)
+
+        def count_commands(
+            conn: AbstractConnection, commands: Iterable[Iterable[Any]]
+        ) -> list[bytes]:
+            commands = list(commands)
+            self.commands += len(commands)
+            return pack_commands(conn, commands)
+
+        connection: Any = AbstractConnection
+        connection.pack_command = count_command
+        connection.pack_commands = count_commands
+        try:
+            yield self
+        finally:
+            connection.pack_command = pack_command
+            connection.pack_commands = pack_commands
+
+
+def connect(redis_url: str | None) -> redis.Redis:
+    if redis_url is not None:
+        # the client of the services: pool, retries and auto-batching
+        return create_redis(redis_url)
+    try:
+        import fakeredis
+    except ImportError as e:
+        raise SystemExit(
+            "fakeredis is not installed, run with `uv run --group bench` "
+            "or pass --redis-url"
+        ) from e
+
+    class FakeRedis(fakeredis.FakeAsyncRedis):
+        async def xreadgroup(self, *args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+            # fakeredis answers XREADGROUP BLOCK at once, without this the
+            # consumer loop never yields to the producer
+            result = await super().xreadgroup(*args, **kwargs)
+            if not result and kwargs.get("block"):
+                await asyncio.sleep(0.001)
+            return result
+
+    return FakeRedis(decode_responses=True)
+
+
+async def run(
+    count: int,
+    concurrency: int,
+    batch_size: int,
+    sites: int,
+    reads: int,
+    redis_url: str | None,
+) -> dict[str, Any]:
+    readings = make_readings(count, sites=sites)
+    r = connect(redis_url)
+    for stream in stream_keys():
+        try:
+            await r.xgroup_create(stream, CONSUMER_GROUP, id="$", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+    producer.app.state.redis = r
+    consumer.app.state.redis = r
+
+    # the consumer looks process_messages up at call time, wrap it to timestamp
+    # the messages it committed
+    sent: dict[str, float] = {}
+    stored: dict[str, float] = {}
+    process_messages = consumer.process_messages
+
+    async def timed_process_messages(
+        client: redis.Redis, messages: consumer.Messages, stream: str = STREAM_NAME
+    ) -> None:
+        await process_messages(client, messages, stream)
+        now = time.perf_counter()
+        for message_id, _payload in messages:
+            stored[message_id] = now
+
+    consumer.process_messages = timed_process_messages  # type: ignore[assignment]
+    counter = CommandCounter()
+    try:
+        with counter.patch():
+            consumer_task = asyncio.create_task(consumer.consume_stream(consumer.app))
+            start = time.perf_counter()
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=producer.app), base_url=BASE_URL
+            ) as client:
+                await _ingest(client, readings, concurrency, batch_size, sent)
+            ingested = time.perf_counter()
+            await _wait_for(lambda: len(stored) >= len(sent))
+            drained = time.perf_counter()
+            commands = counter.commands
+            consumer_task.cancel()
+            await asyncio.gather(consumer_task, return_exceptions=True)
+
+        read_latencies = await _read(readings, reads)
+    finally:
+        consumer.process_messages = process_messages
+        await r.aclose()
+
+    latencies = [stored[i] - sent[i] for i in sent if i in stored]
+    return {
+        "benchmark": "pipeline",
+        "redis": "real" if redis_url else "fakeredis",
+        "readings": count,
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "stream_partitions": STREAM_PARTITIONS,
+        "consumer_workers": consumer.CONSUMER_WORKERS,
+        "consumer_batch_size": consumer.BATCH_SIZE,
+        "ingest_per_second": round(count / (ingested - start), 1),
+        "end_to_end_per_second": round(count / (drained - start), 1),
+        "ingest_to_queryable": percentiles(latencies, 50, 99),
+        "read": {
+            "requests": len(read_latencies),
+            **percentiles(read_latencies, 50, 99),
+        },
+        "redis_commands_per_reading": round(commands / count, 2),
+    }
+
+
+async def _ingest(
+    client: httpx.AsyncClient,
+    readings: list[ReadingInput],
+    concurrency: int,
+    batch_size: int,
+    sent: dict[str, float],
+) -> None:
+    """`concurrency` clients POST the readings, one by one or in batches."""
+    size = max(batch_size, 1)
+    chunks = [readings[i : i + size] for i in range(0, len(readings), size)]
+    pending = iter(chunks)
+
+    async def post_next() -> None:
+        for chunk in pending:
+            posted = time.perf_counter()
+            if batch_size > 0:
+                response = await client.post(
+                    "/readings/batch", json=[r.model_dump() for r in chunk]
+                )
+                response.raise_for_status()
+                # rejected items have no stream_id
+                results = response.json()["results"]
+                ids = [item["stream_id"] for item in results if item["stream_id"]]
+            else:
+                response = await client.post("/readings", json=chunk[0].model_dump())
+                response.raise_for_status()
+                ids = [response.json()["stream_id"]]
+            for stream_id in ids:
+                sent[stream_id] = posted
+
+    await asyncio.gather(*(post_next() for _ in range(concurrency)))
+
+
+async def _read(readings: list[ReadingInput], reads: int) -> list[float]:
+    """GETs the readings of the ingested sites, round robin."""
+    site_ids = sorted({r.site_id for r in readings})
+    latencies: list[float] = []
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=consumer.app), base_url=BASE_URL
+    ) as client:
+        for i in range(reads):
+            start = time.perf_counter()
+            response = await client.get(
+                f"/sites/{site_ids[i % len(site_ids)]}/readings"
+            )
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def _wait_for(condition: Callable[[], bool]) -> None:
+    deadline = time.monotonic() + DRAIN_TIMEOUT_S
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("consumer did not catch up with the producer")
+        await asyncio.sleep(0.001)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--readings", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="POST /readings/batch with this many readings, 0: POST /readings",
+    )
+    parser.add_argument("--sites", type=int, default=100)
+    parser.add_argument("--reads", type=int, default=1000)
+    parser.add_argument("--redis-url", help="real Redis instead of fakeredis")
+    parser.add_argument("--output", help="write the JSON result to a file")
+    args = parser.parse_args(argv)
+    result = asyncio.run(
+        run(
+            args.readings,
+            args.concurrency,
+            args.batch_size,
+            args.sites,
+            args.reads,
+            args.redis_url,
+        )
+    )
+    write_result(result, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Throughput of the producer HTTP server with 1 to N worker processes.
+
+Starts `python -m services.producer.serve` once per worker count, waits until
+it answers, then load processes POST readings for --duration seconds through
+real HTTP connections. Admission control and the spool are off, streams are
+capped by STREAM_MAXLEN. Use a throwaway Redis, e.g.
+`docker run --rm -p 6379:6379 redis:7-alpine`; without --redis-url a
+fakeredis TCP server is started, single threaded, it caps the scaling.
+
+The load processes share the machine with the producer: give the benchmark
+at least workers + clients cores (--clients), or the numbers measure the
+load generator.
+
+Reports per worker count:
+- readings_per_second: readings answered 201 (or per item of a batch)
+- speedup: against the first worker count
+- latency: p50/p99 of one POST
+
+run from project root: `uv run --group bench python -m benchmarks.producer_scaling`
+prints one JSON document (or --output), so results can be diffed between commits.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any
+from urllib.parse import urlparse
+
+import httpx
+
+from benchmarks.common import make_readings, percentiles, write_result
+
+# Wait at most this long for a producer to answer /health
+STARTUP_TIMEOUT_S = 30
+# Stream entries kept per partition, bounds the Redis memory of a long run
+BENCH_STREAM_MAXLEN = 100000
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port: int = s.getsockname()[1]
+        return port
+
+
+def start_fake_redis() -> tuple[subprocess.Popen[bytes], str]:
+    """A fakeredis TCP server in a child process."""
+    port = free_port()
+    code = (
+        "from fakeredis import TcpFakeServer;"
+        f"TcpFakeServer(('127.0.0.1', {port}), server_type='redis').serve_forever()"
+    )
+    process = subprocess.Popen([sys.executable, "-c", code])
+    deadline = time.monotonic() + STARTUP_TIMEOUT_S
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, f"redis://127.0.0.1:{port}"
+        except OSError:
+            if time.monotonic() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.1)
+
+
+def start_producer(workers: int, redis_url: str, port: int) -> subprocess.Popen[bytes]:
+    url = urlparse(redis_url)
+    env = {
+        **os.environ,
+        "PRODUCER_WORKERS": str(workers),
+        "PORT": str(port),
+        "REDIS_HOST": url.hostname or "localhost",
+        "REDIS_PORT": str(url.port or 6379),
+        "MAX_STREAM_LAG": "0",
+        "STREAM_MAXLEN": str(BENCH_STREAM_MAXLEN),
+        "SPOOL_DIR": "",
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "services.producer.serve"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + STARTUP_TIMEOUT_S
+    while True:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).raise_for_status()
+            return process
+        except httpx.HTTPError as e:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(
+                    f"producer with {workers} workers did not start"
+                ) from e
+            time.sleep(0.2)
+
+
+def stop_producer(process: subprocess.Popen[bytes]) -> None:
+    process.terminate()  # SIGTERM, graceful shutdown
+    try:
+        process.wait(STARTUP_TIMEOUT_S)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+LoadResult = tuple[int, list[float], float]
+
+
+def load(
+    url: str, bodies: list[bytes], batch: bool, concurrency: int, duration: float
+) -> LoadResult:
+    """
+    One load process: readings accepted, POST latencies and the seconds it
+    sent requests for, all in seconds.
+    """
+    return asyncio.run(_load(url, bodies, batch, concurrency, duration))
+
+
+async def _load(
+    url: str, bodies: list[bytes], batch: bool, concurrency: int, duration: float
+) -> LoadResult:
+    path = "/readings/batch" if batch else "/readings"
+    latencies: list[float] = []
+    accepted = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+
+        async def post_loop(offset: int) -> None:
+            nonlocal accepted
+            i = offset
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await client.post(
+                    path,
+                    content=bodies[i % len(bodies)],
+                    headers={"Content-Type": "application/json"},
+                )
+                latencies.append(time.perf_counter() - start)
+                if batch and response.is_success:
+                    accepted += response.json()["accepted"]
+                elif response.status_code == httpx.codes.CREATED:
+                    accepted += 1
+                i += concurrency
+
+        await asyncio.gather(*(post_loop(i) for i in range(concurrency)))
+    return accepted, latencies, time.perf_counter() - start
+
+
+def run(
+    worker_counts: list[int],
+    clients: int,
+    concurrency: int,
+    duration: float,
+    batch_size: int,
+    redis_url: str | None,
+) -> dict[str, Any]:
+    readings = make_readings(10000)
+    if batch_size > 0:
+        bodies = [
+            b"[" + b",".join(r.model_dump_json().encode() for r in chunk) + b"]"
+            for chunk in (
+                readings[i : i + batch_size]
+                for i in range(0, len(readings), batch_size)
+            )
+        ]
+    else:
+        bodies = [r.model_dump_json().encode() for r in readings]
+
+    fake_redis = None
+    if redis_url is None:
+        fake_redis, url = start_fake_redis()
+    else:
+        url = redis_url
+    runs: list[dict[str, Any]] = []
+    try:
+        for workers in worker_counts:
+            port = free_port()
+            producer = start_producer(workers, url, port)
+            try:
+                # spawn: load processes do not inherit the event loop or sockets
+                context = multiprocessing.get_context("spawn")
+                with context.Pool(clients) as pool:
+                    results = pool.starmap(
+                        load,
+                        [
+                            (
+                                f"http://127.0.0.1:{port}",
+                                bodies[i::clients],
+                                batch_size > 0,
+                                concurrency,
+                                duration,
+                            )
+                            for i in range(clients)
+                        ],
+                    )
+            finally:
+                stop_producer(producer)
+            accepted = sum(count for count, _times, _elapsed in results)
+            latencies = [t for _count, times, _elapsed in results for t in times]
+            elapsed = max(elapsed for _count, _times, elapsed in results)
+            runs.append(
+                {
+                    "workers": workers,
+                    "readings_per_second": round(accepted / elapsed, 1),
+                    "latency": percentiles(latencies, 50, 99),
+                }
+            )
+    finally:
+        if fake_redis is not None:
+            fake_redis.kill()
+
+    base = runs[0]["readings_per_second"] or 1
+    for result in runs:
+        result["speedup"] = round(result["readings_per_second"] / base, 2)
+    return {
+        "benchmark": "producer_scaling",
+        "redis": "real" if redis_url else "fakeredis",
+        "cpus": os.cpu_count(),
+        "clients": clients,
+        "concurrency": concurrency,
+        "duration_s": duration,
+        "batch_size": batch_size,
+        "runs": runs,
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    cpus = os.cpu_count() or 1
+    parser.add_argument(
+        "--workers",
+        default=",".join(str(n) for n in (1, 2, 4, 8) if n <= max(cpus // 2, 1)),
+        help="comma separated worker counts, default 1 to half the cores",
+    )
+    parser.add_argument(
+        "--clients", type=int, default=max(cpus // 2, 1), help="load processes"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=32, help="requests in flight per client"
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="POST /readings/batch with this many readings, 0: POST /readings",
+    )
+    parser.add_argument("--redis-url", help="real Redis instead of fakeredis")
+    parser.add_argument("--output", help="write the JSON result to a file")
+    args = parser.parse_args(argv)
+    result = run(
+        [int(n) for n in args.workers.split(",")],
+        args.clients,
+        args.concurrency,
+        args.duration,
+        args.batch_size,
+        args.redis_url,
+    )
+    write_result(result, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares the stream entry formats of shared_lib.stream.
+
+Reports, per format:
+- entry_bytes: field names + values as stored in the stream entry
+- command_bytes: the XADD command on the wire (RESP)
+- encode/decode readings per second
+
+run from project root: `uv run python -m benchmarks.wire_format`
+prints one JSON document (or --output), so results can be diffed between commits.
+"""
+
+import argparse
+from typing import Any
+
+from redis.connection import Connection
+
+from benchmarks.common import make_readings, per_second, write_result
+from shared_lib.config import STREAM_NAME
+from shared_lib.stream import StreamFormat, decode_stream_entry, to_stream_entry
+
+
+def run(count: int, repeat: int) -> dict[str, Any]:
+    readings = make_readings(count)
+    connection = Connection()  # type: ignore[no-untyped-call]  # never connects
+    results: dict[str, Any] = {}
+    for stream_format in StreamFormat:
+        entries = [to_stream_entry(r, stream_format) for r in readings]
+        # what the consumer receives with decode_responses=True
+        payloads = [{k: str(v) for k, v in e.items()} for e in entries]
+        entry_bytes: int = sum(
+            len(k.encode()) + len(v.encode())
+            for payload in payloads
+            for k, v in payload.items()
+        )
+        command_bytes = 0
+        for entry in entries:
+            fields = [x for kv in entry.items() for x in kv]
+            packed: list[bytes] = connection.pack_command(  # type: ignore[no-untyped-call]
+                "XADD", STREAM_NAME, "*", *fields
+            )
+            command_bytes += sum(len(part) for part in packed)
+
+        def encode(f: StreamFormat = stream_format) -> None:
+            for reading in readings:
+                to_stream_entry(reading, f)
+
+        def decode(p: list[dict[str, str]] = payloads) -> None:
+            for payload in p:
+                decode_stream_entry(payload)
+
+        results[stream_format] = {
+            "entry_bytes_per_reading": round(entry_bytes / count, 2),
+            "command_bytes_per_reading": round(command_bytes / count, 2),
+            "encode_per_second": per_second(encode, count, repeat),
+            "decode_per_second": per_second(decode, count, repeat),
+        }
+    return {"benchmark": "wire_format", "readings": count, "results": results}
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--readings", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the JSON result to a file")
+    args = parser.parse_args(argv)
+    write_result(run(args.readings, args.repeat), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Site statistics computed over columnar arrays of the stored readings.
+
+The stored JSON is parsed column-wise by the Arrow JSON reader (see export) into
+contiguous arrays, timestamps as int64 epoch seconds and power_reading as
+float64, every statistic is then a NumPy operation over the whole site instead
+of a python loop over dicts.
+
+Anomalies use the modified z-score 0.6745 * (x - median) / MAD (Iglewicz and
+Hoaglin), robust to the outliers it looks for. When more than half of the
+readings are equal (MAD = 0) the mean absolute deviation scaled by 1.2533 is
+used instead.
+
+Series for charts are downsampled to the points a chart can draw, with
+Largest-Triangle-Three-Buckets (Steinarsson) that keeps the visual shape, or
+min/max per bucket that keeps every peak.
+"""
+
+import os
+from dataclasses import dataclass
+from datetime import UTC, datetime
+
+import numpy as np
+import numpy.typing as npt
+import pyarrow as pa
+
+from services.consumer.export import parse_readings
+from shared_lib.model import (
+    DATE_FORMAT,
+    Anomaly,
+    DownsampleMethod,
+    ReadingSeries,
+    SiteAnalytics,
+)
+
+# Modified z-score above which a reading is flagged
+ANOMALY_THRESHOLD = float(os.getenv("ANOMALY_THRESHOLD", 3.5))
+# Anomalies listed in a response, the latest first (all are counted)
+MAX_ANOMALIES = 100
+# Intervals between two readings of a device longer than this are not
+# integrated into energy, the device was likely offline
+ENERGY_MAX_GAP_S = int(os.getenv("ENERGY_MAX_GAP_S", 3600))
+
+MAD_SCALE = 0.6745
+MEAN_AD_SCALE = 1.253314
+
+
+@dataclass(frozen=True)
+class ReadingArrays:
+    """Readings of a site as columns, ordered by timestamp."""
+
+    epochs: npt.NDArray[np.int64]
+    power: npt.NDArray[np.float64]
+    devices: npt.NDArray[np.int32]  # index into device_ids
+    device_ids: list[str]
+
+
+def to_arrays(readings: list[str]) -> ReadingArrays:
+    """Columns of serialized readings, sorted by timestamp."""
+    if not readings:
+        return ReadingArrays(
+            np.empty(0, np.int64), np.empty(0, np.float64), np.empty(0, np.int32), []
+        )
+    table = parse_readings(readings)
+    epochs = table.column("timestamp").cast(pa.int64()).to_numpy()
+    power = table.column("power_reading").to_numpy()
+    devices = table.column("device_id").combine_chunks().dictionary_encode()
+    codes = devices.indices.to_numpy().astype(np.int32)
+    # storage returns the latest first, stable keeps arrival order on ties
+    order = np.argsort(epochs, kind="stable")
+    return ReadingArrays(
+        epochs[order], power[order], codes[order], devices.dictionary.to_pylist()
+    )
+
+
+def anomaly_scores(power: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """Modified z-score of every reading, 0 when all readings are equal."""
+    deviation = power - np.median(power)
+    mad = float(np.median(np.abs(deviation)))
+    if mad > 0:
+        return MAD_SCALE * deviation / mad
+    mean_ad = float(np.mean(np.abs(deviation)))
+    if mean_ad > 0:
+        return deviation / (MEAN_AD_SCALE * mean_ad)
+    return np.zeros_like(power)
+
+
+def energy(arrays: ReadingArrays) -> float:
+    """Trapezoidal integral of power_reading per device, in power x hours."""
+    if len(arrays.epochs) < 2:
+        return 0.0
+    # by device, then by time
+    order = np.lexsort((arrays.epochs, arrays.devices))
+    epochs = arrays.epochs[order]
+    power = arrays.power[order]
+    devices = arrays.devices[order]
+    seconds = np.diff(epochs)
+    integrated = (devices[1:] == devices[:-1]) & (seconds <= ENERGY_MAX_GAP_S)
+    areas = (power[1:] + power[:-1]) * seconds / 2
+    return float(np.sum(areas, where=integrated)) / 3600
+
+
+def site_analytics(arrays: ReadingArrays) -> SiteAnalytics:
+    if not len(arrays.epochs):
+        return SiteAnalytics(
+            count=0,
+            first=None,
+            last=None,
+            avg=None,
+            min=None,
+            max=None,
+            std=None,
+            peak_at=None,
+            energy=0.0,
+            anomaly_count=0,
+            anomalies=[],
+        )
+    power = arrays.power
+    peak = int(np.argmax(power))
+    scores = anomaly_scores(power)
+    flagged = np.flatnonzero(np.abs(scores) > ANOMALY_THRESHOLD)
+    return SiteAnalytics(
+        count=len(power),
+        first=_timestamp(arrays.epochs[0]),
+        last=_timestamp(arrays.epochs[-1]),
+        avg=float(np.mean(power)),
+        min=float(np.min(power)),
+        max=float(power[peak]),
+        std=float(np.std(power)),
+        peak_at=_timestamp(arrays.epochs[peak]),
+        energy=energy(arrays),
+        anomaly_count=len(flagged),
+        anomalies=[
+            Anomaly(
+                timestamp=_timestamp(arrays.epochs[i]),
+                device_id=arrays.device_ids[arrays.devices[i]],
+                power_reading=float(power[i]),
+                score=round(float(scores[i]), 3),
+            )
+            for i in flagged[::-1][:MAX_ANOMALIES]
+        ],
+    )
+
+
+def downsample(
+    arrays: ReadingArrays, points: int, method: DownsampleMethod
+) -> ReadingSeries:
+    """The readings as at most `points` points, oldest first."""
+    if method == DownsampleMethod.LTTB:
+        indices = lttb_indices(arrays.epochs, arrays.power, points)
+    else:
+        indices = minmax_indices(arrays.power, points)
+    return ReadingSeries(
+        count=len(arrays.epochs),
+        epochs=arrays.epochs[indices].tolist(),
+        power=arrays.power[indices].tolist(),
+    )
+
+
+def lttb_indices(
+    epochs: npt.NDArray[np.int64], power: npt.NDArray[np.float64], points: int
+) -> npt.NDArray[np.intp]:
+    """
+    Indices of the points kept by LTTB: the first, the last, and in each of
+    `points - 2` buckets the one forming the largest triangle with the point
+    kept in the previous bucket and the average of the next bucket.
+    """
+    count = len(epochs)
+    if points >= count or points < 3:
+        return np.arange(count)
+    x = epochs.astype(np.float64)
+    # bucket i is [edges[i], edges[i + 1]), the first and last point stand alone
+    edges = np.linspace(1, count - 1, points - 1).astype(np.intp)
+    kept = np.empty(points, np.intp)
+    kept[0], kept[-1] = 0, count - 1
+    previous = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start = end
+        next_end = edges[i + 2] if i + 2 < len(edges) else count
+        next_x = x[next_start:next_end].mean()
+        next_y = power[next_start:next_end].mean()
+        # twice the triangle areas, the factor does not change the argmax
+        areas = np.abs(
+            (x[previous] - next_x) * (power[start:end] - power[previous])
+            - (x[previous] - x[start:end]) * (next_y - power[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        kept[i + 1] = previous
+    return kept
+
+
+def minmax_indices(power: npt.NDArray[np.float64], points: int) -> npt.NDArray[np.intp]:
+    """Indices of the lowest and highest reading of `points // 2` buckets."""
+    count = len(power)
+    if points >= count:
+        return np.arange(count)
+    buckets = max(points // 2, 1)
+    starts = np.linspace(0, count, buckets, endpoint=False).astype(np.intp)
+    # bucket ids of every reading, then the first min and max of each bucket
+    ids = np.repeat(np.arange(buckets), np.diff(np.append(starts, count)))
+    lows = np.minimum.reduceat(power, starts)
+    highs = np.maximum.reduceat(power, starts)
+    _, first_low = np.unique(ids[power == lows[ids]], return_index=True)
+    _, first_high = np.unique(ids[power == highs[ids]], return_index=True)
+    low_indices = np.flatnonzero(power == lows[ids])[first_low]
+    high_indices = np.flatnonzero(power == highs[ids])[first_high]
+    return np.unique(np.concatenate([low_indices, high_indices]))
+
+
+def _timestamp(epoch: np.int64) -> str:
+    return datetime.fromtimestamp(int(epoch), UTC).strftime(DATE_FORMAT)
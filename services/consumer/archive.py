@@ -0,0 +1,242 @@
+"""
+Moves readings older than ARCHIVE_AFTER_S from the Redis zsets to segment files
+(see segments), so Redis holds the recent readings and history stays queryable.
+
+Every ARCHIVE_INTERVAL_S one consumer pod (a Redis lock) goes over the sites:
+1. settle: readings below the site watermark still in Redis were archived by
+   the previous run, or arrived late for an archived window. The late ones are
+   merged into the segment of their window, then all of them leave Redis.
+2. archive: each complete ARCHIVE_WINDOW_S window older than ARCHIVE_AFTER_S is
+   written as one segment, then the watermark moves past it.
+
+Reads take the epochs below the watermark from the segments (see storage). A
+window is in its segment before the watermark covers it, and leaves Redis one
+run later, after the reads that fetched the previous watermark. A crash between
+a segment and its watermark rewrites the segment on the next run. Late readings
+are readable once a run settled them.
+
+Moving a watermark or rewriting a segment bumps the site version, so cached
+reads of the site (see cache) are not served anymore.
+"""
+
+import asyncio
+import os
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import cast
+
+import pyarrow as pa
+import redis.asyncio as redis
+from prometheus_client import Counter
+from redis.exceptions import RedisError
+
+from services.consumer.export import parse_readings
+from services.consumer.segments import read_window, write_segment
+from services.consumer.storage import (
+    ARCHIVE_AFTER_S,
+    ARCHIVE_DIR,
+    SITE_INDEX_PREFIX,
+    archive_watermark_key,
+    device_index_key,
+    site_index_key,
+    site_version_key,
+)
+from shared_lib.logger import logger
+from shared_lib.metrics import redis_timer
+from shared_lib.partitions import untag_site
+
+# Seconds between archive runs
+ARCHIVE_INTERVAL_S = int(os.getenv("ARCHIVE_INTERVAL_S", 600))
+# Seconds of readings per segment, divides a day: a window is in one day
+ARCHIVE_WINDOW_S = 3600
+# Held by the pod archiving, renewed before every site
+ARCHIVE_LOCK_KEY = "readings:archive:lock"
+ARCHIVE_LOCK_TTL_S = 300
+
+ARCHIVED = Counter(
+    "consumer_archived_readings_total", "Readings moved from Redis to segment files"
+)
+ARCHIVE_SEGMENTS = Counter(
+    "consumer_archive_segments_total", "Segment files written or rewritten"
+)
+
+# (value, score) of a zset member
+Members = list[tuple[str, float]]
+
+
+async def archive_loop(
+    r: redis.Redis, owner: str, invalidate: Callable[[str], None] | None = None
+) -> None:
+    """
+    Background worker archiving every ARCHIVE_INTERVAL_S, on one pod at once.
+    `invalidate` drops the local cached reads of a site after it is archived.
+    """
+    directory = Path(ARCHIVE_DIR)
+    while True:
+        try:
+            if await r.set(ARCHIVE_LOCK_KEY, owner, nx=True, ex=ARCHIVE_LOCK_TTL_S):
+                archived = await archive_sites(
+                    r, directory, owner, time.time(), invalidate
+                )
+                logger.info("Archived %d readings to %s", archived, directory)
+        except (RedisError, OSError) as e:
+            logger.error("Error in archive loop: %s", e)
+        await asyncio.sleep(ARCHIVE_INTERVAL_S)
+
+
+async def archive_sites(
+    r: redis.Redis,
+    directory: Path,
+    owner: str,
+    now: float,
+    invalidate: Callable[[str], None] | None = None,
+) -> int:
+    """Settles and archives every site, returns the readings archived."""
+    cutoff = int(now) - ARCHIVE_AFTER_S
+    archived = 0
+    async for key in r.scan_iter(
+        match=f"{SITE_INDEX_PREFIX}*", _type="zset", count=1000
+    ):
+        site_id = untag_site(key.removeprefix(SITE_INDEX_PREFIX))
+        if ":device:" in site_id:
+            continue  # device index of a site, archived with the site
+        if await r.get(ARCHIVE_LOCK_KEY) != owner:
+            logger.warning("Archive lock expired, the run stops")
+            break
+        await r.expire(ARCHIVE_LOCK_KEY, ARCHIVE_LOCK_TTL_S)
+        try:
+            archived += await archive_site(r, directory, site_id, cutoff)
+        except pa.ArrowInvalid as e:
+            # a stored reading that does not parse, the other sites still move
+            logger.error("Error archiving site %s: %s", site_id, e)
+        if invalidate is not None:
+            invalidate(site_id)
+    return archived
+
+
+async def archive_site(
+    r: redis.Redis, directory: Path, site_id: str, cutoff: int
+) -> int:
+    """
+    Archives the complete windows of a site ending at or before `cutoff`,
+    returns the readings written to segments.
+    """
+    key = site_index_key(site_id)
+    watermark = await r.get(archive_watermark_key(site_id))
+    archived = 0
+    if watermark is not None:
+        archived += await _settle(r, directory, site_id, int(watermark))
+
+    start: int | str = "-inf" if watermark is None else int(watermark)
+    end = cutoff - cutoff % ARCHIVE_WINDOW_S
+    while True:
+        # the window of the oldest reading not archived yet
+        oldest = await _members(r, key, start, end, limit=1)
+        if not oldest:
+            break
+        window = _window(oldest[0][1])
+        members = await _members(r, key, *window)
+        await asyncio.to_thread(
+            write_segment,
+            directory,
+            site_id,
+            window,
+            [value for value, _score in members],
+            [int(score) for _value, score in members],
+        )
+        ARCHIVE_SEGMENTS.inc()
+        ARCHIVED.inc(len(members))
+        archived += len(members)
+        start = window[1]
+        await _move_watermark(r, site_id, start)
+    # every reading below `end` is in a segment now
+    if watermark is None or int(watermark) < end:
+        await _move_watermark(r, site_id, end)
+    return archived
+
+
+async def _settle(r: redis.Redis, directory: Path, site_id: str, watermark: int) -> int:
+    """Removes the archived readings from Redis, archiving the late ones first."""
+    key = site_index_key(site_id)
+    late_total = 0
+    while True:
+        oldest = await _members(r, key, "-inf", watermark, limit=1)
+        if not oldest:
+            return late_total
+        window = _window(oldest[0][1])
+        members = await _members(r, key, *window)
+        values, epochs = await asyncio.to_thread(
+            read_window, directory, site_id, window
+        )
+        known = set(values)
+        late = [(value, int(score)) for value, score in members if value not in known]
+        if late:
+            # zset order: by score, then by member
+            merged = sorted([*zip(values, epochs, strict=True), *late], key=_order)
+            await asyncio.to_thread(
+                write_segment,
+                directory,
+                site_id,
+                window,
+                [value for value, _epoch in merged],
+                [epoch for _value, epoch in merged],
+            )
+            ARCHIVE_SEGMENTS.inc()
+            ARCHIVED.inc(len(late))
+            late_total += len(late)
+            # the late readings are read from the segment now
+            with redis_timer("archive_version"):
+                await r.incr(site_version_key(site_id))
+        await _remove(r, site_id, [value for value, _score in members])
+
+
+async def _move_watermark(r: redis.Redis, site_id: str, watermark: int) -> None:
+    """Sets the watermark of a site and bumps its version in one transaction."""
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.set(archive_watermark_key(site_id), watermark)
+        pipe.incr(site_version_key(site_id))
+        with redis_timer("archive_watermark"):
+            await pipe.execute()
+
+
+async def _members(
+    r: redis.Redis, key: str, low: int | str, high: int, limit: int | None = None
+) -> Members:
+    """Members scored in [low, high), oldest first, at most `limit`."""
+    with redis_timer("archive_range"):
+        # score bounds: ZRANGE is typed for ranks in redis-py
+        members = await r.zrangebyscore(
+            key,
+            low,
+            f"({high}",
+            start=None if limit is None else 0,
+            num=limit,
+            withscores=True,
+        )
+    # decode_responses=True, scores parsed as float
+    return cast(Members, members)
+
+
+async def _remove(r: redis.Redis, site_id: str, values: list[str]) -> None:
+    """Removes archived readings from the site and device indexes."""
+    by_device: dict[str, list[str]] = {}
+    devices = parse_readings(values)["device_id"].to_pylist()
+    for device_id, value in zip(devices, values, strict=True):
+        by_device.setdefault(device_id, []).append(value)
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zrem(site_index_key(site_id), *values)
+        for device_id, device_values in by_device.items():
+            pipe.zrem(device_index_key(site_id, device_id), *device_values)
+        with redis_timer("archive_remove"):
+            await pipe.execute()
+
+
+def _window(score: float) -> tuple[int, int]:
+    start = int(score) - int(score) % ARCHIVE_WINDOW_S
+    return start, start + ARCHIVE_WINDOW_S
+
+
+def _order(member: tuple[str, int]) -> tuple[int, str]:
+    value, epoch = member
+    return epoch, value
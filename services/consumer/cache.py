@@ -0,0 +1,117 @@
+"""
+In-process LRU/TTL cache of serialized site readings responses.
+
+Entries are tagged with the site version, a counter the consumer increments in
+the same transaction that writes the site readings. A read compares the cached
+version with the current one, so a cached response is never older than the
+last processed batch, whichever pod processed it.
+"""
+
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    version: str
+    body: str
+    headers: dict[str, str]
+    expires_at: float
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0  # dropped by the size bound
+    expirations: int = 0  # dropped by the ttl
+    invalidations: int = 0  # dropped by a write to the site
+
+
+class ResponseCache:
+    """LRU bounded by `max_entries`, entries live at most `ttl_s` seconds."""
+
+    def __init__(self, max_entries: int, ttl_s: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.stats = CacheStats()
+        self._entries: OrderedDict[tuple[str, Hashable], CachedResponse] = OrderedDict()
+        self._site_keys: dict[str, set[tuple[str, Hashable]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, site_id: str, key: Hashable, version: str) -> CachedResponse | None:
+        entry_key = (site_id, key)
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        if entry.expires_at < time.monotonic():
+            self.stats.expirations += 1
+            self._remove(entry_key)
+            self.stats.misses += 1
+            return None
+        if entry.version != version:
+            # the site changed since the entry was stored
+            self.stats.invalidations += 1
+            self._remove(entry_key)
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(entry_key)
+        self.stats.hits += 1
+        return entry
+
+    def put(
+        self,
+        site_id: str,
+        key: Hashable,
+        version: str,
+        body: str,
+        headers: dict[str, str],
+    ) -> None:
+        if self.max_entries <= 0:
+            return
+        entry_key = (site_id, key)
+        self._entries[entry_key] = CachedResponse(
+            version, body, headers, time.monotonic() + self.ttl_s
+        )
+        self._entries.move_to_end(entry_key)
+        self._site_keys.setdefault(site_id, set()).add(entry_key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats.evictions += 1
+
+    def invalidate(self, site_id: str) -> None:
+        """Drops every entry of a site, called after the site is written."""
+        for entry_key in self._site_keys.pop(site_id, set()):
+            if self._entries.pop(entry_key, None) is not None:
+                self.stats.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._site_keys.clear()
+        self.stats = CacheStats()
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "hits": self.stats.hits,
+            "misses": self.stats.misses,
+            "evictions": self.stats.evictions,
+            "expirations": self.stats.expirations,
+            "invalidations": self.stats.invalidations,
+        }
+
+    def _remove(self, entry_key: tuple[str, Hashable]) -> None:
+        self._entries.pop(entry_key, None)
+        keys = self._site_keys.get(entry_key[0])
+        if keys is not None:
+            keys.discard(entry_key)
+            if not keys:
+                del self._site_keys[entry_key[0]]
@@ -0,0 +1,101 @@
+"""
+Drops readings stored already, keyed on (site_id, device_id, timestamp).
+
+Gateways retry on timeouts and the producer spool replays at-least-once, so the
+same reading can reach the stream more than once. Before a batch is stored, each
+of its readings claims `readings:dedup:{site_id}:{device_id}:{epoch}` with
+SET NX GET EX, all claims of the batch in one pipeline (one round-trip per
+batch, not per reading).
+
+The claim value is the stream message id: a reading is new when the key did not
+exist, or holds its own message id (a redelivery after the batch failed to
+store). A claim must not outlive a reading that was never stored: when the
+store transaction fails, or the message is dead-lettered, the claims still
+holding its message id are released, so copies of the reading are stored.
+Keys expire after DEDUP_TTL_S, memory is bounded by the readings of that
+window; copies further apart are stored again.
+"""
+
+import os
+
+import redis.asyncio as redis
+
+from shared_lib.metrics import redis_timer
+from shared_lib.model import ReadingInput, timestamp_to_epoch
+from shared_lib.partitions import site_tag
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+# Seconds a stored reading blocks its copies: the retry window of gateways and
+# the replay delay of a producer spool after a short outage
+DEDUP_TTL_S = int(os.getenv("DEDUP_TTL_S", 900))
+
+DEDUP_KEY_PREFIX = "readings:dedup:"
+
+SiteReadings = dict[str, list[tuple[ReadingInput, str]]]
+
+# KEYS claims, ARGV[i] the message id expected in KEYS[i]
+RELEASE_CLAIMS_LUA = """
+local released = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[i] then
+        released = released + redis.call('DEL', key)
+    end
+end
+return released
+"""
+
+
+def dedup_key(reading: ReadingInput) -> str:
+    epoch = timestamp_to_epoch(reading.timestamp)
+    site = f"{site_tag(reading.site_id)}{reading.site_id}"
+    return f"{DEDUP_KEY_PREFIX}{site}:{reading.device_id}:{epoch}"
+
+
+async def drop_duplicates(
+    r: redis.Redis, by_site: SiteReadings, message_ids: dict[str, list[str]]
+) -> tuple[SiteReadings, dict[str, list[str]], int]:
+    """
+    The readings of `by_site` not stored before with their message ids, and the
+    number of duplicates.
+    `message_ids` holds the stream message id of every reading of `by_site`.
+    """
+    async with r.pipeline(transaction=False) as pipe:
+        for site_id, readings in by_site.items():
+            for (reading, _value), message_id in zip(
+                readings, message_ids[site_id], strict=True
+            ):
+                pipe.set(
+                    dedup_key(reading), message_id, nx=True, ex=DEDUP_TTL_S, get=True
+                )
+        with redis_timer("dedup_claim"):
+            owners: list[str | None] = await pipe.execute()
+
+    kept: SiteReadings = {}
+    kept_ids: dict[str, list[str]] = {}
+    duplicates = 0
+    claims = iter(owners)
+    for site_id, readings in by_site.items():
+        for entry, message_id in zip(readings, message_ids[site_id], strict=True):
+            owner = next(claims)
+            if owner is None or owner == message_id:
+                kept.setdefault(site_id, []).append(entry)
+                kept_ids.setdefault(site_id, []).append(message_id)
+            else:
+                duplicates += 1
+    return kept, kept_ids, duplicates
+
+
+async def release_claims(r: redis.Redis, claims: list[tuple[ReadingInput, str]]) -> int:
+    """
+    Deletes the claims of (reading, message id) still held by that message id,
+    in one script call. Returns the claims released.
+    """
+    if not claims:
+        return 0
+    script = r.register_script(RELEASE_CLAIMS_LUA)
+    with redis_timer("dedup_release"):
+        released = await script(
+            keys=[dedup_key(reading) for reading, _message_id in claims],
+            args=[message_id for _reading, message_id in claims],
+        )
+    return int(released)
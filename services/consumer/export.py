@@ -0,0 +1,124 @@
+"""
+Bulk export of stored site readings as CSV, Arrow IPC stream or Parquet.
+
+Readings are read per site in chunks of READ_CHUNK_SIZE (see storage), parsed
+column-wise by the Arrow JSON reader straight from the stored JSON, and encoded
+into an in-memory sink that is drained after every chunk. Memory stays bounded
+by one chunk (one row group for Parquet) whatever the number of readings.
+"""
+
+import io
+import os
+from collections.abc import AsyncIterator, Buffer
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.ipc as pa_ipc
+import pyarrow.json as pa_json
+import pyarrow.parquet as pa_parquet
+import redis.asyncio as redis
+
+from services.consumer.storage import ReadingQuery, iter_site_readings
+from shared_lib.model import ExportFormat
+
+# Rows buffered per Parquet row group, larger groups compress and scan better
+EXPORT_ROW_GROUP_ROWS = int(os.getenv("EXPORT_ROW_GROUP_ROWS", 65536))
+
+EXPORT_SCHEMA = pa.schema(
+    [
+        ("site_id", pa.string()),
+        ("device_id", pa.string()),
+        ("power_reading", pa.float64()),
+        ("timestamp", pa.timestamp("s", tz="UTC")),
+    ]
+)
+# The consumer stores the stream fields as they were, power_reading is a JSON
+# string ("14.0") and is cast to float64 after parsing
+_STORED_SCHEMA = EXPORT_SCHEMA.set(
+    EXPORT_SCHEMA.get_field_index("power_reading"),
+    pa.field("power_reading", pa.string()),
+)
+_PARSE_OPTIONS = pa_json.ParseOptions(
+    explicit_schema=_STORED_SCHEMA, unexpected_field_behavior="ignore"
+)
+
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.CSV: "text/csv",
+    ExportFormat.ARROW: "application/vnd.apache.arrow.stream",
+    ExportFormat.PARQUET: "application/vnd.apache.parquet",
+}
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file collecting what the writers emit until it is drained."""
+
+    def __init__(self) -> None:
+        self._parts: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Buffer) -> int:
+        part = bytes(data)
+        self._parts.append(part)
+        self._position += len(part)
+        return len(part)
+
+    def tell(self) -> int:
+        # Parquet records column chunk offsets, the drained bytes still count
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def parse_readings(readings: list[str]) -> pa.Table:
+    """
+    Columns of serialized readings as stored by the consumer, extra fields are
+    dropped. Raises pyarrow.ArrowInvalid on a reading that does not parse.
+    """
+    data = "\n".join(readings).encode()
+    table = pa_json.read_json(io.BytesIO(data), parse_options=_PARSE_OPTIONS)
+    return table.select(EXPORT_SCHEMA.names).cast(EXPORT_SCHEMA)
+
+
+async def iter_export(
+    r: redis.Redis,
+    site_ids: list[str],
+    query: ReadingQuery,
+    export_format: ExportFormat,
+) -> AsyncIterator[bytes]:
+    """Yields the encoded readings of the sites, site by site, latest first."""
+    sink = _Sink()
+    writer: pa_csv.CSVWriter | pa_ipc.RecordBatchStreamWriter | pa_parquet.ParquetWriter
+    if export_format == ExportFormat.CSV:
+        writer = pa_csv.CSVWriter(sink, EXPORT_SCHEMA)
+    elif export_format == ExportFormat.ARROW:
+        writer = pa_ipc.new_stream(sink, EXPORT_SCHEMA)
+    else:
+        writer = pa_parquet.ParquetWriter(sink, EXPORT_SCHEMA)
+
+    pending: list[pa.Table] = []  # Parquet rows of the next row group
+    pending_rows = 0
+    for site_id in site_ids:
+        async for chunk in iter_site_readings(r, site_id, query):
+            table = parse_readings(chunk)
+            if export_format != ExportFormat.PARQUET:
+                writer.write_table(table)
+                yield sink.drain()
+                continue
+            pending.append(table)
+            pending_rows += table.num_rows
+            if pending_rows >= EXPORT_ROW_GROUP_ROWS:
+                writer.write_table(pa.concat_tables(pending))
+                pending, pending_rows = [], 0
+                yield sink.drain()
+    if pending:
+        writer.write_table(pa.concat_tables(pending))
+    # the header of an empty CSV, the end of stream marker or the Parquet footer
+    writer.close()
+    yield sink.drain()
@@ -0,0 +1,147 @@
+"""
+Live push of newly stored readings, served as Server-Sent Events.
+
+process_messages publishes the readings of every site of a batch to
+`readings:live:site:{site_id}` in the transaction that stores them, as one JSON
+array of the stored values, so a subscriber only sees committed readings.
+
+Each process holds a single pub/sub connection (LiveHub): a site channel is
+subscribed while at least one SSE client of the process follows the site, and
+every message is fanned out to the queues of these clients. A client that does
+not keep up gets `None`, the endpoint then asks it to resync.
+"""
+
+import asyncio
+import os
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Any
+
+import redis.asyncio as redis
+from redis.asyncio.client import PubSub
+from redis.exceptions import RedisError
+
+from shared_lib.logger import logger
+
+LIVE_ENABLED = os.getenv("LIVE_ENABLED", "true").lower() == "true"
+# Messages (batches of a site) buffered per SSE client before it must resync
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", 100))
+# Seconds between SSE comments on an idle stream, keeps proxies from closing it
+LIVE_HEARTBEAT_S = float(os.getenv("LIVE_HEARTBEAT_S", 15))
+# Wait before listening again after a pub/sub error
+LIVE_RETRY_S = 1.0
+
+LIVE_CHANNEL_PREFIX = "readings:live:site:"
+
+Subscriber = asyncio.Queue[str | None]
+
+
+def live_channel(site_id: str) -> str:
+    return f"{LIVE_CHANNEL_PREFIX}{site_id}"
+
+
+def stage_live_update(
+    pipe: redis.client.Pipeline, site_id: str, values: list[str]
+) -> None:
+    """Queues the PUBLISH of serialized readings of one site on `pipe`."""
+    # stored values are JSON already, joined without re-parsing
+    pipe.publish(live_channel(site_id), f"[{','.join(values)}]")
+
+
+class LiveHub:
+    """Fans the live channels out to the SSE clients of this process."""
+
+    def __init__(self, queue_size: int) -> None:
+        self.queue_size = queue_size
+        self._subscribers: dict[str, set[Subscriber]] = {}
+        self._pubsub: PubSub | None = None
+        self._listener: asyncio.Task[None] | None = None
+        self._active = asyncio.Event()  # set while a channel is subscribed
+
+    @property
+    def followed_sites(self) -> int:
+        return len(self._subscribers)
+
+    def start(self, r: redis.Redis) -> None:
+        self._pubsub = r.pubsub()
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()  # type: ignore[no-untyped-call]
+            self._pubsub = None
+        self._subscribers.clear()
+        self._active.clear()
+
+    @asynccontextmanager
+    async def subscribe(self, site_id: str) -> AsyncIterator[Subscriber]:
+        """A queue receiving the live messages of the site while in the block."""
+        if self._pubsub is None:
+            raise RuntimeError("live hub is not started")
+        queue: Subscriber = asyncio.Queue(self.queue_size)
+        subscribers = self._subscribers.setdefault(site_id, set())
+        if not subscribers:
+            await self._pubsub.subscribe(live_channel(site_id))
+            self._active.set()
+        subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[site_id]
+                if not self._subscribers:
+                    self._active.clear()
+                if self._pubsub is not None:
+                    await self._pubsub.unsubscribe(live_channel(site_id))
+
+    def dispatch(self, channel: str, data: str) -> None:
+        """Hands a message to every subscriber of its site, without waiting."""
+        site_id = channel.removeprefix(LIVE_CHANNEL_PREFIX)
+        for queue in self._subscribers.get(site_id, ()):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # dropping silently would leave a gap in the client table
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def _listen(self) -> None:
+        while True:
+            await self._active.wait()
+            if self._pubsub is None:
+                return
+            try:
+                message: dict[str, Any] | None = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+            except RedisError as e:
+                # the pub/sub connection resubscribes its channels on reconnect
+                logger.error("Live pub/sub failed: %s", e)
+                await asyncio.sleep(LIVE_RETRY_S)
+                continue
+            if message is not None and message["type"] == "message":
+                self.dispatch(message["channel"], message["data"])
+
+
+async def iter_live_events(hub: LiveHub, site_id: str) -> AsyncIterator[str]:
+    """SSE stream of the site: `readings` events, heartbeats and `resync`."""
+    async with hub.subscribe(site_id) as queue:
+        # reconnect delay of EventSource clients, also flushes the headers
+        yield f"retry: {int(LIVE_RETRY_S * 1000)}\n\n"
+        while True:
+            try:
+                data = await asyncio.wait_for(queue.get(), LIVE_HEARTBEAT_S)
+            except TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if data is None:
+                # readings were missed, the client refetches and reconnects
+                yield "event: resync\ndata: {}\n\n"
+                return
+            yield f"event: readings\ndata: {data}\n\n"
@@ -1,24 +1,165 @@
 import asyncio
 import json
 import os
+import time
 import uuid
-from collections.abc import AsyncGenerator
+import zlib
+from collections.abc import AsyncGenerator, AsyncIterator, Callable
 from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
 from enum import StrEnum
-from typing import Any
+from typing import TYPE_CHECKING, Annotated, Any
 
 import redis.asyncio as redis
-from fastapi import FastAPI
-from pydantic import ValidationError
-from redis.exceptions import RedisError, ResponseError
+from fastapi import (
+    APIRouter,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from pydantic import BaseModel, ValidationError
+from redis.exceptions import NoScriptError, RedisError, ResponseError
+
+from services.consumer.cache import ResponseCache
+from services.consumer.dedup import (
+    DEDUP_ENABLED,
+    SiteReadings,
+    drop_duplicates,
+    release_claims,
+)
+from services.consumer.live import (
+    LIVE_ENABLED,
+    LIVE_QUEUE_SIZE,
+    LiveHub,
+    iter_live_events,
+    stage_live_update,
+)
+from services.consumer.rollups import (
+    BUCKET_SECONDS,
+    ROLLUPS_ENABLED,
+    Merge,
+    Resolution,
+    load_merge_script,
+    read_rollups,
+    rerun_merges,
+    stage_rollups,
+)
+from services.consumer.storage import (
+    ARCHIVE_DIR,
+    ARCHIVE_ENABLED,
+    ReadingQuery,
+    count_site_readings,
+    iter_site_readings,
+    read_site_readings,
+    site_version_key,
+    stage_site_writes,
+)
 
 # Assuming these are shared with your producer
-from shared_lib.config import CONSUMER_GROUP, REDIS_URL, STREAM_NAME
+from shared_lib.config import (
+    CONSUMER_GROUP,
+    REDIS_SOCKET_TIMEOUT_S,
+    STREAM_NAME,
+    STREAM_PARTITIONS,
+)
 from shared_lib.logger import logger
-from shared_lib.model import HEALTH_CHECK_DICT, ReadingInput
+from shared_lib.metrics import VALIDATION_SECONDS, redis_timer
+from shared_lib.model import (
+    HEALTH_CHECK_DICT,
+    AggregateBucket,
+    DownsampleMethod,
+    ExportFormat,
+    ReadingInput,
+    ReadingSeries,
+    SiteAnalytics,
+    batch_now,
+)
+from shared_lib.partitions import dead_letter_key, parse_partitions, stream_keys
+from shared_lib.redis_client import create_redis, stream_reply
+from shared_lib.stream import decode_stream_entry, stream_entry_site_id
+
+if TYPE_CHECKING:
+    from services.consumer.analytics import ReadingArrays
 
 # Constants for this service
 CONSUMER_NAME = os.getenv("HOSTNAME", f"default_consumer-{str(uuid.uuid4())[:8]}")
+# Stream partitions read by this consumer, e.g. "0-3,7", empty reads all
+CONSUMER_PARTITIONS = parse_partitions(
+    os.getenv("CONSUMER_PARTITIONS", ""), STREAM_PARTITIONS
+)
+CONSUMER_STREAMS = stream_keys(CONSUMER_PARTITIONS)
+# Max messages per XREADGROUP call and partition, each batch is stored in one
+# pipeline
+BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", 100))
+# How long XREADGROUP waits for new messages when the stream is empty
+BLOCK_MS = int(os.getenv("CONSUMER_BLOCK_MS", 5000))
+# Concurrent processing workers in this process, messages are sharded by site_id
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", 1))
+# Batches a worker may have queued before the reader waits (backpressure)
+WORKER_QUEUE_SIZE = 2
+# Pending messages idle longer than this are claimed from any consumer
+RECLAIM_MIN_IDLE_MS = int(os.getenv("RECLAIM_MIN_IDLE_MS", 60000))
+# Seconds between XAUTOCLAIM sweeps
+RECLAIM_INTERVAL_S = float(os.getenv("RECLAIM_INTERVAL_S", 30))
+# Deliveries after which a message is moved to the dead-letter stream
+MAX_DELIVERIES = int(os.getenv("MAX_DELIVERIES", 5))
+# Seconds between XINFO GROUPS reads for the lag and pending gauges
+METRICS_INTERVAL_S = float(os.getenv("METRICS_INTERVAL_S", 15))
+# Buckets returned by /aggregates when `from` is omitted, and the upper bound
+DEFAULT_AGGREGATE_BUCKETS = 60
+MAX_AGGREGATE_BUCKETS = 5000
+
+# In-process cache of site readings responses, 0 entries disables it
+READ_CACHE_MAX_ENTRIES = int(os.getenv("READ_CACHE_MAX_ENTRIES", 1024))
+# Upper bound of an entry lifetime, a write to the site drops it earlier
+READ_CACHE_TTL_S = float(os.getenv("READ_CACHE_TTL_S", 30))
+
+# Sites per export request
+EXPORT_MAX_SITES = int(os.getenv("EXPORT_MAX_SITES", 1000))
+# Points of a downsampled series, default and upper bound
+DEFAULT_SERIES_POINTS = 1000
+MAX_SERIES_POINTS = 10000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NEXT_OFFSET_HEADER = "X-Next-Offset"
+TOTAL_COUNT_HEADER = "X-Total-Count"
+
+Messages = list[tuple[str, dict[str, str]]]
+
+MESSAGES = Counter(
+    "consumer_messages_total",
+    "Stream messages by outcome: acked, duplicate (acked), invalid (acked), failed,"
+    " dead_lettered, trimmed (acked)",
+    ["outcome"],
+)
+BATCH_MESSAGES = Histogram(
+    "consumer_batch_messages",
+    "Messages per processed batch",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+GROUP_LAG = Gauge(
+    "consumer_group_lag",
+    "Stream entries not yet delivered to the consumer group",
+    ["stream"],
+)
+GROUP_PENDING = Gauge(
+    "consumer_group_pending",
+    "Entries delivered to the group but not ACKed",
+    ["stream"],
+)
+LIVE_SITES = Gauge("consumer_live_sites", "Sites followed by SSE clients")
 
 
 class StreamCreateStrategy(StrEnum):
@@ -35,133 +176,831 @@ class StreamReadMode(StrEnum):
     MY_PENDING = "0"  # Give me messages I claimed but haven't ACKnowledged
 
 
+@dataclass
+class WorkerStats:
+    """Throughput counters of a single processing worker."""
+
+    worker_id: int
+    messages: int = 0
+    batches: int = 0
+    busy_seconds: float = 0.0
+    started_at: float = field(default_factory=time.monotonic)
+
+    def as_dict(self) -> dict[str, float]:
+        uptime = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "worker_id": self.worker_id,
+            "messages": self.messages,
+            "batches": self.batches,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "messages_per_second": round(self.messages / uptime, 3),
+            # busy ratio close to 1 means the worker is the bottleneck
+            "utilization": round(self.busy_seconds / uptime, 3),
+        }
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[Any, None]:
-    # 1. Setup Redis Connection
-    async with redis.from_url(REDIS_URL, decode_responses=True) as r:  # type: ignore[no-untyped-call]
+    # 1. Setup Redis Connection, replies to XREADGROUP come after up to BLOCK_MS
+    socket_timeout = max(REDIS_SOCKET_TIMEOUT_S, BLOCK_MS / 1000 + 1)
+    async with create_redis(socket_timeout=socket_timeout) as r:
         app.state.redis = r
 
-        # 2. Ensure Consumer Group exists
-        try:
-            # MKSTREAM creates the stream if it doesn't exist
-            await r.xgroup_create(
-                STREAM_NAME,
-                CONSUMER_GROUP,
-                id=StreamCreateStrategy.FROM_START,
-                mkstream=True,
-            )
-        except ResponseError as e:
-            if "BUSYGROUP" in str(e):
-                logger.info("Consumer group %s already exists", CONSUMER_GROUP)
-            else:
-                raise e
-        logger.info("Created consumer group: %s", CONSUMER_GROUP)
+        # 2. Ensure Consumer Group exists on every assigned partition
+        for stream in CONSUMER_STREAMS:
+            try:
+                # MKSTREAM creates the stream if it doesn't exist
+                await r.xgroup_create(
+                    stream,
+                    CONSUMER_GROUP,
+                    id=StreamCreateStrategy.FROM_START,
+                    mkstream=True,
+                )
+            except ResponseError as e:
+                if "BUSYGROUP" in str(e):
+                    logger.info("Consumer group %s already exists", CONSUMER_GROUP)
+                else:
+                    raise e
+        logger.info(
+            "Created consumer group: %s on %s", CONSUMER_GROUP, CONSUMER_STREAMS
+        )
+        if ROLLUPS_ENABLED:
+            # called by its sha in every store transaction
+            await load_merge_script(r)
 
-        # 3. Start the background consumer task
-        consumer_task = asyncio.create_task(consume_stream(app))
+        # 3. Start the background consumer, pending recovery and metrics tasks
+        tasks = [
+            asyncio.create_task(consume_stream(app)),
+            asyncio.create_task(reclaim_pending(app)),
+            asyncio.create_task(monitor_group(app)),
+        ]
+        if ARCHIVE_ENABLED:
+            # imports pyarrow, only pods archiving pay for it at startup
+            from services.consumer.archive import archive_loop
+
+            tasks.append(
+                asyncio.create_task(
+                    archive_loop(r, CONSUMER_NAME, read_cache.invalidate)
+                )
+            )
+        elif ARCHIVE_DIR:
+            logger.warning("ARCHIVE_DIR needs STORAGE_BACKEND=zset, not archiving")
+        live_hub.start(r)
 
         yield
 
-        # 4. Cleanup: Cancel the consumer task on shutdown
-        consumer_task.cancel()
-        try:
-            await consumer_task
-        except asyncio.CancelledError:
-            logger.info("Consumer task stopped.")
+        await live_hub.stop()
+
+        # 4. Cleanup: Cancel the background tasks on shutdown
+        for task in tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                logger.info("Task %s stopped.", task.get_coro())
 
 
-app = FastAPI(lifespan=lifespan)
+router = APIRouter()
+read_cache = ResponseCache(READ_CACHE_MAX_ENTRIES, READ_CACHE_TTL_S)
+live_hub = LiveHub(LIVE_QUEUE_SIZE)
+LIVE_SITES.set_function(lambda: live_hub.followed_sites)
 
 
-async def consume_stream(app: FastAPI) -> None:
+async def consume_stream(app: FastAPI, workers: int = CONSUMER_WORKERS) -> None:
     """
     Background worker that reads from Redis Stream and stores data by site_id.
+    One XREADGROUP reads all assigned partitions, a batch per partition.
+    With more than one worker the reader shards every batch by site_id hash,
+    so each site is always handled by the same worker and keeps its order.
     """
     r = app.state.redis
-    logger.info("Starting stream consumer...")
+    stats = [WorkerStats(worker_id=i) for i in range(workers)]
+    app.state.worker_stats = stats
+    logger.info("Starting stream consumer with %d workers...", workers)
 
+    queues: list[asyncio.Queue[tuple[str, Messages]]] = []
+    tasks: list[asyncio.Task[None]] = []
+    if workers > 1:
+        queues = [asyncio.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers)]
+        tasks = [
+            asyncio.create_task(_shard_worker(r, queue, worker_stats))
+            for queue, worker_stats in zip(queues, stats, strict=True)
+        ]
+
+    try:
+        while True:
+            try:
+                # Read new messages
+                # (">" means messages not yet delivered to other consumers)
+                # count: process in batches for efficiency
+                # block: wait up to BLOCK_MS milliseconds if stream is empty
+                # the histogram includes the BLOCK wait on an idle stream
+                with redis_timer("xreadgroup"):
+                    reply = await r.xreadgroup(
+                        CONSUMER_GROUP,
+                        CONSUMER_NAME,
+                        dict.fromkeys(CONSUMER_STREAMS, StreamReadMode.NEW_UNDELIVERED),
+                        count=BATCH_SIZE,
+                        block=BLOCK_MS,
+                    )
+            except Exception as e:
+                logger.error("Error in consumer loop: %s", e)
+                await asyncio.sleep(2)  # Prevent rapid-fire crashing
+                continue
+
+            for stream, messages in stream_reply(reply):
+                if not queues:
+                    await _timed_process(r, stream, messages, stats[0])
+                    continue
+                for index, shard in enumerate(shard_by_site(messages, workers)):
+                    if shard:
+                        await queues[index].put((stream, shard))
+    finally:
+        # un-ACKed messages of queued batches stay pending in the group
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def shard_by_site(messages: Messages, shards: int) -> list[Messages]:
+    """Splits messages into `shards` lists by a stable hash of their site_id."""
+    result: list[Messages] = [[] for _ in range(shards)]
+    for message in messages:
+        site_id = stream_entry_site_id(message[1])
+        result[zlib.crc32(site_id.encode()) % shards].append(message)
+    return result
+
+
+async def _shard_worker(
+    r: redis.Redis, queue: asyncio.Queue[tuple[str, Messages]], stats: WorkerStats
+) -> None:
     while True:
+        stream, messages = await queue.get()
+        try:
+            await _timed_process(r, stream, messages, stats)
+        finally:
+            queue.task_done()
+
+
+async def _timed_process(
+    r: redis.Redis, stream: str, messages: Messages, stats: WorkerStats
+) -> None:
+    start = time.perf_counter()
+    await process_messages(r, messages, stream)
+    stats.busy_seconds += time.perf_counter() - start
+    stats.messages += len(messages)
+    stats.batches += 1
+
+
+def _group_by_site(
+    messages: Messages, stream: str
+) -> tuple[SiteReadings, dict[str, list[str]]]:
+    """
+    Validates messages and groups them with their serialized payload by site_id,
+    along with their message ids. Order inside each site is the stream order.
+    Entries marked by the producer are trusted and not validated again.
+    """
+    by_site: SiteReadings = {}
+    message_ids: dict[str, list[str]] = {}
+    with batch_now():
+        for message_id, payload in messages:
+            try:
+                # Validate and parse the raw_data into a ReadingInput object
+                reading, fields = decode_stream_entry(payload)
+            except (ValidationError, ValueError, TypeError, OverflowError) as e:
+                # invalid messages are still ACKed with the batch,
+                # to prevent reprocessing bad data
+                logger.warning(
+                    "Message %s from stream %s failed validation: %s - Data: %s",
+                    message_id,
+                    stream,
+                    e,
+                    payload,
+                )
+                continue
+            by_site.setdefault(reading.site_id, []).append(
+                (reading, json.dumps(fields))
+            )
+            message_ids.setdefault(reading.site_id, []).append(message_id)
+    return by_site, message_ids
+
+
+async def process_messages(
+    r: redis.Redis, messages: Messages, stream: str = STREAM_NAME
+) -> None:
+    """
+    Stores one XREADGROUP batch of `stream` and ACKs it in a single MULTI/EXEC
+    round-trip.
+    one write group per touched site (see storage), one XACK for all message ids.
+    The ACK is sent only together with the writes, if the consumer dies or the
+    write fails the messages stay pending (at-least-once) until reclaimed, and
+    the dedup claims of the batch are released.
+    """
+    if not messages:
+        return
+    message_ids = [message_id for message_id, _payload in messages]
+    with VALIDATION_SECONDS.time():
+        by_site, site_message_ids = _group_by_site(messages, stream)
+    BATCH_MESSAGES.observe(len(messages))
+    valid = sum(len(readings) for readings in by_site.values())
+
+    claims: list[tuple[ReadingInput, str]] = []
+    try:
+        duplicates = 0
+        if DEDUP_ENABLED and by_site:
+            by_site, kept_ids, duplicates = await drop_duplicates(
+                r, by_site, site_message_ids
+            )
+            claims = [
+                (reading, message_id)
+                for site_id, readings in by_site.items()
+                for (reading, _v), message_id in zip(
+                    readings, kept_ids[site_id], strict=True
+                )
+            ]
+        merges: list[Merge] = []
+        async with r.pipeline(transaction=True) as pipe:
+            for site_id, readings in by_site.items():
+                stage_site_writes(pipe, site_id, readings)
+                if LIVE_ENABLED:
+                    stage_live_update(pipe, site_id, [v for _r, v in readings])
+                if ROLLUPS_ENABLED:
+                    merges += stage_rollups(pipe, [reading for reading, _v in readings])
+            pipe.xack(stream, CONSUMER_GROUP, *message_ids)
+            try:
+                with redis_timer("store_batch"):
+                    await pipe.execute()
+            except NoScriptError:
+                # Redis lost its scripts: the batch is stored and ACKed, only
+                # the merges did not run
+                await _rerun_merges(r, merges)
+    except RedisError as e:
+        MESSAGES.labels("failed").inc(len(message_ids))
+        logger.error(
+            "Error processing batch of %d messages %s: %s",
+            len(message_ids),
+            message_ids,
+            e,
+        )
+        # Left pending, reclaim_pending retries and dead-letters after
+        # MAX_DELIVERIES attempts
+        await _release_claims(r, claims)
+        return
+    except Exception:
+        # a bug must not stop the consumer loops, the batch is left pending
+        # like on a Redis error and dead-lettered after MAX_DELIVERIES attempts
+        MESSAGES.labels("failed").inc(len(message_ids))
+        logger.exception(
+            "Unexpected error processing batch of %d messages %s",
+            len(message_ids),
+            message_ids,
+        )
+        await _release_claims(r, claims)
+        return
+
+    MESSAGES.labels("acked").inc(valid - duplicates)
+    MESSAGES.labels("duplicate").inc(duplicates)
+    MESSAGES.labels("invalid").inc(len(message_ids) - valid)
+    for site_id in by_site:
+        read_cache.invalidate(site_id)
+    logger.debug(
+        "Processed and ACKed %d messages for %d sites",
+        len(message_ids),
+        len(by_site),
+    )
+
+
+async def _rerun_merges(r: redis.Redis, merges: list[Merge]) -> None:
+    """Reruns the rollup merges of a stored batch, best effort."""
+    logger.warning("Rollup script not loaded, reloading it")
+    try:
+        with redis_timer("rerun_merges"):
+            await rerun_merges(r, merges)
+    except RedisError as e:
+        # the messages are ACKed, a retry would store them twice
+        logger.error("Rollups of %d merges lost: %s", len(merges), e)
+
+
+async def _release_claims(
+    r: redis.Redis, claims: list[tuple[ReadingInput, str]]
+) -> None:
+    """
+    Releases dedup claims of readings that were not stored. If Redis is down
+    they stay: a redelivery still holds the claim, a dead-letter releases it.
+    """
+    try:
+        await release_claims(r, claims)
+    except RedisError as e:
+        logger.error("Error releasing %d dedup claims: %s", len(claims), e)
+
+
+def _decoded(messages: Messages) -> list[tuple[ReadingInput, str]]:
+    """(reading, message id) of the messages that decode, the others skipped."""
+    readings: list[tuple[ReadingInput, str]] = []
+    for message_id, payload in messages:
         try:
-            # Read new messages
-            # (">" means messages not yet delivered to other consumers)
-            # count=10: process in batches for efficiency
-            # block=5000: wait up to 5 seconds if stream is empty
-            streams = await r.xreadgroup(
+            readings.append((decode_stream_entry(payload)[0], message_id))
+        except (ValidationError, ValueError, TypeError, OverflowError):
+            continue
+    return readings
+
+
+async def reclaim_pending(app: FastAPI) -> None:
+    """
+    Background worker for the pending entries list (PEL).
+    On startup it drains this consumer's own pending messages, then it
+    periodically XAUTOCLAIMs messages idle longer than RECLAIM_MIN_IDLE_MS
+    (e.g. left by a dead pod) and processes them through the same path.
+    """
+    r = app.state.redis
+    for stream in CONSUMER_STREAMS:
+        try:
+            await drain_own_pending(r, stream)
+        except RedisError as e:
+            logger.error("Error draining pending messages of %s: %s", stream, e)
+
+    while True:
+        await asyncio.sleep(RECLAIM_INTERVAL_S)
+        for stream in CONSUMER_STREAMS:
+            try:
+                await autoclaim_idle(r, stream)
+            except RedisError as e:
+                logger.error("Error in reclaim loop of %s: %s", stream, e)
+
+
+async def drain_own_pending(r: redis.Redis, stream: str = STREAM_NAME) -> None:
+    """Re-processes messages delivered to this consumer but never ACKed."""
+    # start from the head of the own PEL, then continue after the last id
+    last_id: str = StreamReadMode.MY_PENDING
+    while True:
+        with redis_timer("xreadgroup_pending"):
+            reply = await r.xreadgroup(
                 CONSUMER_GROUP,
                 CONSUMER_NAME,
-                {STREAM_NAME: StreamReadMode.NEW_UNDELIVERED},
-                count=10,
-                block=5000,
+                {stream: last_id},
+                count=BATCH_SIZE,
             )
-        except Exception as e:
-            logger.error("Error in consumer loop: %s", e)
-            await asyncio.sleep(2)  # Prevent rapid-fire crashing
+        messages: Messages = [
+            # entries trimmed from the stream come back without payload
+            (message_id, payload or {})
+            for _stream, stream_messages in stream_reply(reply)
+            for message_id, payload in stream_messages
+        ]
+        if not messages:
+            return
+        logger.info("Recovering %d own pending messages", len(messages))
+        await recover_messages(r, messages, stream)
+        last_id = messages[-1][0]
+
+
+async def autoclaim_idle(r: redis.Redis, stream: str = STREAM_NAME) -> None:
+    """Claims idle pending messages of any consumer, one sweep over the PEL."""
+    start_id = "0-0"
+    while True:
+        with redis_timer("xautoclaim"):
+            response: list[Any] = await r.xautoclaim(
+                stream,
+                CONSUMER_GROUP,
+                CONSUMER_NAME,
+                min_idle_time=RECLAIM_MIN_IDLE_MS,
+                start_id=start_id,
+                count=BATCH_SIZE,
+            )
+        start_id, claimed = response[0], response[1]
+        messages: Messages = [(mid, payload or {}) for mid, payload in claimed]
+        if messages:
+            logger.info("Reclaimed %d idle pending messages", len(messages))
+            await recover_messages(r, messages, stream)
+        if start_id == "0-0":
+            return
+
+
+async def recover_messages(
+    r: redis.Redis, messages: Messages, stream: str = STREAM_NAME
+) -> None:
+    """
+    Processes redelivered messages. Messages delivered MAX_DELIVERIES times or
+    more are poison: they go to the dead-letter stream of their partition with
+    their delivery count and are ACKed instead of being retried forever.
+    Messages without payload were trimmed from the stream, there is nothing to
+    retry: they are ACKed so they leave the PEL.
+    """
+    dead_letter_stream = dead_letter_key(stream)
+    trimmed = [message_id for message_id, payload in messages if not payload]
+    if trimmed:
+        with redis_timer("xack_trimmed"):
+            await r.xack(stream, CONSUMER_GROUP, *trimmed)
+        MESSAGES.labels("trimmed").inc(len(trimmed))
+        logger.warning(
+            "ACKed %d pending messages trimmed from %s: %s",
+            len(trimmed),
+            stream,
+            trimmed,
+        )
+    if len(trimmed) == len(messages):
+        return
+
+    with redis_timer("xpending"):
+        pending: list[dict[str, Any]] = await r.xpending_range(
+            stream,
+            CONSUMER_GROUP,
+            min=messages[0][0],
+            max=messages[-1][0],
+            count=len(messages),
+            consumername=CONSUMER_NAME,
+        )
+    deliveries = {entry["message_id"]: entry["times_delivered"] for entry in pending}
+
+    retry: Messages = []
+    poison: Messages = []
+    for message_id, payload in messages:
+        if not payload:
             continue
+        delivered = deliveries.get(message_id, 1)
+        logger.debug("Message %s delivered %d times", message_id, delivered)
+        (poison if delivered >= MAX_DELIVERIES else retry).append((message_id, payload))
 
-        for _stream, messages in streams:
-            for message_id, payload in messages:
-                try:
-                    # Validate and parse the raw_data into a ReadingInput object
-                    reading = ReadingInput.model_validate(payload)
-                except ValidationError as e:
-                    logger.warning(
-                        "Message %s from stream %s failed Pydantic validation: %s "
-                        "- Data: %s",
-                        message_id,
-                        STREAM_NAME,
-                        e,
-                        payload,
-                    )
-                    # Acknowledge invalid messages to prevent reprocessing bad data
-                    await r.xack(STREAM_NAME, CONSUMER_GROUP, message_id)
-                    continue
+    if poison:
+        async with r.pipeline(transaction=True) as pipe:
+            for message_id, payload in poison:
+                dead_letter: dict[Any, Any] = {
+                    **payload,
+                    "original_id": message_id,
+                    "deliveries": deliveries[message_id],
+                }
+                pipe.xadd(dead_letter_stream, dead_letter)
+            pipe.xack(stream, CONSUMER_GROUP, *[mid for mid, _p in poison])
+            with redis_timer("dead_letter"):
+                await pipe.execute()
+        if DEDUP_ENABLED:
+            # copies of a dead-lettered reading must still be stored
+            await _release_claims(r, _decoded(poison))
+        MESSAGES.labels("dead_lettered").inc(len(poison))
+        logger.warning(
+            "Moved %d poison messages to %s: %s",
+            len(poison),
+            dead_letter_stream,
+            [mid for mid, _p in poison],
+        )
+    await process_messages(r, retry, stream)
 
-                site_id = reading.site_id
-
-                # Store in a Redis List specific to the site
-                storage_key = f"readings:site:{site_id}"
-
-                try:
-                    # LPUSH adds to the head, keeping latest readings first
-                    # LTRIM keeps only the last 1000 readings
-                    #   (optional, for memory safety)
-                    # LPUSH the string, not the dict
-                    await r.lpush(storage_key, json.dumps(payload))
-                    await r.ltrim(storage_key, 0, 999)
-                except redis.RedisError as e:
-                    logger.error(
-                        "Error processing message %s: %s - Data: %s",
-                        message_id,
-                        e,
-                        payload,
-                    )
-                    # If any other error, still acknowledge to prevent stuck messages.\
-                    await r.xack(STREAM_NAME, CONSUMER_GROUP, message_id)
-                    continue
 
-                # Acknowledge the message
-                await r.xack(STREAM_NAME, CONSUMER_GROUP, message_id)
-                logger.debug(
-                    "Processed and ACKed message %s for site %s",
-                    message_id,
-                    site_id,
-                )
+async def monitor_group(app: FastAPI) -> None:
+    """Refreshes the lag and pending gauges every METRICS_INTERVAL_S."""
+    r = app.state.redis
+    while True:
+        try:
+            await update_group_gauges(r)
+        except RedisError as e:
+            logger.error("Error reading consumer group info: %s", e)
+        await asyncio.sleep(METRICS_INTERVAL_S)
 
 
-@app.get("/sites/{site_id}/readings")
-async def get_site_readings(site_id: str) -> list[Any]:
-    """Returns all stored readings for the given site."""
-    storage_key = f"readings:site:{site_id}"
+async def update_group_gauges(r: redis.Redis) -> None:
+    for stream in CONSUMER_STREAMS:
+        with redis_timer("xinfo_groups"):
+            groups: list[dict[str, Any]] = await r.xinfo_groups(stream)
+        for group in groups:
+            if group["name"] != CONSUMER_GROUP:
+                continue
+            GROUP_PENDING.labels(stream).set(group["pending"])
+            # lag is nil when Redis cannot compute it (e.g. after XDEL)
+            if group.get("lag") is not None:
+                GROUP_LAG.labels(stream).set(group["lag"])
+
+
+class ReadingsFormat(StrEnum):
+    JSON = "json"  # a JSON list
+    NDJSON = "ndjson"  # one reading per line, streamed
+
+
+class SortOrder(StrEnum):
+    ASC = "asc"  # oldest first
+    DESC = "desc"  # latest first
+
+
+@router.get("/sites/{site_id}/readings")
+async def get_site_readings(
+    request: Request,
+    site_id: str,
+    start: Annotated[datetime | None, Query(alias="from")] = None,
+    end: Annotated[datetime | None, Query(alias="to")] = None,
+    device_id: str | None = None,
+    limit: Annotated[int | None, Query(ge=1)] = None,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    order: SortOrder = SortOrder.DESC,
+    total: bool = False,
+    format: ReadingsFormat = ReadingsFormat.JSON,
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    """
+    Returns the stored readings for the given site, latest first (`order=asc`
+    for oldest first).
+    `from`/`to` (ISO 8601 or epoch seconds, naive values are UTC), `device_id`
+    and `limit` narrow the result, served by range lookups on the zset backend.
+    `offset`/`limit` page through the readings, a full page carries the next
+    offset in the X-Next-Offset header, `total=true` adds the number of
+    matching readings in X-Total-Count (one more Redis call).
+    Stored readings are already JSON, they are sent as is without re-parsing.
+    JSON responses are cached per site and query, tagged with the site version
+    which is also the ETag, a matching If-None-Match gets 304 without a body.
+    """
+    query = ReadingQuery(
+        start=_epoch(start),
+        end=_epoch(end),
+        device_id=device_id,
+        limit=limit,
+        offset=offset,
+        ascending=order == SortOrder.ASC,
+    )
+    r = request.app.state.redis
+    if format == ReadingsFormat.NDJSON:
+        return StreamingResponse(
+            _stream_ndjson(r, site_id, query), media_type=NDJSON_MEDIA_TYPE
+        )
+
     try:
-        # Retrieve all items from the list
-        readings = await app.state.redis.lrange(storage_key, 0, -1)
-        # Parse strings back to JSON objects
-        return [json.loads(r) for r in readings]
+        with redis_timer("get_version"):
+            version = await r.get(site_version_key(site_id)) or "0"
+        cache_key = (query, total)
+        etag = f'"{version}-{zlib.crc32(repr(cache_key).encode()):08x}"'
+        if if_none_match == etag:
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+            )
+        cached = read_cache.get(site_id, cache_key, version)
+        if cached is not None:
+            return Response(
+                content=cached.body,
+                media_type="application/json",
+                headers=cached.headers,
+            )
+        with redis_timer("read_readings"):
+            readings = await read_site_readings(r, site_id, query)
+        headers = {"ETag": etag}
+        if total:
+            with redis_timer("count_readings"):
+                count = await count_site_readings(r, site_id, query)
+            headers[TOTAL_COUNT_HEADER] = str(count)
     except RedisError as e:
         logger.error("Failed to fetch readings for %s: %s", site_id, e)
+        return Response(content="[]", media_type="application/json")
+
+    if limit is not None and len(readings) == limit:
+        headers[NEXT_OFFSET_HEADER] = str(offset + limit)
+    body = f"[{','.join(readings)}]"
+    read_cache.put(site_id, cache_key, version, body, headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def _stream_ndjson(
+    r: redis.Redis, site_id: str, query: ReadingQuery
+) -> AsyncIterator[str]:
+    try:
+        async for chunk in iter_site_readings(r, site_id, query):
+            yield "\n".join(chunk) + "\n"
+    except RedisError as e:
+        # the status line is already sent, the stream just ends early
+        logger.error("Failed to stream readings for %s: %s", site_id, e)
+
+
+@router.get("/sites/{site_id}/live")
+async def follow_site_readings(site_id: str) -> StreamingResponse:
+    """
+    Server-Sent Events of the readings stored for the site from now on, a
+    `readings` event per processed batch with a JSON list of readings.
+    A `resync` event means readings were missed, the client should fetch
+    /sites/{site_id}/readings again and reconnect.
+    """
+    return StreamingResponse(
+        iter_live_events(live_hub, site_id),
+        media_type="text/event-stream",
+        # no caching or proxy buffering of the event stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/sites/{site_id}/aggregates", response_model=list[AggregateBucket])
+async def get_site_aggregates(
+    request: Request,
+    site_id: str,
+    resolution: Resolution = Resolution.HOUR,
+    start: Annotated[datetime | None, Query(alias="from")] = None,
+    end: Annotated[datetime | None, Query(alias="to")] = None,
+    device_id: str | None = None,
+) -> list[AggregateBucket]:
+    """
+    Returns count/sum/avg/min/max/last of power_reading per bucket, oldest first.
+    Answered from the rollups kept by the consumer, one lookup per bucket.
+    `to` defaults to now, `from` to DEFAULT_AGGREGATE_BUCKETS buckets before it.
+    """
+    bucket_size = BUCKET_SECONDS[resolution]
+    end_epoch = _epoch(end)
+    if end_epoch is None:
+        end_epoch = time.time()
+    start_epoch = _epoch(start)
+    if start_epoch is None:
+        start_epoch = end_epoch - (DEFAULT_AGGREGATE_BUCKETS - 1) * bucket_size
+    buckets = (end_epoch - start_epoch) // bucket_size + 1
+    if buckets > MAX_AGGREGATE_BUCKETS or buckets < 1:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail=f"Range must cover 1 to {MAX_AGGREGATE_BUCKETS} {resolution} "
+            "buckets",
+        )
+
+    try:
+        with redis_timer("read_rollups"):
+            return await read_rollups(
+                request.app.state.redis,
+                site_id,
+                device_id,
+                resolution,
+                start_epoch,
+                end_epoch,
+            )
+    except RedisError as e:
+        logger.error("Failed to fetch aggregates for %s: %s", site_id, e)
         return []
 
 
-@app.get("/health")
+@router.get("/sites/{site_id}/analytics", response_model=SiteAnalytics)
+async def get_site_analytics(
+    request: Request,
+    site_id: str,
+    start: Annotated[datetime | None, Query(alias="from")] = None,
+    end: Annotated[datetime | None, Query(alias="to")] = None,
+    device_id: str | None = None,
+) -> Response:
+    """
+    Returns avg/min/max/std and peak of power_reading, the energy integrated
+    over time and the anomalous readings of the stored readings of a site.
+    Computed with NumPy over the readings as arrays, cached per site and query
+    like /sites/{site_id}/readings until the site gets new readings.
+    """
+    from services.consumer.analytics import site_analytics
+
+    query = ReadingQuery(start=_epoch(start), end=_epoch(end), device_id=device_id)
+    return await _computed_response(
+        request.app.state.redis, site_id, query, ("analytics", query), site_analytics
+    )
+
+
+@router.get("/sites/{site_id}/series", response_model=ReadingSeries)
+async def get_site_series(
+    request: Request,
+    site_id: str,
+    start: Annotated[datetime | None, Query(alias="from")] = None,
+    end: Annotated[datetime | None, Query(alias="to")] = None,
+    device_id: str | None = None,
+    points: Annotated[int, Query(ge=10, le=MAX_SERIES_POINTS)] = (
+        DEFAULT_SERIES_POINTS
+    ),
+    method: DownsampleMethod = DownsampleMethod.LTTB,
+) -> Response:
+    """
+    Returns power_reading over time, oldest first, downsampled to at most
+    `points` points (e.g. the chart width in pixels) with LTTB or min/max per
+    bucket, so the payload does not grow with the history.
+    Cached like /sites/{site_id}/analytics.
+    """
+    from services.consumer.analytics import downsample
+
+    query = ReadingQuery(start=_epoch(start), end=_epoch(end), device_id=device_id)
+
+    def series(arrays: "ReadingArrays") -> ReadingSeries:
+        return downsample(arrays, points, method)
+
+    return await _computed_response(
+        request.app.state.redis,
+        site_id,
+        query,
+        ("series", query, points, method),
+        series,
+    )
+
+
+async def _computed_response(
+    r: redis.Redis,
+    site_id: str,
+    query: ReadingQuery,
+    cache_key: tuple[Any, ...],
+    compute: Callable[["ReadingArrays"], BaseModel],
+) -> Response:
+    """JSON of `compute` over the readings of `query`, from the read cache."""
+    from services.consumer.analytics import to_arrays
+
+    try:
+        with redis_timer("get_version"):
+            # decode_responses, the version is a str
+            version = str(await r.get(site_version_key(site_id)) or "0")
+        cached = read_cache.get(site_id, cache_key, version)
+        if cached is not None:
+            return Response(content=cached.body, media_type="application/json")
+        with redis_timer("read_readings"):
+            readings = await read_site_readings(r, site_id, query)
+    except RedisError as e:
+        logger.error("Failed to fetch readings for %s: %s", site_id, e)
+        readings, version = [], ""
+
+    body = compute(to_arrays(readings)).model_dump_json()
+    if version:
+        read_cache.put(site_id, cache_key, version, body, {})
+    return Response(content=body, media_type="application/json")
+
+
+@router.get("/export/readings")
+async def export_readings(
+    request: Request,
+    site_id: Annotated[list[str], Query(min_length=1)],
+    start: Annotated[datetime | None, Query(alias="from")] = None,
+    end: Annotated[datetime | None, Query(alias="to")] = None,
+    device_id: str | None = None,
+    format: ExportFormat = ExportFormat.CSV,
+) -> StreamingResponse:
+    """
+    Streams the stored readings of many sites (`site_id` repeated) as CSV,
+    Arrow IPC stream or Parquet, site by site, latest first.
+    `from`/`to` and `device_id` filter like GET /sites/{site_id}/readings.
+    Generated chunk by chunk, memory does not grow with the export size.
+    """
+    site_ids = list(dict.fromkeys(site_id))
+    if len(site_ids) > EXPORT_MAX_SITES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail=f"Export is limited to {EXPORT_MAX_SITES} sites",
+        )
+    from services.consumer.export import EXPORT_MEDIA_TYPES
+
+    query = ReadingQuery(start=_epoch(start), end=_epoch(end), device_id=device_id)
+    return StreamingResponse(
+        _stream_export(request.app.state.redis, site_ids, query, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="readings.{format}"'},
+    )
+
+
+async def _stream_export(
+    r: redis.Redis, site_ids: list[str], query: ReadingQuery, format: ExportFormat
+) -> AsyncIterator[bytes]:
+    import pyarrow as pa
+
+    from services.consumer.export import iter_export
+
+    try:
+        async for data in iter_export(r, site_ids, query, format):
+            yield data
+    except (RedisError, pa.ArrowInvalid) as e:
+        # the status line is already sent, the client gets a truncated file
+        logger.error("Failed to export readings of %d sites: %s", len(site_ids), e)
+
+
+def _epoch(value: datetime | None) -> float | None:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return value.timestamp()
+
+
+@router.get("/workers")
+async def get_worker_stats(request: Request) -> list[dict[str, float]]:
+    """Per worker throughput, used to size CONSUMER_WORKERS against KEDA lag."""
+    stats: list[WorkerStats] = getattr(request.app.state, "worker_stats", [])
+    return [worker.as_dict() for worker in stats]
+
+
+@router.get("/cache")
+async def get_cache_stats() -> dict[str, int | float]:
+    """Size, hit/miss and eviction counters of the readings response cache."""
+    return read_cache.as_dict()
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    """Prometheus metrics in the text exposition format."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@router.get("/health")
 async def health_check() -> dict[str, str]:
     return HEALTH_CHECK_DICT
+
+
+def create_app() -> FastAPI:
+    """
+    The consumer application, `uvicorn --factory services.consumer.main:create_app`.
+    NumPy and pyarrow are imported by the analytics and export routes on first
+    use, not at startup.
+    """
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str) -> Any:  # noqa: ANN401
+    # `services.consumer.main:app`, built on first access
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
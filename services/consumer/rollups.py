@@ -0,0 +1,229 @@
+"""
+Pre-aggregated rollups of power_reading, maintained while ingesting.
+
+Every reading updates a bucket per resolution (minute, hour, day) for its site
+and for its (site, device). A bucket holds count, sum, min, max and the last
+reading (the one with the latest timestamp, not the latest arrival), so late
+and out-of-order readings land in the bucket of their own timestamp.
+
+Buckets live in hashes partitioned by time, field = bucket start epoch:
+    rollup:{resolution}:site:{site_id}:{partition}
+    rollup:{resolution}:site:{site_id}:device:{device_id}:{partition}
+(site_id prefixed with the hash tag of its stream partition, see partitions).
+A batch is first reduced in python, then merged with one Lua call per hash.
+The script is loaded once at startup and called by its sha (EVALSHA) in the
+store transaction, after NOSCRIPT (Redis restarted or failed over) it is
+loaded again and the merges of the batch rerun.
+"""
+
+import hashlib
+import os
+import time
+from collections.abc import Iterable
+from dataclasses import dataclass
+from enum import StrEnum
+from typing import Any, cast
+
+import redis.asyncio as redis
+
+from shared_lib.model import (
+    DATE_FORMAT,
+    AggregateBucket,
+    ReadingInput,
+    timestamp_to_epoch,
+)
+from shared_lib.partitions import site_tag
+
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "true").lower() == "true"
+
+
+class Resolution(StrEnum):
+    MINUTE = "minute"
+    HOUR = "hour"
+    DAY = "day"
+
+
+DAY_S = 24 * 3600
+BUCKET_SECONDS = {Resolution.MINUTE: 60, Resolution.HOUR: 3600, Resolution.DAY: DAY_S}
+# Time span of one hash, keeps hashes small and lets old ones expire whole
+PARTITION_SECONDS = {
+    Resolution.MINUTE: DAY_S,
+    Resolution.HOUR: 30 * DAY_S,
+    Resolution.DAY: 365 * DAY_S,
+}
+# How long buckets are kept after their partition ends
+RETENTION_SECONDS = {
+    Resolution.MINUTE: 7 * DAY_S,
+    Resolution.HOUR: 90 * DAY_S,
+    Resolution.DAY: 10 * 365 * DAY_S,
+}
+
+# KEYS[1] rollup hash, ARGV[1] ttl, then groups of:
+#   bucket count sum min max last_ts last
+# a bucket value is "count sum min max last_ts last"
+MERGE_BUCKETS_LUA = """
+local key = KEYS[1]
+for i = 2, #ARGV, 7 do
+    local count, sum = tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2])
+    local low, high = tonumber(ARGV[i + 3]), tonumber(ARGV[i + 4])
+    local last_ts, last = tonumber(ARGV[i + 5]), tonumber(ARGV[i + 6])
+    local current = redis.call('HGET', key, ARGV[i])
+    if current then
+        local c = {}
+        for v in string.gmatch(current, '%S+') do c[#c + 1] = tonumber(v) end
+        count, sum = count + c[1], sum + c[2]
+        low, high = math.min(low, c[3]), math.max(high, c[4])
+        if c[5] > last_ts then last_ts, last = c[5], c[6] end
+    end
+    redis.call('HSET', key, ARGV[i], string.format(
+        '%d %.17g %.17g %.17g %d %.17g', count, sum, low, high, last_ts, last))
+end
+redis.call('EXPIRE', key, ARGV[1])
+return 1
+"""
+MERGE_BUCKETS_SHA = hashlib.sha1(MERGE_BUCKETS_LUA.encode()).hexdigest()
+
+# (rollup hash key, ARGV) of one merge
+Merge = tuple[str, list[Any]]
+
+
+@dataclass
+class Bucket:
+    count: int
+    sum: float
+    min: float
+    max: float
+    last_ts: int
+    last: float
+
+    def add(self, value: float, epoch: int) -> None:
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if epoch >= self.last_ts:
+            self.last_ts, self.last = epoch, value
+
+    def as_args(self) -> list[Any]:
+        return [self.count, self.sum, self.min, self.max, self.last_ts, self.last]
+
+    @classmethod
+    def parse(cls, value: str) -> "Bucket":
+        count, total, low, high, last_ts, last = value.split()
+        return cls(
+            int(count), float(total), float(low), float(high), int(last_ts), float(last)
+        )
+
+
+def rollup_key(
+    resolution: Resolution, site_id: str, device_id: str | None, partition: int
+) -> str:
+    site = f"site:{site_tag(site_id)}{site_id}"
+    scope = site if device_id is None else f"{site}:device:{device_id}"
+    return f"rollup:{resolution}:{scope}:{partition}"
+
+
+def bucket_start(epoch: float, resolution: Resolution) -> int:
+    size = BUCKET_SECONDS[resolution]
+    return int(epoch // size * size)
+
+
+def reduce_readings(
+    readings: Iterable[ReadingInput],
+) -> dict[tuple[Resolution, str], dict[int, Bucket]]:
+    """
+    Reduces a batch to (resolution, rollup hash key) -> bucket start -> partial
+    bucket, so each hash is merged once per batch.
+    """
+    result: dict[tuple[Resolution, str], dict[int, Bucket]] = {}
+    for reading in readings:
+        epoch = timestamp_to_epoch(reading.timestamp)
+        value = reading.power_reading
+        for resolution in Resolution:
+            start = bucket_start(epoch, resolution)
+            partition = start // PARTITION_SECONDS[resolution]
+            for device_id in (None, reading.device_id):
+                key = rollup_key(resolution, reading.site_id, device_id, partition)
+                buckets = result.setdefault((resolution, key), {})
+                if start in buckets:
+                    buckets[start].add(value, epoch)
+                else:
+                    buckets[start] = Bucket(1, value, value, value, epoch, value)
+    return result
+
+
+async def load_merge_script(r: redis.Redis) -> None:
+    """Loads the merge script into the Redis script cache."""
+    await r.script_load(MERGE_BUCKETS_LUA)
+
+
+def stage_rollups(
+    pipe: redis.client.Pipeline, readings: list[ReadingInput]
+) -> list[Merge]:
+    """
+    Queues one bucket merge per touched rollup hash on `pipe`, returns them.
+    Inside MULTI a NOSCRIPT fails only the merges, see rerun_merges.
+    """
+    merges: list[Merge] = []
+    for (resolution, key), buckets in reduce_readings(readings).items():
+        ttl = PARTITION_SECONDS[resolution] + RETENTION_SECONDS[resolution]
+        args: list[Any] = [ttl]
+        for start, bucket in buckets.items():
+            args.extend([start, *bucket.as_args()])
+        pipe.evalsha(MERGE_BUCKETS_SHA, 1, key, *args)
+        merges.append((key, args))
+    return merges
+
+
+async def rerun_merges(r: redis.Redis, merges: list[Merge]) -> None:
+    """
+    Loads the script again and runs merges that failed with NOSCRIPT. Such a
+    merge did not run, the rest of its transaction did.
+    """
+    await load_merge_script(r)
+    async with r.pipeline(transaction=True) as pipe:
+        for key, args in merges:
+            pipe.evalsha(MERGE_BUCKETS_SHA, 1, key, *args)
+        await pipe.execute()
+
+
+async def read_rollups(
+    r: redis.Redis,
+    site_id: str,
+    device_id: str | None,
+    resolution: Resolution,
+    start: float,
+    end: float,
+) -> list[AggregateBucket]:
+    """Returns the non-empty buckets between start and end, oldest first."""
+    size = BUCKET_SECONDS[resolution]
+    starts = range(bucket_start(start, resolution), int(end) + 1, size)
+    by_partition: dict[int, list[int]] = {}
+    for bucket in starts:
+        by_partition.setdefault(bucket // PARTITION_SECONDS[resolution], []).append(
+            bucket
+        )
+
+    async with r.pipeline(transaction=False) as pipe:
+        for partition, buckets in by_partition.items():
+            pipe.hmget(rollup_key(resolution, site_id, device_id, partition), buckets)
+        responses = cast(list[list[str | None]], await pipe.execute())
+
+    result: list[AggregateBucket] = []
+    for buckets, values in zip(by_partition.values(), responses, strict=True):
+        for bucket, value in zip(buckets, values, strict=True):
+            if value is None:
+                continue
+            parsed = Bucket.parse(value)
+            result.append(
+                AggregateBucket(
+                    start=time.strftime(DATE_FORMAT, time.gmtime(bucket)),
+                    count=parsed.count,
+                    sum=parsed.sum,
+                    avg=parsed.sum / parsed.count,
+                    min=parsed.min,
+                    max=parsed.max,
+                    last=parsed.last,
+                )
+            )
+    return result
@@ -0,0 +1,264 @@
+"""
+Cold storage of archived readings: compressed columnar segment files.
+
+Layout, one file per site and archived window (see archive):
+`{ARCHIVE_DIR}/site={site_id}/day={YYYY-MM-DD}/{window_start}-{window_end}.parquet`
+(site_id percent-encoded). A segment is written once, to a temporary file that
+is synced and renamed into place, so readers see all of it or nothing. A day
+directory only grows; a window is rewritten (same name, same rename) only to
+merge readings that arrived after it was archived.
+
+A segment is Parquet, zstd compressed, rows sorted by epoch:
+- epoch (int64): the zset score, epoch seconds
+- device_id, power_reading: the filter and statistics columns
+- value: the stored JSON, returned as is, like the hot readings
+
+The footer is the index of the segment: row counts and min/max epoch of every
+row group (Parquet statistics) plus `min_epoch`, `max_epoch` and `devices` of
+the whole file in its key-value metadata. Reads memory-map the file, read the
+footer, and skip segments and row groups outside the time range or without the
+device, only the row groups that may match are decompressed.
+"""
+
+import json
+import os
+from collections.abc import Iterator
+from datetime import UTC, datetime
+from pathlib import Path
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pa_parquet
+
+from services.consumer.export import parse_readings
+from services.consumer.storage import ReadingQuery
+
+# Rows per row group, the unit skipped by the footer index
+SEGMENT_ROW_GROUP_ROWS = int(os.getenv("SEGMENT_ROW_GROUP_ROWS", 16384))
+
+SEGMENT_SUFFIX = ".parquet"
+DAY_SECONDS = 86400
+
+SEGMENT_SCHEMA = pa.schema(
+    [
+        ("epoch", pa.int64()),
+        ("device_id", pa.string()),
+        ("power_reading", pa.float64()),
+        ("value", pa.string()),
+    ]
+)
+
+
+def site_directory(directory: Path, site_id: str) -> Path:
+    # "site=" keeps "." and ".." site ids inside the directory
+    return directory / f"site={quote(site_id, safe='')}"
+
+
+def segment_path(directory: Path, site_id: str, start: int, end: int) -> Path:
+    day = datetime.fromtimestamp(start, UTC).strftime("%Y-%m-%d")
+    return (
+        site_directory(directory, site_id)
+        / f"day={day}"
+        / f"{start}-{end}{SEGMENT_SUFFIX}"
+    )
+
+
+def write_segment(
+    directory: Path,
+    site_id: str,
+    window: tuple[int, int],
+    values: list[str],
+    epochs: list[int],
+) -> Path:
+    """
+    Writes the readings of `window` [start, end) as one segment, replacing the
+    segment of the window if there is one. `values` are sorted by epoch.
+    """
+    columns = parse_readings(values)
+    devices = sorted(set(columns["device_id"].to_pylist()))
+    table = pa.table(
+        [
+            pa.array(epochs, pa.int64()),
+            columns["device_id"],
+            columns["power_reading"],
+            pa.array(values, pa.string()),
+        ],
+        schema=SEGMENT_SCHEMA,
+    ).replace_schema_metadata(
+        {
+            "min_epoch": str(min(epochs)),
+            "max_epoch": str(max(epochs)),
+            "devices": json.dumps(devices),
+        }
+    )
+
+    path = segment_path(directory, site_id, *window)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix(".tmp")
+    with temporary.open("wb") as file:
+        pa_parquet.write_table(
+            table, file, compression="zstd", row_group_size=SEGMENT_ROW_GROUP_ROWS
+        )
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    # the rename is durable once the directory entry is
+    descriptor = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+    return path
+
+
+def read_window(
+    directory: Path, site_id: str, window: tuple[int, int]
+) -> tuple[list[str], list[int]]:
+    """The values and epochs of the segment of `window`, empty without one."""
+    path = segment_path(directory, site_id, *window)
+    if not path.exists():
+        return [], []
+    with pa.memory_map(str(path)) as source:
+        table = pa_parquet.read_table(source, columns=["value", "epoch"])
+    return table["value"].to_pylist(), table["epoch"].to_pylist()
+
+
+def iter_segments(
+    directory: Path, site_id: str, query: ReadingQuery, chunk_size: int
+) -> Iterator[list[str]]:
+    """
+    Yields the archived readings matching `query` in its order and page, in
+    chunks of at most `chunk_size`.
+    """
+    skip, remaining = query.offset, query.limit
+    chunk: list[str] = []
+    for values in _iter_matches(directory, site_id, query):
+        if skip:
+            skipped = min(skip, len(values))
+            values, skip = values[skipped:], skip - skipped
+        if remaining is not None:
+            values = values[:remaining]
+            remaining -= len(values)
+        chunk.extend(values)
+        while len(chunk) >= chunk_size:
+            yield chunk[:chunk_size]
+            chunk = chunk[chunk_size:]
+        if remaining == 0:
+            break
+    if chunk:
+        yield chunk
+
+
+def read_segments(directory: Path, site_id: str, query: ReadingQuery) -> list[str]:
+    """The archived readings matching `query`, in its order and page."""
+    return [
+        value
+        for chunk in iter_segments(directory, site_id, query, SEGMENT_ROW_GROUP_ROWS)
+        for value in chunk
+    ]
+
+
+def count_segments(directory: Path, site_id: str, query: ReadingQuery) -> int:
+    """Number of archived readings matching the filters of `query`."""
+    count = 0
+    for path in _segment_paths(directory, site_id, query):
+        with pa.memory_map(str(path)) as source:
+            segment = pa_parquet.ParquetFile(source)
+            for index in _matching_row_groups(segment, query):
+                group = segment.metadata.row_group(index)
+                low, high = _epoch_range(group)
+                inside = (query.start is None or query.start <= low) and (
+                    query.end is None or high <= query.end
+                )
+                if inside and query.device_id is None:
+                    # the footer has the answer, the rows are not read
+                    count += group.num_rows
+                    continue
+                table = segment.read_row_group(index, columns=["epoch", "device_id"])
+                count += pc.sum(_mask(table, query)).as_py() or 0
+    return count
+
+
+def _iter_matches(
+    directory: Path, site_id: str, query: ReadingQuery
+) -> Iterator[list[str]]:
+    """The matching values of each row group, oldest first or latest first."""
+    paths = _segment_paths(directory, site_id, query)
+    for path in paths if query.ascending else reversed(paths):
+        with pa.memory_map(str(path)) as source:
+            segment = pa_parquet.ParquetFile(source)
+            groups = _matching_row_groups(segment, query)
+            for index in groups if query.ascending else reversed(groups):
+                table = segment.read_row_group(
+                    index, columns=["epoch", "device_id", "value"]
+                )
+                values: list[str] = table.filter(_mask(table, query))[
+                    "value"
+                ].to_pylist()
+                yield values if query.ascending else values[::-1]
+
+
+def _segment_paths(directory: Path, site_id: str, query: ReadingQuery) -> list[Path]:
+    """Segments of the site that may hold readings of `query`, oldest first."""
+    site = site_directory(directory, site_id)
+    if not site.is_dir():
+        return []
+    paths: list[tuple[int, Path]] = []
+    for day in sorted(site.iterdir()):
+        day_start = int(
+            datetime.strptime(day.name.removeprefix("day="), "%Y-%m-%d")
+            .replace(tzinfo=UTC)
+            .timestamp()
+        )
+        if not _overlaps(query, day_start, day_start + DAY_SECONDS):
+            continue
+        for path in day.glob(f"*{SEGMENT_SUFFIX}"):
+            start, end = (int(bound) for bound in path.stem.split("-"))
+            if _overlaps(query, start, end):
+                paths.append((start, path))
+    return [path for _start, path in sorted(paths)]
+
+
+def _matching_row_groups(
+    segment: pa_parquet.ParquetFile, query: ReadingQuery
+) -> list[int]:
+    metadata = segment.schema_arrow.metadata
+    if query.device_id is not None and query.device_id not in json.loads(
+        metadata[b"devices"]
+    ):
+        return []
+    if not _overlaps(
+        query, int(metadata[b"min_epoch"]), int(metadata[b"max_epoch"]) + 1
+    ):
+        return []
+    groups: list[int] = []
+    for index in range(segment.metadata.num_row_groups):
+        low, high = _epoch_range(segment.metadata.row_group(index))
+        if _overlaps(query, low, high + 1):
+            groups.append(index)
+    return groups
+
+
+def _epoch_range(group: pa_parquet.RowGroupMetaData) -> tuple[int, int]:
+    """Min and max epoch of a row group, from its statistics (epoch is column 0)."""
+    statistics = group.column(0).statistics
+    return int(statistics.min), int(statistics.max)
+
+
+def _overlaps(query: ReadingQuery, start: int, end: int) -> bool:
+    """Whether the inclusive query bounds meet the epochs [start, end)."""
+    return (query.start is None or query.start < end) and (
+        query.end is None or query.end >= start
+    )
+
+
+def _mask(table: pa.Table, query: ReadingQuery) -> pa.ChunkedArray:
+    mask = pc.is_valid(table["epoch"])
+    if query.start is not None:
+        mask = pc.and_(mask, pc.greater_equal(table["epoch"], query.start))
+    if query.end is not None:
+        mask = pc.and_(mask, pc.less_equal(table["epoch"], query.end))
+    if query.device_id is not None:
+        mask = pc.and_(mask, pc.equal(table["device_id"], query.device_id))
+    return mask
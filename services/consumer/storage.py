@@ -0,0 +1,405 @@
+"""
+Per-site storage of processed readings.
+
+Two backends, selected with STORAGE_BACKEND:
+- `list`: a capped Redis list per site, latest reading first (default)
+- `zset`: sorted sets scored by the reading epoch seconds, one per site and one
+  per (site, device), trimmed by age. Serves time-range queries with ZRANGEBYSCORE.
+
+With ARCHIVE_DIR set (zset backend), readings older than ARCHIVE_AFTER_S move to
+segment files (see archive and segments). The archive watermark of a site splits
+its readings: the epochs below it are read from the segments, the others from
+Redis, and a query spanning both is answered from both tiers, one page across
+them.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from dataclasses import dataclass, replace
+from enum import StrEnum
+from pathlib import Path
+from typing import Any, cast
+
+import redis.asyncio as redis
+
+from shared_lib.model import ReadingInput, timestamp_to_epoch
+from shared_lib.partitions import site_tag
+
+
+class StorageBackend(StrEnum):
+    LIST = "list"
+    ZSET = "zset"
+
+
+STORAGE_BACKEND = StorageBackend(os.getenv("STORAGE_BACKEND", StorageBackend.LIST))
+# Readings kept per site list (LTRIM cap), list backend only
+SITE_READINGS_LIMIT = 1000
+# Age after which readings are dropped, zset backend only (default 7 days)
+READINGS_RETENTION_S = int(os.getenv("READINGS_RETENTION_S", 7 * 24 * 3600))
+# Readings fetched per LRANGE/ZRANGE call when streaming or scanning
+READ_CHUNK_SIZE = int(os.getenv("READ_CHUNK_SIZE", 500))
+# Directory of the archived segment files, a volume shared by every consumer
+# pod. Empty: readings stay in Redis until the retention trim
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")
+# Age after which readings move to ARCHIVE_DIR, keep READINGS_RETENTION_S above
+# it: the retention trim still drops what was not archived in time
+ARCHIVE_AFTER_S = int(os.getenv("ARCHIVE_AFTER_S", 24 * 3600))
+ARCHIVE_ENABLED = bool(ARCHIVE_DIR) and STORAGE_BACKEND == StorageBackend.ZSET
+
+
+# Keys of a site carry the hash tag of its stream partition (see partitions)
+SITE_INDEX_PREFIX = "readings:ts:site:"
+
+
+def site_key(site_id: str) -> str:
+    return f"readings:site:{site_tag(site_id)}{site_id}"
+
+
+def site_index_key(site_id: str) -> str:
+    return f"{SITE_INDEX_PREFIX}{site_tag(site_id)}{site_id}"
+
+
+def device_index_key(site_id: str, device_id: str) -> str:
+    return f"{site_index_key(site_id)}:device:{device_id}"
+
+
+def archive_watermark_key(site_id: str) -> str:
+    """Epoch below which the readings of a site are archived."""
+    return f"readings:archive:site:{site_tag(site_id)}{site_id}"
+
+
+def site_version_key(site_id: str) -> str:
+    """Counter bumped on every write to a site, tags cached responses."""
+    return f"readings:version:site:{site_tag(site_id)}{site_id}"
+
+
+@dataclass(frozen=True)
+class ReadingQuery:
+    """
+    Optional filters, order and page of a site readings request.
+    bounds are epoch seconds, offset counts from the latest reading, or from
+    the oldest one when ascending.
+    """
+
+    start: float | None = None
+    end: float | None = None
+    device_id: str | None = None
+    limit: int | None = None
+    offset: int = 0
+    ascending: bool = False
+
+    @property
+    def has_filters(self) -> bool:
+        return (
+            self.start is not None or self.end is not None or self.device_id is not None
+        )
+
+
+def stage_site_writes(
+    pipe: redis.client.Pipeline,
+    site_id: str,
+    readings: list[tuple[ReadingInput, str]],
+) -> None:
+    """
+    Queues the commands that store `readings` (model, serialized payload) of one
+    site on `pipe`. readings are in stream order.
+    """
+    pipe.incr(site_version_key(site_id))
+    if STORAGE_BACKEND == StorageBackend.ZSET:
+        _stage_zset_writes(pipe, site_id, readings)
+        return
+
+    key = site_key(site_id)
+    # LPUSH adds to the head, keeping latest readings first
+    # LTRIM keeps only the last SITE_READINGS_LIMIT readings
+    #   (optional, for memory safety)
+    pipe.lpush(key, *[value for _reading, value in readings])
+    pipe.ltrim(key, 0, SITE_READINGS_LIMIT - 1)
+
+
+def _stage_zset_writes(
+    pipe: redis.client.Pipeline,
+    site_id: str,
+    readings: list[tuple[ReadingInput, str]],
+) -> None:
+    site_members: dict[str, float] = {}
+    device_members: dict[str, dict[str, float]] = {}
+    for reading, value in readings:
+        score = timestamp_to_epoch(reading.timestamp)
+        site_members[value] = score
+        device_members.setdefault(reading.device_id, {})[value] = score
+
+    # exclusive bound, readings older than the retention age are removed
+    cutoff = f"({time.time() - READINGS_RETENTION_S}"
+    keys = [site_index_key(site_id)]
+    pipe.zadd(keys[0], site_members)
+    for device_id, members in device_members.items():
+        keys.append(device_index_key(site_id, device_id))
+        pipe.zadd(keys[-1], members)
+    for key in keys:
+        pipe.zremrangebyscore(key, "-inf", cutoff)
+        # a site without new readings expires as a whole
+        pipe.expire(key, READINGS_RETENTION_S)
+
+
+async def read_site_readings(
+    r: redis.Redis, site_id: str, query: ReadingQuery
+) -> list[str]:
+    """Returns one page of serialized readings of a site, latest first."""
+    if ARCHIVE_ENABLED:
+        from services.consumer.segments import read_segments
+
+        hot, cold = await _split_tiers(r, site_id, query)
+        hot_values = [] if hot is None else await _read_zset(r, site_id, hot)
+        cold_values = (
+            []
+            if cold is None
+            else await asyncio.to_thread(
+                read_segments, Path(ARCHIVE_DIR), site_id, cold
+            )
+        )
+        if query.ascending:
+            return cold_values + hot_values
+        return hot_values + cold_values
+    if STORAGE_BACKEND == StorageBackend.ZSET:
+        return await _read_zset(r, site_id, query)
+
+    if not query.has_filters and query.ascending:
+        # oldest first is read from the tail of the list
+        start = 0 if query.limit is None else -(query.offset + query.limit)
+        values = await cast(
+            Awaitable[list[str]],
+            r.lrange(site_key(site_id), start, -(query.offset + 1)),
+        )
+        return values[::-1]
+    if not query.has_filters:
+        stop = -1 if query.limit is None else query.offset + query.limit - 1
+        return await cast(
+            Awaitable[list[str]], r.lrange(site_key(site_id), query.offset, stop)
+        )
+    if query.ascending:
+        # the scan runs from the head, the list is capped so it is read whole
+        latest_first = replace(query, offset=0, limit=None, ascending=False)
+        matched = (await read_site_readings(r, site_id, latest_first))[::-1]
+        end = None if query.limit is None else query.offset + query.limit
+        return matched[query.offset : end]
+    return [
+        value
+        async for chunk in _iter_filtered_list(r, site_id, query, READ_CHUNK_SIZE)
+        for value in chunk
+    ]
+
+
+async def count_site_readings(r: redis.Redis, site_id: str, query: ReadingQuery) -> int:
+    """Number of readings matching the filters of `query`, its page ignored."""
+    everything = replace(query, offset=0, limit=None)
+    if ARCHIVE_ENABLED:
+        hot, cold = await _split_tiers(r, site_id, everything)
+        count = 0 if hot is None else await _count_zset(r, site_id, hot)
+        if cold is not None:
+            count += await _count_segments(site_id, cold)
+        return count
+    if STORAGE_BACKEND == StorageBackend.ZSET:
+        return await _count_zset(r, site_id, query)
+    if not query.has_filters:
+        return await cast(Awaitable[int], r.llen(site_key(site_id)))
+    return sum(
+        [
+            len(chunk)
+            async for chunk in _iter_filtered_list(
+                r, site_id, everything, READ_CHUNK_SIZE
+            )
+        ]
+    )
+
+
+async def _read_zset(r: redis.Redis, site_id: str, query: ReadingQuery) -> list[str]:
+    low, high = _score_range(query)
+    # LIMIT needs both offset and count, -1 means no count
+    paged = query.limit is not None or query.offset > 0
+    key = _index_key(site_id, query)
+    start = query.offset if paged else None
+    num = (query.limit or -1) if paged else None
+    # redis-py types the bounds of ZRANGE as ranks, these take scores
+    if query.ascending:
+        members = await r.zrangebyscore(key, low, high, start=start, num=num)
+    else:
+        members = await r.zrevrangebyscore(key, high, low, start=start, num=num)
+    # decode_responses=True, members are str
+    return cast(list[str], members)
+
+
+async def _count_zset(r: redis.Redis, site_id: str, query: ReadingQuery) -> int:
+    low, high = _score_range(query)
+    count: int = await r.zcount(_index_key(site_id, query), low, high)
+    return count
+
+
+async def _count_segments(site_id: str, query: ReadingQuery) -> int:
+    from services.consumer.segments import count_segments
+
+    return await asyncio.to_thread(count_segments, Path(ARCHIVE_DIR), site_id, query)
+
+
+async def _split_tiers(
+    r: redis.Redis, site_id: str, query: ReadingQuery
+) -> tuple[ReadingQuery | None, ReadingQuery | None]:
+    """
+    The Redis (hot) and segment (cold) parts of `query`, None for a part out
+    of its range or page. The page of `query` runs over the latest readings
+    first (hot then cold), or the oldest first when ascending.
+    """
+    watermark = await r.get(archive_watermark_key(site_id))
+    if watermark is None:
+        return query, None
+    # epochs are whole seconds, the cold tier ends one second below
+    boundary = int(watermark)
+    if query.start is not None and query.start >= boundary:
+        return query, None
+    cold = replace(
+        query, end=boundary - 1 if query.end is None else min(query.end, boundary - 1)
+    )
+    if query.end is not None and query.end < boundary:
+        return None, cold
+    hot = replace(
+        query, start=boundary if query.start is None else max(query.start, boundary)
+    )
+    if query.offset == 0 and query.limit is None:
+        return hot, cold
+
+    # the page starts in the first tier and continues in the second
+    if query.ascending:
+        first_total = await _count_segments(site_id, cold)
+    else:
+        first_total = await _count_zset(r, site_id, hot)
+    taken = max(min(first_total - query.offset, query.limit or first_total), 0)
+    if query.limit is not None and taken == query.limit:
+        second = None
+    else:
+        second = replace(
+            cold if not query.ascending else hot,
+            offset=max(query.offset - first_total, 0),
+            limit=None if query.limit is None else query.limit - taken,
+        )
+    first = None if taken == 0 else (cold if query.ascending else hot)
+    if query.ascending:
+        return second, first
+    return first, second
+
+
+def _index_key(site_id: str, query: ReadingQuery) -> str:
+    if query.device_id:
+        return device_index_key(site_id, query.device_id)
+    return site_index_key(site_id)
+
+
+def _score_range(query: ReadingQuery) -> tuple[float | str, float | str]:
+    return (
+        "-inf" if query.start is None else query.start,
+        "+inf" if query.end is None else query.end,
+    )
+
+
+async def iter_site_readings(
+    r: redis.Redis, site_id: str, query: ReadingQuery
+) -> AsyncIterator[list[str]]:
+    """
+    Yields the readings of `query` in chunks of at most READ_CHUNK_SIZE,
+    so a whole site can be sent without holding it in memory.
+    """
+    chunk_size = READ_CHUNK_SIZE
+    if STORAGE_BACKEND == StorageBackend.LIST and query.has_filters:
+        if query.ascending:
+            yield await read_site_readings(r, site_id, query)
+            return
+        async for chunk in _iter_filtered_list(r, site_id, query, chunk_size):
+            yield chunk
+        return
+    if not ARCHIVE_ENABLED:
+        async for chunk in _iter_pages(
+            lambda page: read_site_readings(r, site_id, page), query, chunk_size
+        ):
+            yield chunk
+        return
+
+    from services.consumer.segments import iter_segments
+
+    hot, cold = await _split_tiers(r, site_id, query)
+    if cold is not None and query.ascending:
+        async for chunk in _iter_thread(
+            iter_segments(Path(ARCHIVE_DIR), site_id, cold, chunk_size)
+        ):
+            yield chunk
+    if hot is not None:
+        async for chunk in _iter_pages(
+            lambda page: _read_zset(r, site_id, page), hot, chunk_size
+        ):
+            yield chunk
+    if cold is not None and not query.ascending:
+        async for chunk in _iter_thread(
+            iter_segments(Path(ARCHIVE_DIR), site_id, cold, chunk_size)
+        ):
+            yield chunk
+
+
+async def _iter_pages(
+    read: Callable[[ReadingQuery], Awaitable[list[str]]],
+    query: ReadingQuery,
+    chunk_size: int,
+) -> AsyncIterator[list[str]]:
+    """The page of `query` read by `read` in pages of at most `chunk_size`."""
+    offset, remaining = query.offset, query.limit
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        chunk = await read(replace(query, offset=offset, limit=size))
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        offset += len(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+
+
+async def _iter_thread(chunks: Iterator[list[str]]) -> AsyncIterator[list[str]]:
+    """Chunks of a blocking iterator (segment reads), each read in a thread."""
+    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+        yield chunk
+
+
+async def _iter_filtered_list(
+    r: redis.Redis, site_id: str, query: ReadingQuery, chunk_size: int
+) -> AsyncIterator[list[str]]:
+    """The list backend has no index, filters fall back to a chunked scan."""
+    skip, remaining = query.offset, query.limit
+    index = 0
+    while remaining is None or remaining > 0:
+        values = await cast(
+            Awaitable[list[str]],
+            r.lrange(site_key(site_id), index, index + chunk_size - 1),
+        )
+        index += len(values)
+        matched = [value for value in values if _matches(value, query)]
+        if skip:
+            skipped = min(skip, len(matched))
+            matched, skip = matched[skipped:], skip - skipped
+        if remaining is not None:
+            matched = matched[:remaining]
+            remaining -= len(matched)
+        if matched:
+            yield matched
+        if len(values) < chunk_size:
+            return
+
+
+def _matches(value: str, query: ReadingQuery) -> bool:
+    reading: dict[str, Any] = json.loads(value)
+    epoch = timestamp_to_epoch(reading["timestamp"])
+    if query.start is not None and epoch < query.start:
+        return False
+    if query.end is not None and epoch > query.end:
+        return False
+    return query.device_id is None or reading["device_id"] == query.device_id
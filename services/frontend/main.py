@@ -1,18 +1,77 @@
+import asyncio
+import json
 import os
+from collections.abc import AsyncIterator
 from datetime import datetime
+from typing import Any
 
 import httpx
-from nicegui import ui
+from nicegui import app, background_tasks, ui
+from nicegui.events import GenericEventArguments
 from pydantic import ValidationError
 
+from services.frontend.upstream import UpstreamClient
 from shared_lib.model import DATE_FORMAT, ReadingInput
 
 # --- Configuration ---
 PRODUCER_URL = os.getenv("PRODUCER_URL", "http://producer:8000")
 CONSUMER_URL = os.getenv("CONSUMER_URL", "http://consumer:8000")
 
-# Persistent client for connection pooling
-client = httpx.AsyncClient(timeout=10.0)
+# Read timeout of the live stream, above the consumer heartbeat (15s)
+LIVE_READ_TIMEOUT_S = float(os.getenv("LIVE_READ_TIMEOUT_S", 45))
+# Wait before reconnecting a dropped live stream
+LIVE_RETRY_S = 2.0
+
+# Page sizes offered by the history table, each page is fetched on demand
+PAGE_SIZES = [10, 25, 50, 100]
+# Chart points, one per pixel of the chart width within these bounds
+MIN_SERIES_POINTS = 100
+MAX_SERIES_POINTS = 4000
+
+HISTORY_COLUMNS: list[dict[str, Any]] = [
+    {
+        "name": "timestamp",
+        "label": "Timestamp",
+        "field": "timestamp",
+        # the only order the consumer serves, the other columns do not sort
+        "sortable": True,
+    },
+    {
+        "name": "value",
+        "label": "Reading (kWh)",
+        "field": "power_reading",
+    },
+    {
+        "name": "device_id",
+        "label": "Device id",
+        "field": "device_id",
+    },
+]
+
+# Connection pool to the backends, each live view holds one connection
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 200))
+# Idle connections kept open for reuse, and for how long
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 50))
+HTTP_KEEPALIVE_EXPIRY_S = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_S", 30))
+HTTP_TIMEOUT_S = float(os.getenv("HTTP_TIMEOUT_S", 10))
+# Refresh window of site reads: viewers of a site share one response per window,
+# 0 disables the cache (identical requests in flight are still coalesced)
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", 2))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+
+# Pooled client shared by all sessions, opened and closed with the app
+upstream = UpstreamClient(
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_S,
+    ),
+    timeout=HTTP_TIMEOUT_S,
+    ttl_s=RESPONSE_CACHE_TTL_S,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+)
+app.on_startup(upstream.start)
+app.on_shutdown(upstream.stop)
 
 # --- Logic ---
 
@@ -34,12 +93,14 @@ async def send_reading(
         return
 
     try:
-        response = await client.post(
+        response = await upstream.client.post(
             f"{PRODUCER_URL}/readings", json=payload.model_dump()
         )
 
         # Check status INSIDE the try block to avoid UnboundLocalError
         if response.is_success:
+            # the next fetch of the site should include the reading
+            upstream.invalidate(site_id)
             # We show the success and the site_id
             ui.notify(
                 f"""✅ Reading sent for {site_id}:
@@ -58,63 +119,242 @@ async def send_reading(
         ui.notify(f"📡 Connection to Producer failed: {str(e)}", type="negative")
 
 
-async def fetch_readings(site_id: str, container: ui.column) -> None:
-    """Fetches historical readings from the Consumer API and renders a table."""
+class HistoryTable:
+    """
+    Readings table of a site, each page and sort order is requested from the
+    Consumer API, the browser only holds the rows on screen.
+    """
+
+    def __init__(self, site_id: str) -> None:
+        self.site_id = site_id
+        self.table = ui.table(
+            columns=HISTORY_COLUMNS,
+            rows=[],
+            # rowsNumber switches the table to server side pagination
+            pagination={
+                "page": 1,
+                "rowsPerPage": PAGE_SIZES[0],
+                "sortBy": "timestamp",
+                "descending": True,
+                "rowsNumber": 0,
+            },
+        ).classes("w-full mt-4 shadow-sm")
+        self.table.props(f":rows-per-page-options={json.dumps(PAGE_SIZES)}")
+        self.table.on("request", self._on_request)
+        # whether rowsNumber holds a count from the consumer
+        self._counted = False
+
+    @property
+    def total(self) -> int:
+        return int(self.table.pagination.get("rowsNumber", 0))
+
+    async def load(self, pagination: dict[str, Any] | None = None) -> bool:
+        """
+        Shows the page of `pagination` (default: the current one). The total is
+        counted on the first page, live readings keep it current on the others.
+        """
+        pagination = dict(pagination or self.table.pagination)
+        sort_by = pagination.get("sortBy")
+        if sort_by is None:
+            # sorting cleared (third click on the header): the default order
+            pagination.update(sortBy="timestamp", descending=True)
+        elif sort_by != "timestamp":
+            # the consumer orders by timestamp only, keep the current order
+            current = self.table.pagination
+            pagination.update(
+                sortBy="timestamp", descending=current.get("descending", True)
+            )
+        size = pagination.get("rowsPerPage") or PAGE_SIZES[-1]
+        page = pagination.get("page", 1)
+        count = page == 1 or not self._counted
+        params: dict[str, str | int] = {
+            "offset": (page - 1) * size,
+            "limit": size,
+            "order": "desc" if pagination.get("descending", True) else "asc",
+        }
+        if count:
+            params["total"] = "true"
+        try:
+            response = await upstream.get_site(
+                self.site_id, f"{CONSUMER_URL}/sites/{self.site_id}/readings", params
+            )
+        except httpx.HTTPError as e:
+            ui.notify(f"📡 Connection to Consumer failed: {str(e)}", type="negative")
+            return False
+        if response.status_code != httpx.codes.OK:
+            ui.notify(f"❌ Consumer API error: {response.status_code}", type="negative")
+            return False
+        if count:
+            pagination["rowsNumber"] = int(response.headers.get("X-Total-Count", 0))
+            self._counted = True
+        else:
+            pagination["rowsNumber"] = self.total
+        self.table.rows = response.json()
+        self.table.pagination = pagination
+        self.table.update()
+        return True
+
+    def add_live(self, readings: list[dict[str, Any]]) -> None:
+        """New readings, shown when the first page of latest first is on screen."""
+        pagination = dict(self.table.pagination)
+        pagination["rowsNumber"] = self.total + len(readings)
+        if pagination.get("page", 1) == 1 and pagination.get("descending", True):
+            size = pagination.get("rowsPerPage") or PAGE_SIZES[-1]
+            # a batch is in stream order, the table latest first
+            self.table.rows = (readings[::-1] + self.table.rows)[:size]
+        self.table.pagination = pagination
+        self.table.update()
+
+    async def _on_request(self, e: GenericEventArguments) -> None:
+        await self.load(e.args["pagination"])
+
+
+class SeriesChart:
+    """Power over time, downsampled by the consumer to the chart width."""
+
+    def __init__(self, site_id: str) -> None:
+        self.site_id = site_id
+        self.chart = ui.echart(
+            {
+                "tooltip": {"trigger": "axis"},
+                "xAxis": {"type": "time"},
+                "yAxis": {"type": "value", "name": "Reading (kWh)"},
+                "series": [{"type": "line", "showSymbol": False, "data": []}],
+            }
+        ).classes("w-full h-64 mt-4")
+
+    async def load(self) -> None:
+        # one point per pixel, LTTB keeps the visual shape
+        width = await ui.run_javascript(f"getHtmlElement({self.chart.id}).clientWidth")
+        points = min(max(int(width or 0), MIN_SERIES_POINTS), MAX_SERIES_POINTS)
+        try:
+            response = await upstream.get_site(
+                self.site_id,
+                f"{CONSUMER_URL}/sites/{self.site_id}/series",
+                {"points": points},
+            )
+        except httpx.HTTPError as e:
+            ui.notify(f"📡 Connection to Consumer failed: {str(e)}", type="negative")
+            return
+        if not response.is_success:
+            ui.notify(f"❌ Consumer API error: {response.status_code}", type="negative")
+            return
+        series = response.json()
+        self.chart.options["series"][0]["data"] = [
+            [epoch * 1000, power]
+            for epoch, power in zip(series["epochs"], series["power"], strict=True)
+        ]
+        self.chart.update()
+
+
+async def fetch_readings(
+    site_id: str, container: ui.column, live: bool = False
+) -> HistoryTable | None:
+    """
+    Renders a page of the site readings and a chart of their history.
+    In live mode the table is rendered even without readings, to append to.
+    """
     if not site_id:
         ui.notify("Please enter a Site ID to search", type="warning")
-        return
+        return None
 
     # Phase 1: Show Loading State
     container.clear()
     with container:
-        ui.spinner(size="lg").classes("self-center mt-4")
+        spinner = ui.spinner(size="lg").classes("self-center mt-4")
+        history = HistoryTable(site_id)
+        history.table.set_visibility(False)
 
-    try:
-        response = await client.get(f"{CONSUMER_URL}/sites/{site_id}/readings")
+    # Phase 2: Render Data
+    if not await history.load():
+        container.clear()
+        return None
+    spinner.delete()
+    if not history.total and not live:
+        container.clear()
+        with container:
+            ui.label(f"No readings found for site '{site_id}'.").classes(
+                "text-gray-500 italic"
+            )
+        return None
+    history.table.set_visibility(True)
+    with container:
+        chart = SeriesChart(site_id)
+    await chart.load()
+    return history
 
-        if response.status_code != httpx.codes.OK:
-            ui.notify(f"❌ Consumer API error: {response.status_code}", type="negative")
-            container.clear()
-            return
 
-        data = response.json()
+async def iter_sse(response: httpx.Response) -> AsyncIterator[tuple[str, str]]:
+    """Yields (event, data) of a Server-Sent Events response."""
+    event, data = "message", ""
+    async for line in response.aiter_lines():
+        if not line:
+            if data:
+                yield event, data
+            event, data = "message", ""
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data += line[5:].strip()
+        # ":" comments are heartbeats, "retry:" is for browsers
 
-        # Phase 2: Render Data
-        container.clear()  # Removes the spinner
-        ui.notify(f"Consumer return code: {response.status_code}", type="positive")
-        with container:
-            if not data:
-                ui.label(f"No readings found for site '{site_id}'.").classes(
-                    "text-gray-500 italic"
-                )
-            else:
-                columns = [
-                    {
-                        "name": "timestamp",
-                        "label": "Timestamp",
-                        "field": "timestamp",
-                        "sortable": True,
-                    },
-                    {
-                        "name": "value",
-                        "label": "Reading (kWh)",
-                        "field": "power_reading",
-                        "sortable": True,
-                    },
-                    {
-                        "name": "device_id",
-                        "label": "Device id",
-                        "field": "device_id",
-                        "sortable": True,
-                    },
-                ]
-                ui.table(columns=columns, rows=data, pagination=10).classes(
-                    "w-full mt-4 shadow-sm"
-                )
 
-    except httpx.HTTPError as e:
-        ui.notify(f"📡 Connection to Consumer failed: {str(e)}", type="negative")
-        container.clear()
+async def follow_readings(site_id: str, history: HistoryTable) -> None:
+    """
+    Adds the readings the consumer stores for the site to the table,
+    O(new readings) per update instead of refetching the history.
+    Runs until cancelled, reconnects after errors.
+    """
+    url = f"{CONSUMER_URL}/sites/{site_id}/live"
+    timeout = httpx.Timeout(10.0, read=LIVE_READ_TIMEOUT_S)
+    while True:
+        try:
+            async with upstream.client.stream("GET", url, timeout=timeout) as response:
+                async for event, data in iter_sse(response):
+                    if event == "readings":
+                        history.add_live(json.loads(data))
+                    elif event == "resync":
+                        # updates were dropped, reload the page on screen
+                        with history.table:
+                            await history.load()
+        except httpx.HTTPError as e:
+            with history.table:
+                ui.notify(f"📡 Live updates interrupted: {str(e)}", type="warning")
+        await asyncio.sleep(LIVE_RETRY_S)
+
+
+class LiveFeed:
+    """The live updates task of one history view."""
+
+    def __init__(self) -> None:
+        self.task: asyncio.Task[None] | None = None
+
+    def start(self, site_id: str, history: HistoryTable) -> None:
+        self.stop()
+        self.task = background_tasks.create(
+            follow_readings(site_id, history), name=f"live {site_id}"
+        )
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+async def show_readings(
+    site_id: str, container: ui.column, live: bool, feed: LiveFeed
+) -> None:
+    """Renders the history of the site, then follows it in live mode."""
+    feed.stop()
+    history = await fetch_readings(site_id, container, live)
+    if live and history is not None:
+        feed.start(site_id, history)
+
+
+@app.get("/upstream")
+async def get_upstream_stats() -> dict[str, int | float]:
+    """Cache, coalescing and request counters of the backend client."""
+    return upstream.as_dict()
 
 
 # --- UI Definition ---
@@ -182,16 +422,24 @@ def init_ui() -> None:
                     with ui.column().classes("gap-4"):
                         ui.markdown("### Fetch Site Readings")
                         results = ui.column().classes("w-full mt-4")
+                        feed = LiveFeed()
                         with ui.row().classes("w-full items-center"):
                             search_id = (
                                 ui.input("Enter Site ID", value="site-001")
                                 .props("outlined dense")
                                 .classes("grow")
                             )
+                            # appends new readings as the consumer stores them
+                            live = ui.switch(
+                                "Live",
+                                on_change=lambda e: show_readings(
+                                    search_id.value, results, e.value, feed
+                                ),
+                            )
                             ui.button(
                                 "Fetch",
-                                on_click=lambda: fetch_readings(
-                                    search_id.value, results
+                                on_click=lambda: show_readings(
+                                    search_id.value, results, live.value, feed
                                 ),
                                 icon="search",
                             ).classes("px-6")
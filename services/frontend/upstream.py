@@ -0,0 +1,147 @@
+"""
+Pooled HTTP client of the backend APIs, shared by every dashboard session.
+
+The client is opened and closed with the app (see main), its connections are
+kept alive between requests. Reads of a site go through `get_site`:
+- identical requests in flight are coalesced (single-flight), the first caller
+  sends the request and the others await its response
+- successful responses are kept for `ttl_s` seconds, keyed by site and request
+- `invalidate` bumps the generation of a site: requests sent before it are not
+  joined anymore and their responses are not cached
+
+A popular site costs one upstream call per refresh window, whatever the number
+of viewers.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+
+# (url, sorted params) of a GET
+RequestKey = tuple[str, tuple[tuple[str, str], ...]]
+# (site_id, request)
+EntryKey = tuple[str, RequestKey]
+# (expires_at, response)
+CacheEntry = tuple[float, httpx.Response]
+
+
+@dataclass
+class UpstreamStats:
+    requests: int = 0  # sent upstream
+    hits: int = 0  # served from the cache
+    coalesced: int = 0  # joined a request in flight
+    evictions: int = 0  # dropped by the size bound
+
+
+class UpstreamClient:
+    """Backend client of the process, responses cached per site."""
+
+    def __init__(
+        self,
+        limits: httpx.Limits,
+        timeout: float,
+        ttl_s: float,
+        max_entries: int,
+    ) -> None:
+        self.limits = limits
+        self.timeout = timeout
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.stats = UpstreamStats()
+        self._client: httpx.AsyncClient | None = None
+        self._cache: OrderedDict[EntryKey, CacheEntry] = OrderedDict()
+        # requests in flight by entry and site generation
+        self._inflight: dict[tuple[EntryKey, int], asyncio.Task[httpx.Response]] = {}
+        self._generations: dict[str, int] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("upstream client is not started")
+        return self._client
+
+    def start(self, transport: httpx.AsyncBaseTransport | None = None) -> None:
+        self._client = httpx.AsyncClient(
+            limits=self.limits, timeout=self.timeout, transport=transport
+        )
+
+    async def stop(self) -> None:
+        for task in self._inflight.values():
+            task.cancel()
+        self._inflight.clear()
+        self._cache.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get_site(
+        self, site_id: str, url: str, params: dict[str, Any] | None = None
+    ) -> httpx.Response:
+        """GET of a site resource, coalesced and cached. Raises httpx.HTTPError."""
+        key: RequestKey = (
+            url,
+            tuple(sorted((k, str(v)) for k, v in (params or {}).items())),
+        )
+        entry_key = (site_id, key)
+        cached = self._cache.get(entry_key)
+        if cached is not None:
+            if cached[0] >= time.monotonic():
+                self._cache.move_to_end(entry_key)
+                self.stats.hits += 1
+                return cached[1]
+            del self._cache[entry_key]
+
+        generation = self._generations.get(site_id, 0)
+        flight_key = (entry_key, generation)
+        task = self._inflight.get(flight_key)
+        if task is not None:
+            self.stats.coalesced += 1
+        else:
+            task = asyncio.create_task(self._fetch(entry_key, generation))
+            self._inflight[flight_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(flight_key, None))
+        # a caller going away must not cancel the request of the others
+        return await asyncio.shield(task)
+
+    def invalidate(self, site_id: str) -> None:
+        """
+        Drops the cached responses of a site, called after writing to it.
+        Responses of the requests in flight are not cached.
+        """
+        self._generations[site_id] = self._generations.get(site_id, 0) + 1
+        for entry_key in [k for k in self._cache if k[0] == site_id]:
+            del self._cache[entry_key]
+
+    def as_dict(self) -> dict[str, int | float]:
+        return {
+            "size": len(self._cache),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "in_flight": len(self._inflight),
+            "requests": self.stats.requests,
+            "hits": self.stats.hits,
+            "coalesced": self.stats.coalesced,
+            "evictions": self.stats.evictions,
+        }
+
+    async def _fetch(self, entry_key: EntryKey, generation: int) -> httpx.Response:
+        site_id, (url, params) = entry_key
+        self.stats.requests += 1
+        response = await self.client.get(url, params=dict(params))
+        if (
+            response.is_success
+            and self.ttl_s > 0
+            and self.max_entries > 0
+            # the site was written while the request was in flight
+            and self._generations.get(site_id, 0) == generation
+        ):
+            self._cache[entry_key] = (time.monotonic() + self.ttl_s, response)
+            self._cache.move_to_end(entry_key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+                self.stats.evictions += 1
+        return response
@@ -0,0 +1,66 @@
+"""
+Admission control of the producer, based on the backlog of the consumer group.
+
+The backlog is the group lag (entries not yet delivered to any consumer) summed
+over the stream partitions, read with XINFO GROUPS at most once per probe
+interval and shared by all requests in between, so admission costs no Redis
+call per request.
+When Redis cannot compute the lag (e.g. after trimming) or the group does not
+exist yet, the stream length is used instead, an upper bound of the lag.
+"""
+
+import time
+from typing import Any
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError, ResponseError
+
+from shared_lib.logger import logger
+from shared_lib.metrics import redis_timer
+
+
+class AdmissionControl:
+    """Rejects writes while the backlog is at or above `high_water` (0: off)."""
+
+    def __init__(self, high_water: int, probe_interval_s: float) -> None:
+        self.high_water = high_water
+        self.probe_interval_s = probe_interval_s
+        self.backlog = 0
+        self._next_probe = 0.0
+
+    def reset(self) -> None:
+        self.backlog = 0
+        self._next_probe = 0.0
+
+    async def admit(self, r: redis.Redis, streams: list[str], group: str) -> bool:
+        if self.high_water <= 0:
+            return True
+        now = time.monotonic()
+        if now >= self._next_probe:
+            # set before awaiting, concurrent requests keep the cached value
+            self._next_probe = now + self.probe_interval_s
+            try:
+                backlog = 0
+                for stream in streams:
+                    backlog += await self.probe(r, stream, group)
+                self.backlog = backlog
+            except RedisError as e:
+                # fail open, the XADD reports an unavailable Redis on its own
+                logger.error("Admission probe of %s failed: %s", streams, e)
+        return self.backlog < self.high_water
+
+    @staticmethod
+    async def probe(r: redis.Redis, stream: str, group: str) -> int:
+        try:
+            with redis_timer("xinfo_groups"):
+                groups: list[dict[str, Any]] = await r.xinfo_groups(stream)
+        except ResponseError as e:
+            if "no such key" in str(e).lower():
+                return 0  # nothing was written yet
+            raise
+        for info in groups:
+            if info["name"] == group and info.get("lag") is not None:
+                return int(info["lag"])
+        with redis_timer("xlen"):
+            length: int = await r.xlen(stream)
+        return length
@@ -1,58 +1,496 @@
-from collections.abc import AsyncGenerator
+import asyncio
+import contextlib
+import json
+import os
+import time
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable
 from contextlib import asynccontextmanager
-from typing import Any
+from pathlib import Path
+from typing import Any, cast
 
 import redis.asyncio as redis
-from fastapi import FastAPI, HTTPException, Request, status
+from fastapi import APIRouter, FastAPI, HTTPException, Request, Response, status
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge
+from pydantic import ValidationError
 from redis import RedisError
 
-from shared_lib.config import REDIS_URL, STREAM_NAME
+from services.producer.admission import AdmissionControl
+from services.producer.spool import Spool, SpoolFullError, SpoolRecord
+from shared_lib.config import CONSUMER_GROUP, STREAM_FORMAT
 from shared_lib.logger import logger
+from shared_lib.metrics import (
+    VALIDATION_SECONDS,
+    latest_metrics,
+    mark_process_dead,
+    redis_timer,
+)
 from shared_lib.model import (
     HEALTH_CHECK_DICT,
+    BatchItemOutput,
+    BatchReadingOutput,
     ReadingInput,
     ReadingOutput,
     ReadingStatus,
+    batch_now,
+)
+from shared_lib.partitions import site_stream, stream_keys
+from shared_lib.redis_client import create_redis
+from shared_lib.stream import to_stream_entry
+
+# Upper bound of items accepted by a single /readings/batch request
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 10000))
+# Upper bounds of a /readings/batch body and of one of its NDJSON lines, in
+# bytes, checked while the body streams in
+MAX_BATCH_BYTES = int(os.getenv("MAX_BATCH_BYTES", 8 << 20))
+MAX_LINE_BYTES = int(os.getenv("MAX_LINE_BYTES", 64 << 10))
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/jsonl")
+# Writes get 503 while the consumer group lag is at or above this, 0 disables it
+MAX_STREAM_LAG = int(os.getenv("MAX_STREAM_LAG", 100000))
+# Seconds the lag probe (XINFO GROUPS) is cached between requests
+ADMISSION_PROBE_INTERVAL_S = float(os.getenv("ADMISSION_PROBE_INTERVAL_S", 1))
+# Retry-After sent with the 503
+RETRY_AFTER_S = int(os.getenv("RETRY_AFTER_S", 1))
+# Approximate XADD MAXLEN, 0 disables trimming. Trimming drops entries not yet
+# consumed, keep it well above MAX_STREAM_LAG as a last resort memory bound
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", 0))
+XADD_TRIM: dict[str, Any] = (
+    {"maxlen": STREAM_MAXLEN, "approximate": True} if STREAM_MAXLEN > 0 else {}
+)
+THROTTLED = "throttled"
+
+# Directory of the local spool used while Redis is unavailable, empty disables it
+SPOOL_DIR = os.getenv("SPOOL_DIR", "")
+# Bytes on disk after which the spool refuses readings (500 as without spool)
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", 1 << 30))
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", 16 << 20))
+# fsync every append, a crash of the host then loses no acknowledged reading
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "true").lower() == "true"
+# Entries per flush transaction and the wait while the spool is empty or
+# Redis is still unavailable
+SPOOL_FLUSH_BATCH = int(os.getenv("SPOOL_FLUSH_BATCH", 500))
+SPOOL_FLUSH_INTERVAL_S = float(os.getenv("SPOOL_FLUSH_INTERVAL_S", 1))
+# Wait on shutdown for a spool flush in progress to commit its position
+SPOOL_DRAIN_TIMEOUT_S = float(os.getenv("SPOOL_DRAIN_TIMEOUT_S", 5))
+
+# Connections opened before the worker takes requests, and how long to try
+REDIS_WARM_CONNECTIONS = int(os.getenv("REDIS_WARM_CONNECTIONS", 10))
+REDIS_WARM_TIMEOUT_S = float(os.getenv("REDIS_WARM_TIMEOUT_S", 10))
+
+READINGS = Counter(
+    "producer_readings_total", "Readings handled by the producer", ["status"]
+)
+# multiprocess_mode: how the values of worker processes are combined (see
+# shared_lib.metrics), ignored with a single process
+STREAM_BACKLOG = Gauge(
+    "producer_stream_backlog",
+    "Consumer group lag seen by admission control",
+    multiprocess_mode="livemax",
+)
+SPOOL_DEPTH = Gauge(
+    "producer_spool_depth",
+    "Readings waiting in the local spool",
+    multiprocess_mode="livesum",
+)
+SPOOL_AGE = Gauge(
+    "producer_spool_age_seconds",
+    "Age of the oldest reading in the local spool",
+    multiprocess_mode="livemax",
+)
+SPOOL_BYTES = Gauge(
+    "producer_spool_bytes",
+    "Size of the local spool on disk",
+    multiprocess_mode="livesum",
+)
+SPOOL_FLUSHED = Counter(
+    "producer_spool_flushed_total", "Spooled readings written to Redis"
 )
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[Any, None]:
-    # 1. CONFIGURATION: This runs ONCE when the process starts.
-    # We create the connection pool here.
-    # add # type: ignore[no-untyped-call] to the specific line
-    async with redis.from_url(REDIS_URL, decode_responses=True) as r:  # type: ignore[no-untyped-call]
+    # 1. CONFIGURATION: This runs ONCE when the process starts, in every worker.
+    # Each worker owns its connection pool, nothing is shared between workers.
+    async with create_redis() as r:
         app.state.redis = r
-        # The app "pauses" here and handles all incoming requests
-        yield
+        # uvicorn hands requests to the worker once this returns, so the
+        # first requests do not pay for the connection handshakes
+        await warm_pool(r, REDIS_WARM_CONNECTIONS)
+        try:
+            if spool is None:
+                # The app "pauses" here and handles all incoming requests
+                yield
+                return
+
+            # replays what a previous process left in the spool slot
+            spool.open()
+            update_spool_gauges()
+            logger.info(
+                "Spool %s opened with %d readings", spool.directory, spool.depth
+            )
+            stopping = asyncio.Event()
+            flush_task = asyncio.create_task(flush_spool(app, spool, stopping))
+            try:
+                yield
+            finally:
+                # in-flight requests are done, let a flush in progress commit
+                stopping.set()
+                try:
+                    await asyncio.wait_for(flush_task, SPOOL_DRAIN_TIMEOUT_S)
+                except TimeoutError:
+                    logger.warning("Spool flush did not stop, it is replayed")
+                spool.close()
+        finally:
+            mark_process_dead()
+
+
+router = APIRouter()
+admission = AdmissionControl(MAX_STREAM_LAG, ADMISSION_PROBE_INTERVAL_S)
+spool: Spool | None = (
+    Spool(Path(SPOOL_DIR), SPOOL_SEGMENT_BYTES, SPOOL_MAX_BYTES, SPOOL_FSYNC)
+    if SPOOL_DIR
+    else None
+)
+# Appends run in a thread (write and fsync), one at a time and in arrival
+# order; peek and commit of the flush take it too
+spool_lock = asyncio.Lock()
+
+
+async def warm_pool(r: redis.Redis, connections: int) -> None:
+    """Opens `connections` pooled connections, one PING each in parallel."""
+    try:
+        async with asyncio.timeout(REDIS_WARM_TIMEOUT_S):
+            pings = [cast(Awaitable[bool], r.ping()) for _ in range(connections)]
+            await asyncio.gather(*pings)
+    except (RedisError, TimeoutError) as e:
+        # not fatal: connections open on demand, the spool covers an outage
+        logger.warning("Redis pool not warmed: %s", e)
+        return
+    logger.info("Redis pool warmed with %d connections", connections)
+
+
+async def check_admission(r: redis.Redis, client_ip: str, readings: int) -> None:
+    """Raises 503 with Retry-After while the consumers are too far behind."""
+    admitted = await admission.admit(r, stream_keys(), CONSUMER_GROUP)
+    STREAM_BACKLOG.set(admission.backlog)
+    if admitted:
+        return
+    READINGS.labels(THROTTLED).inc(readings)
+    logger.warning(
+        "%s: throttled %d readings, backlog %d >= %d",
+        client_ip,
+        readings,
+        admission.backlog,
+        MAX_STREAM_LAG,
+    )
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Consumers are behind, retry later",
+        headers={"Retry-After": str(RETRY_AFTER_S)},
+    )
+
+
+def spool_pending() -> bool:
+    """Whether readings wait in the spool or are being appended to it."""
+    return spool is not None and (spool.depth > 0 or spool_lock.locked())
+
+
+async def spool_entries(
+    client_ip: str, entries: list[tuple[str, dict[str, Any]]]
+) -> None:
+    """Appends stream entries to the spool, 500 if it cannot take them."""
+    if spool is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    now = time.time()
+    records = [SpoolRecord(stream, entry, now) for stream, entry in entries]
+    try:
+        async with spool_lock:
+            await asyncio.to_thread(spool.append, records)
+    except (SpoolFullError, OSError) as e:
+        logger.exception("%s: could not spool %d readings", client_ip, len(entries))
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR) from e
+    READINGS.labels(ReadingStatus.SPOOLED).inc(len(entries))
+    update_spool_gauges()
+
+
+def update_spool_gauges() -> None:
+    # set on spool changes and flush rounds, values are per worker
+    if spool is not None:
+        SPOOL_DEPTH.set(spool.depth)
+        SPOOL_BYTES.set(spool.size)
+        SPOOL_AGE.set(spool.age())
+
 
+async def flush_spool(app: FastAPI, spool: Spool, stopping: asyncio.Event) -> None:
+    """
+    Background task writing spooled readings to Redis, oldest first.
+    Stops between two batches once `stopping` is set.
+    """
+    while not stopping.is_set():
+        try:
+            flushed = await flush_spool_batch(app.state.redis, spool)
+        except RedisError as e:
+            logger.warning("Spool flush failed, %d readings wait: %s", spool.depth, e)
+            flushed = 0
+        update_spool_gauges()
+        if not flushed:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(stopping.wait(), SPOOL_FLUSH_INTERVAL_S)
 
-# This run on import, it is better to place this in a closure
-app = FastAPI(lifespan=lifespan)
 
+async def flush_spool_batch(r: redis.Redis, spool: Spool) -> int:
+    """Writes up to SPOOL_FLUSH_BATCH spooled readings in one transaction."""
+    async with spool_lock:
+        records, position = spool.peek(SPOOL_FLUSH_BATCH)
+    if not records:
+        return 0
+    async with r.pipeline(transaction=True) as pipe:
+        for record in records:
+            pipe.xadd(record.stream, record.entry, **XADD_TRIM)
+        with redis_timer("spool_flush"):
+            await pipe.execute()
+    async with spool_lock:
+        spool.commit(position, len(records))
+    SPOOL_FLUSHED.inc(len(records))
+    logger.info("Flushed %d spooled readings, %d left", len(records), spool.depth)
+    return len(records)
 
-@app.post(
+
+@router.post(
     "/readings", response_model=ReadingOutput, status_code=status.HTTP_201_CREATED
 )
-async def create_reading(reading: ReadingInput, request: Request) -> ReadingOutput:
+async def create_reading(
+    reading: ReadingInput, request: Request, response: Response
+) -> ReadingOutput:
+    """
+    Publishes a reading, 201 with its stream id.
+    While Redis is unavailable, or older readings wait in the spool, it is
+    spooled instead: 202 without stream id (requires SPOOL_DIR).
+    """
     client_ip = request.client.host if request.client else "unknown"
     logger.debug("%s: Received new reading: %s", client_ip, reading)
+    r = request.app.state.redis
+    await check_admission(r, client_ip, 1)
+    stream = site_stream(reading.site_id)
+    entry = to_stream_entry(reading, STREAM_FORMAT)
+    if spool_pending():
+        # behind the spooled readings, so a site keeps its order
+        await spool_entries(client_ip, [(stream, entry)])
+        response.status_code = status.HTTP_202_ACCEPTED
+        return ReadingOutput(status=ReadingStatus.SPOOLED)
     try:
-        stream_id = await app.state.redis.xadd(STREAM_NAME, reading.model_dump())
+        with redis_timer("xadd"):
+            stream_id = await r.xadd(stream, entry, **XADD_TRIM)
     except RedisError as e:
-        logger.exception("%s: Redis error occurred for %s", client_ip, reading)
-        # 'from e' links the Redis error to the HTTP error in the traceback
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR) from e
+        if spool is None:
+            logger.exception("%s: Redis error occurred for %s", client_ip, reading)
+            # 'from e' links the Redis error to the HTTP error in the traceback
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
+            ) from e
+        logger.warning("%s: Redis error, spooling %s: %s", client_ip, reading, e)
+        await spool_entries(client_ip, [(stream, entry)])
+        response.status_code = status.HTTP_202_ACCEPTED
+        return ReadingOutput(status=ReadingStatus.SPOOLED)
     logger.debug("%s generated stream id for %s , %s", client_ip, reading, stream_id)
+    READINGS.labels(ReadingStatus.ACCEPTED).inc()
     return ReadingOutput(
         status=ReadingStatus.ACCEPTED,
         stream_id=stream_id,
     )
 
 
-@app.get("/health")
+async def _read_batch_items(request: Request) -> list[Any]:
+    """
+    Returns the raw items of a batch body, either a JSON list or NDJSON.
+    The body is rejected as soon as it exceeds MAX_BATCH_BYTES, an NDJSON line
+    MAX_LINE_BYTES, or the NDJSON lines MAX_BATCH_SIZE, before the rest of it
+    is read.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(NDJSON_CONTENT_TYPES):
+        items: list[Any] = []
+        buffer = b""
+        # parse line by line while the body streams in
+        async for chunk in _limited_stream(request):
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            if len(buffer) > MAX_LINE_BYTES or any(
+                len(line) > MAX_LINE_BYTES for line in lines
+            ):
+                raise HTTPException(
+                    status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                    detail=f"NDJSON line exceeds limit of {MAX_LINE_BYTES} bytes",
+                )
+            items.extend(_parse_ndjson_line(line) for line in lines if line.strip())
+            if len(items) > MAX_BATCH_SIZE:
+                raise _batch_too_large(len(items))
+        if buffer.strip():
+            items.append(_parse_ndjson_line(buffer))
+        return items
+
+    data = b"".join([chunk async for chunk in _limited_stream(request)])
+    try:
+        body = json.loads(data)
+    except json.JSONDecodeError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid JSON: {e}"
+        ) from e
+    if not isinstance(body, list):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail="Batch body must be a JSON list of readings",
+        )
+    return body
+
+
+async def _limited_stream(request: Request) -> AsyncIterator[bytes]:
+    """The body chunks, 413 once they add up to more than MAX_BATCH_BYTES."""
+    too_large = HTTPException(
+        status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+        detail=f"Batch body exceeds limit of {MAX_BATCH_BYTES} bytes",
+    )
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > MAX_BATCH_BYTES:
+        raise too_large
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > MAX_BATCH_BYTES:
+            raise too_large
+        yield chunk
+
+
+def _batch_too_large(size: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+        detail=f"Batch size {size} exceeds limit of {MAX_BATCH_SIZE}",
+    )
+
+
+def _parse_ndjson_line(line: bytes) -> Any:  # noqa: ANN401
+    """A malformed line is kept as an exception so it is reported per item."""
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        return e
+
+
+def _validate_batch_item(item: Any) -> ReadingInput | list[dict[str, Any]]:  # noqa: ANN401
+    """Returns the parsed reading, or the list of errors explaining the rejection."""
+    if isinstance(item, json.JSONDecodeError):
+        return [{"type": "json_invalid", "msg": f"Invalid JSON: {item}"}]
+    try:
+        return ReadingInput.model_validate(item)
+    except ValidationError as e:
+        # e.json() makes the error context (e.g. the raised ValueError) serializable
+        errors: list[dict[str, Any]] = json.loads(e.json(include_url=False))
+        return errors
+
+
+@router.post("/readings/batch", response_model=BatchReadingOutput)
+async def create_readings_batch(request: Request) -> BatchReadingOutput:
+    """
+    Accepts a JSON list or an NDJSON body of readings.
+    Every item is validated on its own, valid items are written to the stream
+    in a single MULTI/EXEC pipeline, the response reports each item by index.
+    Valid items are spooled like single readings while Redis is unavailable.
+    """
+    client_ip = request.client.host if request.client else "unknown"
+    items = await _read_batch_items(request)
+    if len(items) > MAX_BATCH_SIZE:
+        raise _batch_too_large(len(items))
+    logger.debug("%s: Received batch of %d readings", client_ip, len(items))
+    r = request.app.state.redis
+    await check_admission(r, client_ip, len(items))
+
+    valid: list[tuple[int, ReadingInput]] = []
+    results: dict[int, BatchItemOutput] = {}
+    # one "now" for the whole batch instead of one per reading
+    with VALIDATION_SECONDS.time(), batch_now():
+        for index, item in enumerate(items):
+            parsed = _validate_batch_item(item)
+            if isinstance(parsed, ReadingInput):
+                valid.append((index, parsed))
+            else:
+                results[index] = BatchItemOutput(
+                    index=index, status=ReadingStatus.REJECTED, errors=parsed
+                )
+
+    entries = [
+        (site_stream(reading.site_id), to_stream_entry(reading, STREAM_FORMAT))
+        for _index, reading in valid
+    ]
+    stream_ids: list[str | None] = []
+    if entries and spool_pending():
+        await spool_entries(client_ip, entries)
+        stream_ids = [None] * len(entries)
+    elif entries:
+        try:
+            async with r.pipeline(transaction=True) as pipe:
+                for stream, entry in entries:
+                    pipe.xadd(stream, entry, **XADD_TRIM)
+                with redis_timer("xadd_batch"):
+                    stream_ids = await pipe.execute()
+        except RedisError as e:
+            if spool is None:
+                logger.exception(
+                    "%s: Redis error occurred for batch of %d", client_ip, len(valid)
+                )
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
+                ) from e
+            logger.warning("%s: Redis error, spooling batch: %s", client_ip, e)
+            await spool_entries(client_ip, entries)
+            stream_ids = [None] * len(entries)
+        else:
+            READINGS.labels(ReadingStatus.ACCEPTED).inc(len(valid))
+    for (index, _reading), stream_id in zip(valid, stream_ids, strict=True):
+        results[index] = BatchItemOutput(
+            index=index,
+            status=ReadingStatus.ACCEPTED if stream_id else ReadingStatus.SPOOLED,
+            stream_id=stream_id,
+        )
+
+    READINGS.labels(ReadingStatus.REJECTED).inc(len(items) - len(valid))
+    logger.debug(
+        "%s: batch accepted %d, rejected %d",
+        client_ip,
+        len(valid),
+        len(items) - len(valid),
+    )
+    return BatchReadingOutput(
+        accepted=len(valid),
+        rejected=len(items) - len(valid),
+        results=[results[index] for index in range(len(items))],
+    )
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    """Prometheus metrics in the text exposition format."""
+    return Response(latest_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
+@router.get("/health")
 async def health_check(request: Request) -> dict[str, str]:
     """Returns 200 if the service is alive."""
     client_ip = request.client.host if request.client else "unknown"
     logger.debug("%s: health check", client_ip)
     return HEALTH_CHECK_DICT
+
+
+def create_app() -> FastAPI:
+    """
+    The producer application, `uvicorn --factory services.producer.main:create_app`.
+    """
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str) -> Any:  # noqa: ANN401
+    # `services.producer.main:app`, built on first access
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,55 @@
+"""
+Entry point of the producer container: uvicorn with PRODUCER_WORKERS processes.
+
+Validation and JSON handling are CPU bound, one process uses one core. Workers
+share nothing but the listening socket: each one owns its Redis pool, spool
+slot and admission probe (see main). With more than one worker the metrics of
+all of them are aggregated through PROMETHEUS_MULTIPROC_DIR, emptied here
+before the workers start.
+
+run from project root: `python -m services.producer.serve`
+"""
+
+import os
+import shutil
+from pathlib import Path
+
+import uvicorn
+
+# Worker processes, up to the CPU cores of the pod
+PRODUCER_WORKERS = int(os.getenv("PRODUCER_WORKERS", 1))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 8000))
+# Seconds in-flight requests get to finish after SIGTERM, keep it below the
+# terminationGracePeriodSeconds of the pod
+SHUTDOWN_TIMEOUT_S = int(os.getenv("SHUTDOWN_TIMEOUT_S", 20))
+# read by prometheus_client in every worker (see shared_lib.metrics), not
+# imported here so the supervisor process stays small
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+METRICS_DIR = "/tmp/producer-metrics"
+
+
+def prepare_metrics_dir(workers: int) -> None:
+    """Points the workers at an empty multiprocess metrics directory."""
+    if workers <= 1:
+        return
+    directory = Path(os.environ.setdefault(MULTIPROC_DIR_ENV, METRICS_DIR))
+    # samples of a previous run would be added to the new ones
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True)
+
+
+def main() -> None:
+    prepare_metrics_dir(PRODUCER_WORKERS)
+    uvicorn.run(
+        "services.producer.main:create_app",
+        factory=True,
+        host=HOST,
+        port=PORT,
+        workers=PRODUCER_WORKERS,
+        timeout_graceful_shutdown=SHUTDOWN_TIMEOUT_S,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Local write-ahead spool of the producer, bridges Redis outages.
+
+Stream entries that could not be written to Redis are appended to segment files
+`{directory}/{seq:012d}.log`, one JSON record per line, and acknowledged to the
+client. A background task flushes them to Redis in order, in batches, and
+records the flushed position in `{directory}/checkpoint`; fully flushed
+segments are deleted. On restart the spool resumes from the checkpoint.
+
+Delivery is at-least-once: a crash between a flushed batch and its checkpoint
+writes that batch again.
+
+Worker processes of one producer share the directory through slots: a process
+opens the first slot no other process holds, `{directory}` itself then
+`{directory}/1`, `{directory}/2`.., locked (flock) while open. A restarted
+worker takes a free slot over and replays what it holds. Slots still free after
+that (the producer restarted with fewer workers) are merged into the opened
+slot: their unflushed records are appended to it and their files deleted, a
+crash in between replays them twice.
+"""
+
+import fcntl
+import json
+import os
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO
+
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT_FILE = "checkpoint"
+LOCK_FILE = "lock"
+# Records per append while merging a free slot
+MERGE_BATCH = 1000
+
+
+class SpoolFullError(Exception):
+    """The spool reached its size limit, the record was not written."""
+
+
+@dataclass(frozen=True, order=True)
+class SpoolPosition:
+    segment: int
+    offset: int  # bytes into the segment
+
+
+@dataclass(frozen=True)
+class SpoolRecord:
+    stream: str
+    entry: dict[Any, Any]  # stream fields
+    spooled_at: float  # epoch seconds
+
+
+class Spool:
+    """
+    Append-only segment log, not thread-safe: the producer runs appends in a
+    worker thread and serializes them with peek and commit.
+    `directory` is the slot opened by the process once open.
+    """
+
+    def __init__(
+        self, directory: Path, segment_bytes: int, max_bytes: int, fsync: bool
+    ) -> None:
+        self.directory = directory
+        self._base = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.depth = 0  # records not flushed yet
+        self.size = 0  # bytes of the segments on disk
+        self.oldest_spooled_at: float | None = None
+        self._committed = SpoolPosition(0, 0)
+        self._segment = 0
+        self._file: BinaryIO | None = None
+        self._lock: BinaryIO | None = None
+
+    def open(self) -> None:
+        """
+        Claims the first free slot and resumes from its checkpoint, dropping a
+        torn last record, then merges the other free slots into it.
+        """
+        self.directory = self._claim_slot()
+        self._committed = self._read_checkpoint()
+        segments = self._segments()
+        if segments:
+            last = self._path(segments[-1])
+            data = last.read_bytes()
+            if data and not data.endswith(b"\n"):
+                # the process died in the middle of an append
+                with last.open("r+b") as f:
+                    f.truncate(data.rfind(b"\n") + 1)
+            self._segment = segments[-1]
+        else:
+            self._segment = max(self._committed.segment, 0)
+        self.size = sum(self._path(s).stat().st_size for s in segments)
+        self.depth = sum(1 for _ in self._iter_from(self._committed))
+        self._refresh_oldest()
+        self._file = self._path(self._segment).open("ab")
+        self._merge_free_slots()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock is not None:
+            # closing the file releases the flock
+            self._lock.close()
+            self._lock = None
+
+    def append(self, records: list[SpoolRecord]) -> None:
+        """Writes the records in one write (and fsync), all or none."""
+        data = _encode(records)
+        if self.size + len(data) > self.max_bytes:
+            raise SpoolFullError(f"spool {self.directory} holds {self.size} bytes")
+        self._write(data, records)
+
+    def _write(self, data: bytes, records: list[SpoolRecord]) -> None:
+        if self._writer().tell() >= self.segment_bytes:
+            self._rotate()
+        writer = self._writer()
+        writer.write(data)
+        writer.flush()
+        if self.fsync:
+            os.fsync(writer.fileno())
+        self.size += len(data)
+        self.depth += len(records)
+        if self.oldest_spooled_at is None and records:
+            self.oldest_spooled_at = records[0].spooled_at
+
+    def peek(self, limit: int) -> tuple[list[SpoolRecord], SpoolPosition]:
+        """The oldest `limit` records and the position after the last of them."""
+        records: list[SpoolRecord] = []
+        position = self._committed
+        for record, end in self._iter_from(self._committed):
+            if len(records) >= limit:
+                break
+            records.append(record)
+            position = end
+        return records, position
+
+    def commit(self, position: SpoolPosition, records: int) -> None:
+        """Marks everything before `position` as flushed to Redis."""
+        tmp = self.directory / f"{CHECKPOINT_FILE}.tmp"
+        tmp.write_text(f"{position.segment} {position.offset}")
+        os.replace(tmp, self.directory / CHECKPOINT_FILE)
+        self._committed = position
+        self.depth -= records
+        for segment in self._segments():
+            if segment < position.segment:
+                path = self._path(segment)
+                self.size -= path.stat().st_size
+                path.unlink()
+        self._refresh_oldest()
+
+    def age(self) -> float:
+        """Seconds the oldest unflushed record is waiting, 0 when empty."""
+        if self.oldest_spooled_at is None:
+            return 0.0
+        return max(time.time() - self.oldest_spooled_at, 0.0)
+
+    def _claim_slot(self) -> Path:
+        slot = 0
+        while True:
+            directory = self._base / str(slot) if slot else self._base
+            directory.mkdir(parents=True, exist_ok=True)
+            lock = _try_lock(directory)
+            if lock is None:
+                slot += 1  # held by another worker
+                continue
+            self._lock = lock
+            return directory
+
+    def _merge_free_slots(self) -> None:
+        """
+        Appends the unflushed records of every slot no process holds to this
+        one and empties it. Ordering across slots is not kept, as between
+        workers.
+        """
+        slots = [self._base] + sorted(
+            (p for p in self._base.iterdir() if p.is_dir() and p.name.isdigit()),
+            key=lambda p: int(p.name),
+        )
+        for directory in slots:
+            if directory == self.directory:
+                continue
+            lock = _try_lock(directory)
+            if lock is None:
+                continue
+            try:
+                free = Spool(directory, self.segment_bytes, self.max_bytes, False)
+                free._committed = free._read_checkpoint()
+                batch: list[SpoolRecord] = []
+                for record, _end in free._iter_from(free._committed):
+                    batch.append(record)
+                    if len(batch) >= MERGE_BATCH:
+                        self._write(_encode(batch), batch)
+                        batch = []
+                if batch:
+                    self._write(_encode(batch), batch)
+                # merged (and fsynced) before the source is deleted
+                for segment in free._segments():
+                    free._path(segment).unlink()
+                (directory / CHECKPOINT_FILE).unlink(missing_ok=True)
+            finally:
+                lock.close()
+
+    def _read_checkpoint(self) -> SpoolPosition:
+        checkpoint = self.directory / CHECKPOINT_FILE
+        if not checkpoint.exists():
+            return SpoolPosition(0, 0)
+        segment, offset = checkpoint.read_text().split()
+        return SpoolPosition(int(segment), int(offset))
+
+    def _writer(self) -> BinaryIO:
+        if self._file is None:
+            raise RuntimeError(f"spool {self.directory} is not open")
+        return self._file
+
+    def _rotate(self) -> None:
+        self._writer().close()
+        self._segment += 1
+        self._file = self._path(self._segment).open("ab")
+
+    def _refresh_oldest(self) -> None:
+        records, _position = self.peek(1)
+        self.oldest_spooled_at = records[0].spooled_at if records else None
+
+    def _iter_from(
+        self, start: SpoolPosition
+    ) -> Iterator[tuple[SpoolRecord, SpoolPosition]]:
+        """Yields (record, position after it) from `start` to the end."""
+        for segment in self._segments():
+            if segment < start.segment:
+                continue
+            offset = start.offset if segment == start.segment else 0
+            with self._path(segment).open("rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # being written
+                    offset += len(line)
+                    raw = json.loads(line)
+                    record = SpoolRecord(raw["s"], raw["e"], raw["t"])
+                    yield record, SpoolPosition(segment, offset)
+
+    def _segments(self) -> list[int]:
+        return sorted(
+            int(path.stem)
+            for path in self.directory.glob(f"*{SEGMENT_SUFFIX}")
+            if path.stem.isdigit()
+        )
+
+    def _path(self, segment: int) -> Path:
+        return self.directory / f"{segment:012d}{SEGMENT_SUFFIX}"
+
+
+def _encode(records: list[SpoolRecord]) -> bytes:
+    return b"".join(
+        json.dumps(
+            {"s": record.stream, "e": record.entry, "t": record.spooled_at}
+        ).encode()
+        + b"\n"
+        for record in records
+    )
+
+
+def _try_lock(directory: Path) -> BinaryIO | None:
+    """The locked lock file of a slot, None while another process holds it."""
+    lock = (directory / LOCK_FILE).open("ab")
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
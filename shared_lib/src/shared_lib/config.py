@@ -1,7 +1,34 @@
 import os
 
+from shared_lib.stream import StreamFormat
+
 REDIS_HOST = os.getenv("REDIS_HOST", "redis-service")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}"
+# Connections per process, callers wait REDIS_POOL_TIMEOUT_S for a free one
+# instead of opening more (see shared_lib.redis_client)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT_S = float(os.getenv("REDIS_POOL_TIMEOUT_S", 5))
+REDIS_CONNECT_TIMEOUT_S = float(os.getenv("REDIS_CONNECT_TIMEOUT_S", 2))
+# Seconds to wait for a reply, above the BLOCK of blocking reads
+REDIS_SOCKET_TIMEOUT_S = float(os.getenv("REDIS_SOCKET_TIMEOUT_S", 10))
+REDIS_SOCKET_KEEPALIVE = os.getenv("REDIS_SOCKET_KEEPALIVE", "true").lower() == "true"
+# A connection idle for this many seconds is PINGed before use (0: off)
+REDIS_HEALTH_CHECK_INTERVAL_S = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL_S", 30))
+# Retries of a command failing on a connection error or timeout, the n-th
+# after a random wait of up to min(REDIS_RETRY_CAP_S, REDIS_RETRY_BASE_S * 2^n)
+REDIS_RETRIES = int(os.getenv("REDIS_RETRIES", 2))
+REDIS_RETRY_BASE_S = float(os.getenv("REDIS_RETRY_BASE_S", 0.05))
+REDIS_RETRY_CAP_S = float(os.getenv("REDIS_RETRY_CAP_S", 1))
+# RESP protocol version, 2 or 3
+REDIS_PROTOCOL = int(os.getenv("REDIS_PROTOCOL", 2))
+# Coalesce concurrent single commands into pipelines
+REDIS_AUTOBATCH = os.getenv("REDIS_AUTOBATCH", "true").lower() == "true"
+REDIS_AUTOBATCH_MAX = int(os.getenv("REDIS_AUTOBATCH_MAX", 128))
 STREAM_NAME = os.getenv("STREAM_NAME", "energy_readings")
+# Number of stream partitions, readings are routed by site_id (see partitions)
+STREAM_PARTITIONS = int(os.getenv("STREAM_PARTITIONS", 1))
 CONSUMER_GROUP = os.getenv("CONSUMER_GROUP", "processing_group")
+DEAD_LETTER_STREAM = os.getenv("DEAD_LETTER_STREAM", f"{STREAM_NAME}:dead")
+# Encoding of new stream entries, consumers read both (see shared_lib.stream)
+STREAM_FORMAT = StreamFormat(os.getenv("STREAM_FORMAT", StreamFormat.FIELDS))
@@ -0,0 +1,111 @@
+"""
+Prometheus metrics shared by the services, exposed on GET /metrics.
+
+Timings use time.perf_counter, an observation is a lock and a bucket lookup
+(a few microseconds), cheap enough for every Redis call.
+
+A service running several worker processes sets PROMETHEUS_MULTIPROC_DIR before
+they start: every process writes its samples there and /metrics aggregates all
+of them, whichever worker answers the scrape.
+"""
+
+import os
+import time
+from types import TracebackType
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+# Seconds, from a sub-millisecond Redis round-trip to a stuck call
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+REDIS_SECONDS = Histogram(
+    "redis_operation_seconds",
+    "Latency of Redis calls (a pipeline is one call)",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+REDIS_ERRORS = Counter(
+    "redis_operation_errors_total",
+    "Redis calls that raised",
+    ["operation"],
+)
+VALIDATION_SECONDS = Histogram(
+    "reading_validation_seconds",
+    "Time to validate one batch of readings",
+    buckets=LATENCY_BUCKETS,
+)
+
+
+class RedisTimer:
+    """Context manager observing one call, see redis_timer."""
+
+    __slots__ = ("_errors", "_seconds", "_start")
+
+    def __init__(self, seconds: Histogram, errors: Counter) -> None:
+        self._seconds = seconds
+        self._errors = errors
+        self._start = 0.0
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self._seconds.observe(time.perf_counter() - self._start)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self._errors.inc()
+
+
+# label children per operation, resolving them on every call costs more than
+# the observation itself
+_timer_children: dict[str, tuple[Histogram, Counter]] = {}
+
+
+def redis_timer(operation: str) -> RedisTimer:
+    """Observes the duration of the block, counts it as an error if it raises."""
+    children = _timer_children.get(operation)
+    if children is None:
+        children = (REDIS_SECONDS.labels(operation), REDIS_ERRORS.labels(operation))
+        _timer_children[operation] = children
+    return RedisTimer(*children)
+
+
+def latest_metrics() -> bytes:
+    """The text exposition of this process, or of all workers in multiprocess mode."""
+    if MULTIPROC_DIR_ENV not in os.environ:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)  # type: ignore[no-untyped-call]
+    return generate_latest(registry)
+
+
+def mark_process_dead() -> None:
+    """Drops the live gauges of this worker on shutdown, in multiprocess mode."""
+    if MULTIPROC_DIR_ENV in os.environ:
+        multiprocess.mark_process_dead(os.getpid())  # type: ignore[no-untyped-call]
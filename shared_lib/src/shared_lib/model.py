@@ -1,14 +1,58 @@
-from datetime import datetime
+import re
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import UTC, datetime
 from enum import StrEnum
+from typing import Any
 
 from pydantic import BaseModel, ConfigDict, Field, field_validator
 
 # Formatting to ISO 8601
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# The zero padded form of DATE_FORMAT, parsed without strptime
+_DATE_PATTERN = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z")
+
+# "now" shared by all readings validated inside batch_now()
+_batch_now: ContextVar[datetime | None] = ContextVar("batch_now", default=None)
+
+
+def parse_timestamp(timestamp: str) -> datetime:
+    """
+    Same result as datetime.strptime(timestamp, DATE_FORMAT).
+    The canonical form is parsed with a precompiled pattern, anything else
+    (e.g. not zero padded or out of range) goes through strptime, so accepted
+    values and errors do not change.
+    """
+    match = _DATE_PATTERN.fullmatch(timestamp)
+    if match is not None:
+        try:
+            year, month, day, hour, minute, second = map(int, match.groups())
+            return datetime(year, month, day, hour, minute, second)
+        except ValueError:
+            pass
+    return datetime.strptime(timestamp, DATE_FORMAT)
+
+
+def timestamp_to_epoch(timestamp: str) -> int:
+    """Epoch seconds of a DATE_FORMAT timestamp, the trailing Z means UTC."""
+    return int(parse_timestamp(timestamp).replace(tzinfo=UTC).timestamp())
+
+
+@contextmanager
+def batch_now() -> Iterator[None]:
+    """Readings validated inside the block compare against a single "now"."""
+    token = _batch_now.set(datetime.now())
+    try:
+        yield
+    finally:
+        _batch_now.reset(token)
 
 
 class ReadingStatus(StrEnum):
     ACCEPTED = "accepted"
+    REJECTED = "rejected"
+    SPOOLED = "spooled"  # accepted into the producer spool, no stream id yet
 
 
 HEALTH_CHECK_DICT = {"status": "healthy"}
@@ -28,13 +72,13 @@ class ReadingInput(BaseModel):
     @classmethod
     def validate_timestamp_format(cls, v: str) -> str:
         try:
-            new = datetime.strptime(v, DATE_FORMAT)
+            new = parse_timestamp(v)
         except ValueError as err:
             raise ValueError(
                 "Timestamp must be in format YYYY-MM-DDTHH:MM:SSZ"
             ) from err
 
-        now = datetime.now(new.tzinfo) if new.tzinfo else datetime.now()
+        now = _batch_now.get() or datetime.now()
         if new > now:
             raise ValueError("datetime is in the future")
         return v
@@ -42,8 +86,89 @@ class ReadingInput(BaseModel):
 
 class ReadingOutput(BaseModel):
     status: ReadingStatus
-    stream_id: str = Field(min_length=1)  # Cannot be ""
+    stream_id: str | None = Field(default=None, min_length=1)  # None if spooled
     # version: Literal[1] = 1
 
     # immutable
     model_config = ConfigDict(frozen=True, str_strip_whitespace=True)
+
+
+class BatchItemOutput(BaseModel):
+    index: int  # position of the item in the request body
+    status: ReadingStatus
+    stream_id: str | None = None
+    errors: list[dict[str, Any]] | None = None
+
+    # immutable
+    model_config = ConfigDict(frozen=True)
+
+
+class BatchReadingOutput(BaseModel):
+    accepted: int
+    rejected: int
+    results: list[BatchItemOutput]
+
+    # immutable
+    model_config = ConfigDict(frozen=True)
+
+
+class AggregateBucket(BaseModel):
+    start: str  # bucket start, DATE_FORMAT
+    count: int
+    sum: float
+    avg: float
+    min: float
+    max: float
+    last: float  # power_reading with the latest timestamp in the bucket
+
+    # immutable
+    model_config = ConfigDict(frozen=True)
+
+
+class Anomaly(BaseModel):
+    timestamp: str  # DATE_FORMAT
+    device_id: str
+    power_reading: float
+    score: float  # robust z-score, see SiteAnalytics
+
+    # immutable
+    model_config = ConfigDict(frozen=True)
+
+
+class SiteAnalytics(BaseModel):
+    count: int
+    first: str | None  # timestamps, DATE_FORMAT
+    last: str | None
+    avg: float | None  # power_reading statistics
+    min: float | None
+    max: float | None
+    std: float | None
+    peak_at: str | None  # timestamp of max
+    # power_reading integrated over time per device (trapezoids), in power x hours
+    energy: float
+    # readings whose |0.6745 * (x - median) / MAD| exceeds the threshold
+    anomaly_count: int
+    anomalies: list[Anomaly]  # the latest ones
+
+    # immutable
+    model_config = ConfigDict(frozen=True)
+
+
+class DownsampleMethod(StrEnum):
+    LTTB = "lttb"  # largest triangle three buckets
+    MINMAX = "minmax"  # lowest and highest reading per bucket
+
+
+class ExportFormat(StrEnum):
+    CSV = "csv"
+    ARROW = "arrow"  # Arrow IPC streaming format
+    PARQUET = "parquet"
+
+
+class ReadingSeries(BaseModel):
+    count: int  # readings in the range, before downsampling
+    epochs: list[int]  # epoch seconds, oldest first
+    power: list[float]  # power_reading at each epoch
+
+    # immutable
+    model_config = ConfigDict(frozen=True)
@@ -0,0 +1,84 @@
+"""
+Hash partitioning of the readings stream by site_id.
+
+With STREAM_PARTITIONS=1 the only stream is STREAM_NAME, as before.
+With N > 1 readings go to `{STREAM_NAME}:{p}` with p = crc32(site_id) % N,
+e.g. `energy_readings:{3}`, so all readings of a site share one partition and
+keep their order. The braces are a Redis Cluster hash tag: the dead letters
+`energy_readings:{3}:dead` and every key of the sites of the partition carry
+it (`site_tag`, e.g. `readings:site:{3}:site123`), so the transaction storing
+and ACKing a batch of a partition stays in one cluster slot.
+The tag is part of the stored keys: with N > 1 the partition count is fixed
+for the lifetime of the stored readings.
+"""
+
+import zlib
+from collections.abc import Iterable
+
+from shared_lib.config import DEAD_LETTER_STREAM, STREAM_NAME, STREAM_PARTITIONS
+
+
+def partition_of(site_id: str, partitions: int) -> int:
+    if partitions <= 1:
+        return 0
+    return zlib.crc32(site_id.encode()) % partitions
+
+
+def stream_key(partition: int, partitions: int) -> str:
+    if partitions <= 1:
+        return STREAM_NAME
+    return f"{STREAM_NAME}:{{{partition}}}"
+
+
+def site_stream(site_id: str) -> str:
+    """Stream the readings of a site are written to."""
+    return stream_key(partition_of(site_id, STREAM_PARTITIONS), STREAM_PARTITIONS)
+
+
+def site_tag(site_id: str) -> str:
+    """
+    Prefix of the site_id in the keys of a site: the `{p}:` hash tag of its
+    partition, empty with a single stream (keys as before partitioning).
+    """
+    if STREAM_PARTITIONS <= 1:
+        return ""
+    return f"{{{partition_of(site_id, STREAM_PARTITIONS)}}}:"
+
+
+def untag_site(value: str) -> str:
+    """site_id of `site_tag(site_id) + site_id`, e.g. a key without its prefix."""
+    if STREAM_PARTITIONS > 1 and value.startswith("{"):
+        return value.partition("}:")[2]
+    return value
+
+
+def stream_keys(partitions: Iterable[int] | None = None) -> list[str]:
+    """Keys of the given partitions, all of them by default."""
+    if partitions is None:
+        partitions = range(max(STREAM_PARTITIONS, 1))
+    return [stream_key(p, STREAM_PARTITIONS) for p in partitions]
+
+
+def dead_letter_key(stream: str) -> str:
+    """Dead-letter stream of a partition, with the same hash tag."""
+    if stream == STREAM_NAME:
+        return DEAD_LETTER_STREAM
+    return f"{stream}:dead"
+
+
+def parse_partitions(spec: str, partitions: int) -> list[int]:
+    """
+    Parses an assignment like "0-3,7" into sorted partition numbers,
+    an empty spec means all partitions.
+    Raises ValueError for malformed or out of range entries.
+    """
+    if not spec.strip():
+        return list(range(max(partitions, 1)))
+    result: set[int] = set()
+    for part in spec.split(","):
+        first, _sep, last = part.strip().partition("-")
+        low, high = int(first), int(last or first)
+        if not 0 <= low <= high < max(partitions, 1):
+            raise ValueError(f"Partition {part!r} is not in 0..{partitions - 1}")
+        result.update(range(low, high + 1))
+    return sorted(result)
@@ -0,0 +1,185 @@
+"""
+Redis client of the services, configured from shared_lib.config.
+
+`create_redis` opens a BlockingConnectionPool (bounded, callers wait for a free
+connection), with connect and reply timeouts, TCP keepalive, a PING on
+connections idle for REDIS_HEALTH_CHECK_INTERVAL_S, and retries with jittered
+exponential backoff on connection errors and timeouts. Retried writes are
+at-least-once, like the producer spool.
+
+With REDIS_AUTOBATCH the client is an AutoBatchRedis: single commands awaited
+concurrently (e.g. by many request handlers) are sent as one non-transactional
+pipeline, one round-trip for the lot. Callers do not change, every command
+still returns its own reply or raises its own error.
+"""
+
+import asyncio
+from typing import Any
+
+import redis.asyncio as redis
+from prometheus_client import Histogram
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialWithJitterBackoff
+
+from shared_lib.config import (
+    REDIS_AUTOBATCH,
+    REDIS_AUTOBATCH_MAX,
+    REDIS_CONNECT_TIMEOUT_S,
+    REDIS_HEALTH_CHECK_INTERVAL_S,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_POOL_TIMEOUT_S,
+    REDIS_PROTOCOL,
+    REDIS_RETRIES,
+    REDIS_RETRY_BASE_S,
+    REDIS_RETRY_CAP_S,
+    REDIS_SOCKET_KEEPALIVE,
+    REDIS_SOCKET_TIMEOUT_S,
+    REDIS_URL,
+)
+
+# hold their connection until the server answers, batching them would delay
+# every command queued behind. PING opens and probes connections (warmup)
+UNBATCHED_COMMANDS = frozenset(
+    {
+        "BLPOP",
+        "BRPOP",
+        "BRPOPLPUSH",
+        "BLMOVE",
+        "BLMPOP",
+        "BZPOPMIN",
+        "BZPOPMAX",
+        "BZMPOP",
+        "WAIT",
+        "WAITAOF",
+        "PING",
+    }
+)
+
+AUTOBATCH_SIZE = Histogram(
+    "redis_autobatch_size",
+    "Commands sent per auto-batched round-trip",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+# (command args, execute_command options, future of the reply)
+QueuedCommand = tuple[tuple[Any, ...], dict[str, Any], asyncio.Future[Any]]
+# XREAD / XREADGROUP reply: (stream, [(message_id, fields)])
+StreamReply = list[tuple[str, list[tuple[str, dict[str, str]]]]]
+
+
+class AutoBatchRedis(redis.Redis):
+    """
+    Client sending the commands queued during one event loop iteration as one
+    pipeline, at most `max_batch` commands each. A lone command is sent as is.
+    Explicit pipelines, transactions and pub/sub are not affected.
+    """
+
+    max_batch: int = REDIS_AUTOBATCH_MAX
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:  # noqa: ANN401
+        super().__init__(*args, **kwargs)
+        self._queue: list[QueuedCommand] = []
+        self._flushes: set[asyncio.Task[None]] = set()
+
+    async def execute_command(self, *args: Any, **options: Any) -> Any:  # noqa: ANN401
+        if not batchable(args):
+            return await super().execute_command(*args, **options)  # type: ignore[no-untyped-call]
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[Any] = loop.create_future()
+        if not self._queue:
+            # runs after the callbacks ready now, the commands they send join
+            loop.call_soon(self._flush)
+        self._queue.append((args, options, future))
+        return await future
+
+    def _flush(self) -> None:
+        queue, self._queue = self._queue, []
+        for start in range(0, len(queue), self.max_batch):
+            batch = queue[start : start + self.max_batch]
+            task = asyncio.create_task(self._send(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _send(self, batch: list[QueuedCommand]) -> None:
+        AUTOBATCH_SIZE.observe(len(batch))
+        try:
+            if len(batch) == 1:
+                args, options, _future = batch[0]
+                reply = await super().execute_command(*args, **options)  # type: ignore[no-untyped-call]
+                replies = [reply]
+            else:
+                async with self.pipeline(transaction=False) as pipe:
+                    for args, options, _future in batch:
+                        pipe.execute_command(*args, **options)
+                    # errors of single commands are returned in place
+                    replies = await pipe.execute(raise_on_error=False)
+        except BaseException as e:
+            # the round-trip failed (after the retries), for every command
+            for _args, _options, future in batch:
+                if not future.done():
+                    if isinstance(e, Exception):
+                        future.set_exception(e)
+                    else:
+                        future.cancel()
+            if not isinstance(e, Exception):
+                raise
+            return
+        for (_args, _options, future), reply in zip(batch, replies, strict=True):
+            # a caller cancelled meanwhile has no future to answer
+            if future.done():
+                continue
+            if isinstance(reply, Exception):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+
+
+def batchable(args: tuple[Any, ...]) -> bool:
+    """False for blocking commands, they must not hold a batch back."""
+    command = str(args[0]).upper()
+    if command in UNBATCHED_COMMANDS:
+        return False
+    if command in ("XREAD", "XREADGROUP"):
+        return not any(arg in (b"BLOCK", "BLOCK") for arg in args)
+    return True
+
+
+def create_redis(
+    url: str = REDIS_URL,
+    socket_timeout: float = REDIS_SOCKET_TIMEOUT_S,
+    autobatch: bool = REDIS_AUTOBATCH,
+) -> redis.Redis:
+    """
+    A client owning its connection pool, closed with the client. Open one per
+    process, `socket_timeout` must stay above the BLOCK of blocking reads.
+    """
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        decode_responses=True,
+        protocol=REDIS_PROTOCOL,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT_S,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT_S,
+        socket_timeout=socket_timeout,
+        socket_keepalive=REDIS_SOCKET_KEEPALIVE,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL_S,
+        # retries ConnectionError and TimeoutError, reconnecting in between
+        retry=Retry(
+            ExponentialWithJitterBackoff(
+                cap=REDIS_RETRY_CAP_S, base=REDIS_RETRY_BASE_S
+            ),
+            REDIS_RETRIES,
+        ),
+    )
+    client_class = AutoBatchRedis if autobatch else redis.Redis
+    return client_class.from_pool(pool)
+
+
+def stream_reply(reply: Any) -> StreamReply:  # noqa: ANN401
+    """
+    XREAD / XREADGROUP reply as (stream, messages) pairs, RESP3 replies are a
+    dict {stream: [messages]}.
+    """
+    if isinstance(reply, dict):
+        return [(stream, messages[0]) for stream, messages in reply.items()]
+    return [(stream, messages) for stream, messages in reply or []]
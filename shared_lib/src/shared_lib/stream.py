@@ -0,0 +1,128 @@
+"""
+Encoding of readings as Redis stream entries.
+
+Two formats, consumers decode both so producers can switch gradually:
+- `fields` (schema_version 1): one stream field per reading field plus
+  the schema_version marker
+- `compact` (schema_version 2): a single field holding
+  "2<US>site_id<US>device_id<US>power_reading<US>epoch seconds", no repeated
+  field names and a 10 digit epoch instead of the 20 char timestamp.
+  Readings whose ids contain the separator fall back to `fields`.
+
+`compact` trades CPU for bandwidth and stream memory: about 40% of the entry
+bytes, but slower to encode and decode (timestamp conversions), see
+benchmarks.wire_format. `fields` stays the default.
+
+Clients run with decode_responses=True, so the compact record is text;
+a binary struct would not survive the utf-8 decoding of every reply.
+"""
+
+import time
+from collections.abc import Mapping
+from enum import StrEnum
+from typing import Any
+
+from shared_lib.model import (
+    DATE_FORMAT,
+    ReadingInput,
+    parse_timestamp,
+    timestamp_to_epoch,
+)
+
+# Entries written by the producer carry a schema version,
+# consumers trust them and skip re-validation
+STREAM_SCHEMA_FIELD = "schema_version"
+STREAM_SCHEMA_VERSION = "1"
+COMPACT_FIELD = "r"
+COMPACT_SCHEMA_VERSION = "2"
+COMPACT_SEPARATOR = "\x1f"  # ASCII unit separator
+
+
+class StreamFormat(StrEnum):
+    FIELDS = "fields"
+    COMPACT = "compact"
+
+
+def to_stream_entry(
+    reading: ReadingInput, stream_format: StreamFormat = StreamFormat.FIELDS
+) -> dict[str, Any]:
+    """Stream fields of a validated reading, marked as trusted."""
+    if stream_format == StreamFormat.COMPACT and not (
+        COMPACT_SEPARATOR in reading.site_id or COMPACT_SEPARATOR in reading.device_id
+    ):
+        record = COMPACT_SEPARATOR.join(
+            (
+                COMPACT_SCHEMA_VERSION,
+                reading.site_id,
+                reading.device_id,
+                repr(reading.power_reading),
+                str(timestamp_to_epoch(reading.timestamp)),
+            )
+        )
+        return {COMPACT_FIELD: record}
+    return {**reading.model_dump(), STREAM_SCHEMA_FIELD: STREAM_SCHEMA_VERSION}
+
+
+def decode_stream_entry(
+    payload: Mapping[str, Any],
+) -> tuple[ReadingInput, dict[str, Any]]:
+    """
+    Returns the reading of a stream entry and its fields as stored by the
+    consumer (without the schema marker, values as they were in the stream).
+    Entries marked by the producer were validated on ingest and are only type
+    converted and format checked, others get the full validation.
+    Raises pydantic.ValidationError like ReadingInput.model_validate.
+    """
+    fields, trusted = _entry_fields(payload)
+    if trusted:
+        try:
+            parse_timestamp(fields["timestamp"])
+            reading = ReadingInput.model_construct(
+                site_id=fields["site_id"],
+                device_id=fields["device_id"],
+                power_reading=float(fields["power_reading"]),
+                timestamp=fields["timestamp"],
+            )
+            return reading, fields
+        except (KeyError, TypeError, ValueError):
+            pass  # a broken trusted entry, let validation report it
+    return ReadingInput.model_validate(fields), fields
+
+
+def from_stream_entry(payload: Mapping[str, Any]) -> ReadingInput:
+    """Reading of a stream entry, see decode_stream_entry."""
+    return decode_stream_entry(payload)[0]
+
+
+def stream_entry_site_id(payload: Mapping[str, Any]) -> str:
+    """site_id of a stream entry without decoding it, "" if it has none."""
+    record = payload.get(COMPACT_FIELD)
+    if isinstance(record, str) and record.startswith(
+        COMPACT_SCHEMA_VERSION + COMPACT_SEPARATOR
+    ):
+        return record.split(COMPACT_SEPARATOR, 2)[1]
+    return str(payload.get("site_id", ""))
+
+
+def _entry_fields(payload: Mapping[str, Any]) -> tuple[dict[str, Any], bool]:
+    record = payload.get(COMPACT_FIELD)
+    if isinstance(record, str):
+        parts = record.split(COMPACT_SEPARATOR)
+        if len(parts) == 5 and parts[0] == COMPACT_SCHEMA_VERSION:
+            _version, site_id, device_id, power_reading, epoch = parts
+            try:
+                timestamp = time.strftime(DATE_FORMAT, time.gmtime(int(epoch)))
+            except (ValueError, OverflowError, OSError):
+                # epoch out of range, validated as is and reported invalid
+                return dict(payload), False
+            fields = {
+                "site_id": site_id,
+                "device_id": device_id,
+                "power_reading": power_reading,
+                "timestamp": timestamp,
+            }
+            return fields, True
+
+    trusted = payload.get(STREAM_SCHEMA_FIELD) == STREAM_SCHEMA_VERSION
+    fields = {k: v for k, v in payload.items() if k != STREAM_SCHEMA_FIELD}
+    return fields, trusted
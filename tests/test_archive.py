@@ -0,0 +1,195 @@
+import json
+import time
+from collections.abc import AsyncIterator
+from datetime import UTC, datetime
+from pathlib import Path
+
+import pyarrow.parquet as pa_parquet
+import pytest
+from fakeredis import FakeAsyncRedis
+
+from services.consumer import archive, segments, storage
+from services.consumer.storage import ReadingQuery
+from shared_lib import partitions
+from shared_lib.model import DATE_FORMAT, ReadingInput
+
+SITE_ID = "site1"
+NOW = time.time()
+# three days back, on a window boundary
+BASE = (int(NOW) - 3 * 86400) // archive.ARCHIVE_WINDOW_S * archive.ARCHIVE_WINDOW_S
+
+
+def reading(epoch: int, device_id: str = "dev1") -> str:
+    """A reading as the consumer stores it, stream values are strings."""
+    return json.dumps(
+        {
+            "site_id": SITE_ID,
+            "device_id": device_id,
+            "power_reading": str(float(epoch % 1000)),
+            "timestamp": datetime.fromtimestamp(epoch, UTC).strftime(DATE_FORMAT),
+        }
+    )
+
+
+# two archived windows and two recent readings, latest first
+OLD = [reading(BASE + i * 600, f"dev{i % 2}") for i in range(12)]
+RECENT = [reading(int(NOW) - 60), reading(int(NOW) - 30)]
+LATEST_FIRST = (OLD + RECENT)[::-1]
+
+
+@pytest.fixture
+def archive_dir(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Path:
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", storage.StorageBackend.ZSET)
+    monkeypatch.setattr(storage, "ARCHIVE_ENABLED", True)
+    monkeypatch.setattr(storage, "ARCHIVE_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+async def r() -> AsyncIterator[FakeAsyncRedis]:
+    client = FakeAsyncRedis(decode_responses=True)
+    await client.set(archive.ARCHIVE_LOCK_KEY, "owner")
+    yield client
+    await client.aclose()
+
+
+async def store(r: FakeAsyncRedis, values: list[str]) -> None:
+    async with r.pipeline(transaction=True) as pipe:
+        storage.stage_site_writes(
+            pipe,
+            SITE_ID,
+            [(ReadingInput.model_validate_json(value), value) for value in values],
+        )
+        await pipe.execute()
+
+
+async def test_archive_moves_old_windows_to_segments(
+    r: FakeAsyncRedis, archive_dir: Path
+) -> None:
+    await store(r, OLD + RECENT)
+
+    archived = await archive.archive_sites(r, archive_dir, "owner", NOW)
+
+    assert archived == len(OLD)
+    assert len(list(archive_dir.rglob("*.parquet"))) == 2
+    cutoff = int(NOW) - storage.ARCHIVE_AFTER_S
+    watermark = cutoff - cutoff % archive.ARCHIVE_WINDOW_S
+    assert await r.get(storage.archive_watermark_key(SITE_ID)) == str(watermark)
+    assert await storage.read_site_readings(r, SITE_ID, ReadingQuery()) == LATEST_FIRST
+
+    # the next run removes them from Redis, reads do not change
+    assert await archive.archive_sites(r, archive_dir, "owner", NOW) == 0
+    assert await r.zcard(storage.site_index_key(SITE_ID)) == len(RECENT)
+    assert await r.zcard(storage.device_index_key(SITE_ID, "dev0")) == 0
+    assert await storage.read_site_readings(r, SITE_ID, ReadingQuery()) == LATEST_FIRST
+    assert await storage.count_site_readings(r, SITE_ID, ReadingQuery()) == 14
+
+
+@pytest.mark.parametrize("ascending", [False, True])
+@pytest.mark.parametrize(("offset", "limit"), [(0, 5), (1, 3), (4, 5), (13, 5)])
+async def test_pages_span_both_tiers(
+    r: FakeAsyncRedis, archive_dir: Path, ascending: bool, offset: int, limit: int
+) -> None:
+    await store(r, OLD + RECENT)
+    await archive.archive_sites(r, archive_dir, "owner", NOW)
+    expected = LATEST_FIRST[::-1] if ascending else LATEST_FIRST
+    query = ReadingQuery(offset=offset, limit=limit, ascending=ascending)
+
+    page = await storage.read_site_readings(r, SITE_ID, query)
+    chunks = [chunk async for chunk in storage.iter_site_readings(r, SITE_ID, query)]
+
+    assert page == expected[offset : offset + limit]
+    assert [value for chunk in chunks for value in chunk] == page
+
+
+async def test_filters_apply_to_segments(r: FakeAsyncRedis, archive_dir: Path) -> None:
+    await store(r, OLD + RECENT)
+    await archive.archive_sites(r, archive_dir, "owner", NOW)
+    query = ReadingQuery(start=BASE + 600, end=BASE + 4200, device_id="dev1")
+
+    readings = await storage.read_site_readings(r, SITE_ID, query)
+
+    expected = [reading(BASE + i * 600, "dev1") for i in (7, 5, 3, 1)]
+    assert readings == expected
+    assert await storage.count_site_readings(r, SITE_ID, query) == len(expected)
+
+
+async def test_archive_finds_partition_tagged_sites(
+    r: FakeAsyncRedis, archive_dir: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(partitions, "STREAM_PARTITIONS", 4)
+    await store(r, OLD + RECENT)
+
+    assert await archive.archive_sites(r, archive_dir, "owner", NOW) == len(OLD)
+    assert await storage.read_site_readings(r, SITE_ID, ReadingQuery()) == LATEST_FIRST
+
+
+async def test_unparsable_site_does_not_stop_the_run(
+    r: FakeAsyncRedis, archive_dir: Path
+) -> None:
+    await store(r, OLD)
+    broken = json.loads(reading(BASE))
+    broken.update(site_id="broken", power_reading="not a number")
+    await r.zadd(storage.site_index_key("broken"), {json.dumps(broken): BASE})
+
+    archived = await archive.archive_sites(r, archive_dir, "owner", NOW)
+
+    assert archived == len(OLD)
+    assert await r.zcard(storage.site_index_key("broken")) == 1
+    assert await r.get(storage.archive_watermark_key("broken")) is None
+
+
+async def test_late_reading_is_merged_into_its_segment(
+    r: FakeAsyncRedis, archive_dir: Path
+) -> None:
+    await store(r, OLD + RECENT)
+    await archive.archive_sites(r, archive_dir, "owner", NOW)
+    late = reading(BASE + 300, "dev9")
+    await store(r, [late])
+
+    await archive.archive_sites(r, archive_dir, "owner", NOW)
+
+    readings = await storage.read_site_readings(r, SITE_ID, ReadingQuery())
+    assert readings == [*LATEST_FIRST[:-1], late, LATEST_FIRST[-1]]
+    assert await r.zcard(storage.site_index_key(SITE_ID)) == len(RECENT)
+
+
+async def test_archive_bumps_site_version(r: FakeAsyncRedis, archive_dir: Path) -> None:
+    await store(r, OLD + RECENT)
+    invalidated: list[str] = []
+    version_key = storage.site_version_key(SITE_ID)
+
+    before = int(await r.get(version_key) or 0)
+    await archive.archive_sites(r, archive_dir, "owner", NOW, invalidated.append)
+    archived = int(await r.get(version_key) or 0)
+    # the watermark moved past the old windows
+    assert archived > before
+    assert invalidated == [SITE_ID]
+
+    await store(r, [reading(BASE + 300, "dev9")])
+    stored = int(await r.get(version_key) or 0)
+    await archive.archive_sites(r, archive_dir, "owner", NOW, invalidated.append)
+    # the late reading rewrote its segment
+    assert int(await r.get(version_key) or 0) > stored
+
+
+def test_segment_footer_indexes_row_groups(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(segments, "SEGMENT_ROW_GROUP_ROWS", 4)
+    epochs = [BASE + i * 600 for i in range(6)]
+    values = [reading(epoch, f"dev{i % 2}") for i, epoch in enumerate(epochs)]
+
+    path = segments.write_segment(
+        tmp_path, SITE_ID, (BASE, BASE + 3600), values, epochs
+    )
+
+    metadata = pa_parquet.ParquetFile(path).metadata
+    assert metadata.num_row_groups == 2
+    assert metadata.metadata[b"devices"] == b'["dev0", "dev1"]'
+    # the second row group only
+    query = ReadingQuery(start=BASE + 2400, ascending=True)
+    assert segments.read_segments(tmp_path, SITE_ID, query) == values[4:]
+    assert segments.count_segments(tmp_path, SITE_ID, query) == 2
+    missing = ReadingQuery(device_id="dev7")
+    assert segments.read_segments(tmp_path, SITE_ID, missing) == []
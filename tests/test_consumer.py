@@ -1,14 +1,49 @@
 import asyncio
+import io
 import json
-from unittest.mock import ANY, AsyncMock
+from typing import Any
+from unittest.mock import ANY, AsyncMock, MagicMock
 
+import numpy as np
+import pyarrow.ipc as pa_ipc
+import pyarrow.parquet as pa_parquet
 import pytest
+from fakeredis import FakeAsyncRedis
 from httpx import ASGITransport, AsyncClient, codes
+from prometheus_client import REGISTRY
+from redis.crc import key_slot
 from redis.exceptions import RedisError
 
 # Adjust import based on your actual file
-from services.consumer.main import app, consume_stream
+from services.consumer import dedup, export, main as consumer_main, rollups, storage
+from services.consumer.analytics import (
+    lttb_indices,
+    minmax_indices,
+    site_analytics,
+    to_arrays,
+)
+from services.consumer.cache import ResponseCache
+from services.consumer.live import LiveHub, iter_live_events
+from services.consumer.main import (
+    MAX_DELIVERIES,
+    app,
+    autoclaim_idle,
+    consume_stream,
+    drain_own_pending,
+    process_messages,
+    read_cache,
+    shard_by_site,
+    update_group_gauges,
+)
+from shared_lib import partitions
+from shared_lib.config import CONSUMER_GROUP, DEAD_LETTER_STREAM, STREAM_NAME
 from shared_lib.model import HEALTH_CHECK_DICT, ReadingInput
+from shared_lib.stream import (
+    STREAM_SCHEMA_FIELD,
+    STREAM_SCHEMA_VERSION,
+    StreamFormat,
+    to_stream_entry,
+)
 
 MOCK_SITE_ID = "site123"
 MOCK_STREAM_ID = "1705314600000-0"
@@ -19,6 +54,45 @@ MOCK_PAYLOAD = ReadingInput(
     timestamp="2024-01-15T10:30:00Z",
 ).model_dump()
 
+
+def mock_pipeline(mock_redis: AsyncMock) -> MagicMock:
+    """Attach a pipeline mock usable as `async with r.pipeline() as pipe`."""
+    pipe = MagicMock()
+    pipe.__aenter__.return_value = pipe
+    pipe.execute = AsyncMock()
+    mock_redis.pipeline = MagicMock(return_value=pipe)
+    return pipe
+
+
+async def stored_by_consumer(*payloads: dict[str, Any]) -> list[str]:
+    """
+    The payloads serialized as process_messages stores them, latest first.
+    Stream values come back from Redis as strings, so does power_reading.
+    """
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    messages = [
+        (f"{index}-0", {field: str(value) for field, value in payload.items()})
+        for index, payload in enumerate(payloads, 1)
+    ]
+    await process_messages(mock_redis, messages)
+    return [value for call in pipe.lpush.call_args_list for value in call.args[1:]][
+        ::-1
+    ]
+
+
+@pytest.fixture(autouse=True)
+def clear_read_cache() -> None:
+    """Responses cached by one test must not leak into the next."""
+    read_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def disable_dedup(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Dedup claims run in their own pipeline, tests of it enable it on their own."""
+    monkeypatch.setattr(consumer_main, "DEDUP_ENABLED", False)
+
+
 # --- API Tests ---
 
 
@@ -72,6 +146,7 @@ async def test_get_site_readings_redis_error() -> None:
 async def test_consume_stream_processes_and_acks() -> None:
     """Tests that a valid message is parsed, stored in a list, and acknowledged."""
     mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
     # Mock xreadgroup to return one message, then empty to avoid infinite loop in test
     mock_redis.xreadgroup.side_effect = [
         [("mystream", [(MOCK_STREAM_ID, MOCK_PAYLOAD)])],
@@ -85,16 +160,19 @@ async def test_consume_stream_processes_and_acks() -> None:
 
     # Verify storage
     storage_key = f"readings:site:{MOCK_SITE_ID}"
-    mock_redis.lpush.assert_called_once_with(storage_key, json.dumps(MOCK_PAYLOAD))
-    mock_redis.ltrim.assert_called_once_with(storage_key, 0, 999)
-    # Verify ACK
-    mock_redis.xack.assert_called_once_with(ANY, ANY, MOCK_STREAM_ID)
+    pipe.lpush.assert_called_once_with(storage_key, json.dumps(MOCK_PAYLOAD))
+    pipe.ltrim.assert_called_once_with(storage_key, 0, 999)
+    # Verify ACK, sent in the same transaction
+    pipe.xack.assert_called_once_with(ANY, ANY, MOCK_STREAM_ID)
+    pipe.execute.assert_awaited_once()
+    mock_redis.xack.assert_not_called()
 
 
 @pytest.mark.asyncio
 async def test_consume_stream_invalid_data_acks_and_skips() -> None:
     """Tests that invalid Pydantic data is skipped but ACKed to clear the stream."""
     mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
     invalid_payload = {"malformed": "data"}
 
     mock_redis.xreadgroup.side_effect = [
@@ -108,26 +186,1180 @@ async def test_consume_stream_invalid_data_acks_and_skips() -> None:
         await consume_stream(app)
 
     # Should NOT attempt to store
-    mock_redis.lpush.assert_not_called()
+    pipe.lpush.assert_not_called()
     # Should still ACK to prevent stuck message
-    mock_redis.xack.assert_called_once_with(ANY, ANY, MOCK_STREAM_ID)
+    pipe.xack.assert_called_once_with(ANY, ANY, MOCK_STREAM_ID)
 
 
 @pytest.mark.asyncio
-async def test_consume_stream_redis_storage_error_still_acks() -> None:
-    """Tests that if storage fails, we still ACK to prevent blocking the group."""
+async def test_consume_stream_redis_storage_error_stays_pending() -> None:
+    """If storage fails the batch is not ACKed, reclaim retries it later."""
     mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
     mock_redis.xreadgroup.side_effect = [
         [("mystream", [(MOCK_STREAM_ID, MOCK_PAYLOAD)])],
         asyncio.CancelledError(),
     ]
     # Simulate failure during LPUSH
-    mock_redis.lpush.side_effect = RedisError("Storage Full")
+    pipe.execute.side_effect = RedisError("Storage Full")
+
+    app.state.redis = mock_redis
+
+    with pytest.raises(asyncio.CancelledError):
+        await consume_stream(app)
+
+    mock_redis.xack.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_process_messages_trusted_entry_bad_timestamp_is_invalid() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    trusted = {**MOCK_PAYLOAD, STREAM_SCHEMA_FIELD: STREAM_SCHEMA_VERSION}
+    broken = {**trusted, "timestamp": "garbage"}
+
+    await process_messages(mock_redis, [("1-0", broken), ("1-1", trusted)])
+
+    pipe.lpush.assert_called_once_with(
+        f"readings:site:{MOCK_SITE_ID}", json.dumps(MOCK_PAYLOAD)
+    )
+    pipe.xack.assert_called_once_with(ANY, ANY, "1-0", "1-1")
+
+
+@pytest.mark.asyncio
+async def test_process_messages_unexpected_error_stays_pending() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    pipe.execute.side_effect = ValueError("bug")
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, MOCK_PAYLOAD)])
+
+    mock_redis.xack.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_process_messages_groups_by_site_in_one_transaction() -> None:
+    """One LPUSH/LTRIM per site and a single multi-id XACK per batch."""
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    other_site = {**MOCK_PAYLOAD, "site_id": "site999"}
+    messages = [
+        ("1-0", MOCK_PAYLOAD),
+        ("1-1", other_site),
+        ("1-2", MOCK_PAYLOAD),
+        ("1-3", {"malformed": "data"}),
+    ]
+
+    await process_messages(mock_redis, messages)
+
+    mock_redis.pipeline.assert_called_once_with(transaction=True)
+    assert pipe.lpush.call_count == 2
+    pipe.lpush.assert_any_call(
+        f"readings:site:{MOCK_SITE_ID}",
+        json.dumps(MOCK_PAYLOAD),
+        json.dumps(MOCK_PAYLOAD),
+    )
+    pipe.lpush.assert_any_call("readings:site:site999", json.dumps(other_site))
+    assert pipe.ltrim.call_count == 2
+    pipe.xack.assert_called_once_with(ANY, ANY, "1-0", "1-1", "1-2", "1-3")
+    pipe.execute.assert_awaited_once()
+
+
+def test_shard_by_site_keeps_site_on_one_shard() -> None:
+    messages = [
+        (f"1-{i}", {**MOCK_PAYLOAD, "site_id": f"site{i % 5}"}) for i in range(50)
+    ]
+
+    shards = shard_by_site(messages, 4)
+
+    assert sum(len(shard) for shard in shards) == len(messages)
+    for shard in shards:
+        # stream order is kept inside a shard
+        assert shard == sorted(shard, key=lambda m: int(m[0].split("-")[1]))
+    for site in {payload["site_id"] for _id, payload in messages}:
+        owners = [
+            i
+            for i, shard in enumerate(shards)
+            if any(payload["site_id"] == site for _id, payload in shard)
+        ]
+        assert len(owners) == 1
+
+
+@pytest.mark.asyncio
+async def test_consume_stream_multiple_workers() -> None:
+    """Each site shard is stored by its worker and counted in /workers."""
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    messages = [
+        ("1-0", MOCK_PAYLOAD),
+        ("1-1", {**MOCK_PAYLOAD, "site_id": "site999"}),
+    ]
+
+    reads = iter([[("mystream", messages)]])
+
+    async def read_once(*_args: object, **_kwargs: object) -> object:
+        for streams in reads:
+            return streams
+        await asyncio.sleep(0.05)  # let the workers drain their queues
+        raise asyncio.CancelledError
+
+    mock_redis.xreadgroup.side_effect = read_once
+    app.state.redis = mock_redis
+
+    with pytest.raises(asyncio.CancelledError):
+        await consume_stream(app, workers=2)
+
+    assert pipe.execute.await_count == len(
+        [shard for shard in shard_by_site(messages, 2) if shard]
+    )
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get("/workers")
+
+    assert response.status_code == codes.OK
+    stats = response.json()
+    assert [worker["worker_id"] for worker in stats] == [0, 1]
+    assert sum(worker["messages"] for worker in stats) == len(messages)
+
+
+def pending_entry(message_id: str, times_delivered: int) -> dict[str, object]:
+    return {
+        "message_id": message_id,
+        "consumer": "me",
+        "time_since_delivered": 120000,
+        "times_delivered": times_delivered,
+    }
+
+
+@pytest.mark.asyncio
+async def test_autoclaim_idle_processes_and_dead_letters() -> None:
+    """Claimed messages are retried, poison messages move to the DLQ."""
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    mock_redis.xautoclaim.return_value = [
+        "0-0",
+        [("1-0", MOCK_PAYLOAD), ("1-1", MOCK_PAYLOAD)],
+        [],
+    ]
+    mock_redis.xpending_range.return_value = [
+        pending_entry("1-0", 2),
+        pending_entry("1-1", MAX_DELIVERIES),
+    ]
+
+    await autoclaim_idle(mock_redis)
+
+    mock_redis.xautoclaim.assert_awaited_once()
+    pipe.xadd.assert_called_once_with(
+        DEAD_LETTER_STREAM,
+        {**MOCK_PAYLOAD, "original_id": "1-1", "deliveries": MAX_DELIVERIES},
+    )
+    pipe.xack.assert_any_call(ANY, ANY, "1-1")
+    pipe.xack.assert_any_call(ANY, ANY, "1-0")
+    pipe.lpush.assert_called_once_with(
+        f"readings:site:{MOCK_SITE_ID}", json.dumps(MOCK_PAYLOAD)
+    )
+
+
+@pytest.mark.asyncio
+async def test_drain_own_pending_reads_from_pel_until_empty() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    mock_redis.xreadgroup.side_effect = [
+        [("mystream", [(MOCK_STREAM_ID, MOCK_PAYLOAD)])],
+        [("mystream", [])],
+    ]
+    mock_redis.xpending_range.return_value = [pending_entry(MOCK_STREAM_ID, 2)]
+
+    await drain_own_pending(mock_redis)
+
+    first_read, second_read = mock_redis.xreadgroup.call_args_list
+    assert list(first_read.args[2].values()) == ["0"]
+    # continues after the last recovered id
+    assert list(second_read.args[2].values()) == [MOCK_STREAM_ID]
+    pipe.xack.assert_called_once_with(ANY, ANY, MOCK_STREAM_ID)
+
+
+@pytest.mark.asyncio
+async def test_drain_own_pending_acks_trimmed_messages() -> None:
+    """Entries trimmed from the stream leave the PEL, the others are retried."""
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    mock_redis.xreadgroup.side_effect = [
+        [("mystream", [("1-0", None), ("1-1", MOCK_PAYLOAD), ("1-2", {})])],
+        [("mystream", [])],
+    ]
+    mock_redis.xpending_range.return_value = [pending_entry("1-1", 2)]
+
+    await drain_own_pending(mock_redis)
+
+    mock_redis.xack.assert_awaited_once_with(STREAM_NAME, CONSUMER_GROUP, "1-0", "1-2")
+    # sized by the claimed batch, the trimmed entries are in its id range
+    assert mock_redis.xpending_range.call_args.kwargs["count"] == 3
+    pipe.xack.assert_called_once_with(ANY, ANY, "1-1")
+    second_read = mock_redis.xreadgroup.call_args_list[1]
+    assert list(second_read.args[2].values()) == ["1-2"]
+
+
+# --- Storage backend Tests ---
+
+MOCK_EPOCH = 1705314600  # 2024-01-15T10:30:00Z
+
+
+@pytest.mark.asyncio
+async def test_process_messages_zset_backend(monkeypatch: pytest.MonkeyPatch) -> None:
+    """zset backend indexes by timestamp per site and device, trimmed by age."""
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", storage.StorageBackend.ZSET)
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, MOCK_PAYLOAD)])
+
+    member = {json.dumps(MOCK_PAYLOAD): MOCK_EPOCH}
+    pipe.zadd.assert_any_call(f"readings:ts:site:{MOCK_SITE_ID}", member)
+    pipe.zadd.assert_any_call(
+        f"readings:ts:site:{MOCK_SITE_ID}:device:{MOCK_PAYLOAD['device_id']}", member
+    )
+    assert pipe.zremrangebyscore.call_count == 2
+    pipe.lpush.assert_not_called()
+    pipe.xack.assert_called_once_with(ANY, ANY, MOCK_STREAM_ID)
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_zset_range_query(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", storage.StorageBackend.ZSET)
+    mock_redis = AsyncMock()
+    mock_redis.zrevrangebyscore.return_value = [json.dumps(MOCK_PAYLOAD)]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/readings",
+            params={
+                "from": "2024-01-15T10:00:00Z",
+                "to": "2024-01-15T11:00:00Z",
+                "device_id": "dev456",
+                "limit": 5,
+            },
+        )
+
+    assert response.status_code == codes.OK
+    assert response.json() == [MOCK_PAYLOAD]
+    mock_redis.zrevrangebyscore.assert_awaited_once_with(
+        f"readings:ts:site:{MOCK_SITE_ID}:device:dev456",
+        MOCK_EPOCH + 1800,
+        MOCK_EPOCH - 1800,
+        start=0,
+        num=5,
+    )
+    mock_redis.lrange.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_list_backend_filters() -> None:
+    """The list backend answers the same filters with a scan."""
+    older = {**MOCK_PAYLOAD, "timestamp": "2024-01-14T10:30:00Z"}
+    other_device = {**MOCK_PAYLOAD, "device_id": "dev999"}
+    mock_redis = AsyncMock()
+    mock_redis.lrange.return_value = [
+        json.dumps(p) for p in (other_device, MOCK_PAYLOAD, older)
+    ]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/readings",
+            params={"from": MOCK_EPOCH - 60, "device_id": "dev456"},
+        )
+
+    assert response.status_code == codes.OK
+    assert response.json() == [MOCK_PAYLOAD]
+
+
+@pytest.mark.parametrize("params", [{"from": "yesterday"}, {"limit": 0}])
+@pytest.mark.asyncio
+async def test_get_site_readings_invalid_query(params: dict[str, str | int]) -> None:
+    app.state.redis = AsyncMock()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(f"/sites/{MOCK_SITE_ID}/readings", params=params)
+
+    assert response.status_code == codes.UNPROCESSABLE_ENTITY
+
+
+# --- Pagination Tests ---
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_offset_page() -> None:
+    mock_redis = AsyncMock()
+    mock_redis.lrange.return_value = [json.dumps(MOCK_PAYLOAD)] * 10
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/readings", params={"offset": 20, "limit": 10}
+        )
+
+    assert response.status_code == codes.OK
+    assert response.json() == [MOCK_PAYLOAD] * 10
+    assert response.headers["X-Next-Offset"] == "30"
+    mock_redis.lrange.assert_awaited_once_with(f"readings:site:{MOCK_SITE_ID}", 20, 29)
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_last_page_has_no_next_offset() -> None:
+    mock_redis = AsyncMock()
+    mock_redis.lrange.return_value = [json.dumps(MOCK_PAYLOAD)]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(f"/sites/{MOCK_SITE_ID}/readings", params={"limit": 10})
+
+    assert response.json() == [MOCK_PAYLOAD]
+    assert "X-Next-Offset" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_ascending_page_with_total() -> None:
+    """Oldest first is read from the tail of the list, then reversed."""
+    stored = [json.dumps({**MOCK_PAYLOAD, "power_reading": i}) for i in (2, 1)]
+    mock_redis = AsyncMock()
+    mock_redis.lrange.return_value = stored
+    mock_redis.llen.return_value = 42
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/readings",
+            params={"order": "asc", "offset": 10, "limit": 2, "total": "true"},
+        )
+
+    assert [r["power_reading"] for r in response.json()] == [1, 2]
+    assert response.headers["X-Total-Count"] == "42"
+    assert response.headers["X-Next-Offset"] == "12"
+    mock_redis.lrange.assert_awaited_once_with(
+        f"readings:site:{MOCK_SITE_ID}", -12, -11
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_zset_ascending_count(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", storage.StorageBackend.ZSET)
+    mock_redis = AsyncMock()
+    mock_redis.zrangebyscore.return_value = [json.dumps(MOCK_PAYLOAD)]
+    mock_redis.zcount.return_value = 1
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/readings",
+            params={"from": MOCK_EPOCH, "order": "asc", "total": "true"},
+        )
+
+    assert response.headers["X-Total-Count"] == "1"
+    key = f"readings:ts:site:{MOCK_SITE_ID}"
+    mock_redis.zrangebyscore.assert_awaited_once_with(
+        key, MOCK_EPOCH, "+inf", start=None, num=None
+    )
+    mock_redis.zcount.assert_awaited_once_with(key, MOCK_EPOCH, "+inf")
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_ndjson_streams_in_chunks(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """NDJSON mode pages through the list and sends stored strings as is."""
+    monkeypatch.setattr(storage, "READ_CHUNK_SIZE", 2)
+    stored = await stored_by_consumer(
+        *[{**MOCK_PAYLOAD, "power_reading": i} for i in range(3)]
+    )
+    mock_redis = AsyncMock()
+    mock_redis.lrange.side_effect = [stored[:2], stored[2:]]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/readings", params={"format": "ndjson"}
+        )
+
+    assert response.status_code == codes.OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text == "\n".join(stored) + "\n"
+    key = f"readings:site:{MOCK_SITE_ID}"
+    assert [c.args for c in mock_redis.lrange.call_args_list] == [
+        (key, 0, 1),
+        (key, 2, 3),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_export_readings_csv_of_many_sites() -> None:
+    other = {**MOCK_PAYLOAD, "site_id": "site789", "extra": "dropped"}
+    mock_redis = AsyncMock()
+    mock_redis.lrange.side_effect = [
+        await stored_by_consumer(MOCK_PAYLOAD),
+        await stored_by_consumer(other),
+    ]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            "/export/readings", params={"site_id": [MOCK_SITE_ID, "site789"]}
+        )
+
+    assert response.status_code == codes.OK
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.text.splitlines() == [
+        '"site_id","device_id","power_reading","timestamp"',
+        '"site123","dev456",50.5,2024-01-15 10:30:00Z',
+        '"site789","dev456",50.5,2024-01-15 10:30:00Z',
+    ]
+
+
+@pytest.mark.parametrize("export_format", ["arrow", "parquet"])
+@pytest.mark.asyncio
+async def test_export_readings_columnar_in_chunks(
+    export_format: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(storage, "READ_CHUNK_SIZE", 2)
+    monkeypatch.setattr(export, "EXPORT_ROW_GROUP_ROWS", 2)
+    stored = await stored_by_consumer(
+        *[{**MOCK_PAYLOAD, "power_reading": i} for i in range(3)]
+    )
+    mock_redis = AsyncMock()
+    mock_redis.lrange.side_effect = [stored[:2], stored[2:]]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            "/export/readings",
+            params={"site_id": MOCK_SITE_ID, "format": export_format},
+        )
+
+    assert response.status_code == codes.OK
+    if export_format == "arrow":
+        table = pa_ipc.open_stream(response.content).read_all()
+    else:
+        parquet = pa_parquet.ParquetFile(io.BytesIO(response.content))
+        assert parquet.metadata.num_row_groups == 2
+        table = parquet.read()
+    assert table.column("power_reading").to_pylist() == [2.0, 1.0, 0.0]
+    # Parquet stores second timestamps as milliseconds
+    assert table.schema.names == export.EXPORT_SCHEMA.names
+
+
+@pytest.mark.asyncio
+async def test_export_readings_too_many_sites(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(consumer_main, "EXPORT_MAX_SITES", 1)
+    app.state.redis = AsyncMock()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get("/export/readings", params={"site_id": ["a", "b"]})
+
+    assert response.status_code == codes.UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+async def test_export_readings_unparsable_reading_ends_export() -> None:
+    mock_redis = AsyncMock()
+    mock_redis.lrange.return_value = [json.dumps({**MOCK_PAYLOAD, "site_id": 1})]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get("/export/readings", params={"site_id": MOCK_SITE_ID})
+
+    # the status line is sent before the readings are read
+    assert response.status_code == codes.OK
+    assert response.text == ""
+
+
+# --- Rollup Tests ---
+
 
+def test_reduce_readings_late_reading_keeps_latest_last() -> None:
+    late = ReadingInput(**{**MOCK_PAYLOAD, "timestamp": "2024-01-15T10:30:00Z"})
+    on_time = ReadingInput(
+        **{**MOCK_PAYLOAD, "power_reading": 7.5, "timestamp": "2024-01-15T10:30:40Z"}
+    )
+    older = ReadingInput(
+        **{**MOCK_PAYLOAD, "power_reading": 1.0, "timestamp": "2024-01-15T10:30:10Z"}
+    )
+
+    reduced = rollups.reduce_readings([late, on_time, older])
+
+    # minute, hour and day, for the site and for the device
+    assert len(reduced) == 6
+    minute_key = rollups.rollup_key(
+        rollups.Resolution.MINUTE, MOCK_SITE_ID, None, MOCK_EPOCH // 86400
+    )
+    bucket = reduced[(rollups.Resolution.MINUTE, minute_key)][MOCK_EPOCH]
+    assert bucket == rollups.Bucket(
+        count=3, sum=59.0, min=1.0, max=50.5, last_ts=MOCK_EPOCH + 40, last=7.5
+    )
+
+
+@pytest.mark.asyncio
+async def test_process_messages_merges_rollups() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, MOCK_PAYLOAD)])
+
+    # by sha, no SCRIPT EXISTS or SCRIPT LOAD per batch
+    assert pipe.evalsha.call_count == 6
+    assert {call.args[:2] for call in pipe.evalsha.call_args_list} == {
+        (rollups.MERGE_BUCKETS_SHA, 1)
+    }
+    keys = {call.args[2] for call in pipe.evalsha.call_args_list}
+    assert f"rollup:hour:site:{MOCK_SITE_ID}:{MOCK_EPOCH // (30 * 86400)}" in keys
+    pipe.execute.assert_awaited_once()
+    mock_redis.script_load.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_process_messages_reruns_merges_after_noscript() -> None:
+    # a fresh Redis, the script loaded at startup is gone
+    r = FakeAsyncRedis(decode_responses=True)
+
+    await process_messages(r, [(MOCK_STREAM_ID, MOCK_PAYLOAD)])
+
+    buckets = await rollups.read_rollups(
+        r,
+        MOCK_SITE_ID,
+        None,
+        rollups.Resolution.HOUR,
+        MOCK_EPOCH - 3600,
+        MOCK_EPOCH,
+    )
+    assert [bucket.count for bucket in buckets] == [1]
+    assert await r.script_exists(rollups.MERGE_BUCKETS_SHA) == [True]
+    await r.aclose()
+
+
+@pytest.mark.asyncio
+async def test_get_site_aggregates_reads_buckets() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    hour_start = MOCK_EPOCH - 1800
+    pipe.execute.return_value = [[f"2 101 50.5 50.5 {MOCK_EPOCH} 50.5", None]]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/aggregates",
+            params={
+                "resolution": "hour",
+                "from": "2024-01-15T10:00:00Z",
+                "to": "2024-01-15T11:00:00Z",
+            },
+        )
+
+    assert response.status_code == codes.OK
+    assert response.json() == [
+        {
+            "start": "2024-01-15T10:00:00Z",
+            "count": 2,
+            "sum": 101.0,
+            "avg": 50.5,
+            "min": 50.5,
+            "max": 50.5,
+            "last": 50.5,
+        }
+    ]
+    pipe.hmget.assert_called_once_with(
+        f"rollup:hour:site:{MOCK_SITE_ID}:{hour_start // (30 * 86400)}",
+        [hour_start, hour_start + 3600],
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_site_aggregates_range_too_large() -> None:
+    app.state.redis = AsyncMock()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/aggregates",
+            params={"resolution": "minute", "from": "2020-01-01T00:00:00Z"},
+        )
+
+    assert response.status_code == codes.UNPROCESSABLE_ENTITY
+
+
+# --- Analytics Tests ---
+
+
+def stored_reading(device_id: str, power_reading: float, minute: int) -> str:
+    """A reading as the consumer stores it, power_reading is a string."""
+    return json.dumps(
+        {
+            **MOCK_PAYLOAD,
+            "device_id": device_id,
+            "power_reading": str(float(power_reading)),
+            "timestamp": f"2024-01-15T10:{minute:02d}:00Z",
+        }
+    )
+
+
+def test_site_analytics_statistics_and_energy() -> None:
+    # latest first, as stored
+    readings = [
+        stored_reading("dev1", 30, 30),
+        stored_reading("dev1", 10, 0),
+        stored_reading("dev2", 60, 59),
+        stored_reading("dev2", 20, 0),
+    ]
+
+    analytics = site_analytics(to_arrays(readings))
+
+    assert analytics.count == 4
+    assert analytics.first == "2024-01-15T10:00:00Z"
+    assert analytics.last == "2024-01-15T10:59:00Z"
+    assert analytics.avg == 30
+    assert (analytics.min, analytics.max) == (10, 60)
+    assert analytics.peak_at == "2024-01-15T10:59:00Z"
+    # dev1: (10 + 30) / 2 over half an hour, dev2: 59 minutes of (20 + 60) / 2
+    assert analytics.energy == pytest.approx(10 + 40 * 59 / 60)
+
+
+def test_site_analytics_flags_outliers() -> None:
+    readings = [stored_reading("dev1", 50 + i % 3, i) for i in range(20)]
+    readings.append(stored_reading("dev2", 500, 30))
+
+    analytics = site_analytics(to_arrays(readings))
+
+    assert analytics.anomaly_count == 1
+    assert analytics.anomalies[0].device_id == "dev2"
+    assert analytics.anomalies[0].power_reading == 500
+
+
+def test_site_analytics_of_no_readings() -> None:
+    analytics = site_analytics(to_arrays([]))
+
+    assert analytics.count == 0
+    assert analytics.avg is None
+    assert analytics.anomalies == []
+
+
+@pytest.mark.asyncio
+async def test_get_site_analytics_cached_until_version_changes() -> None:
+    mock_redis = AsyncMock()
+    mock_redis.get.return_value = "7"
+    mock_redis.lrange.return_value = [stored_reading("dev456", 50.5, 30)]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        first = await ac.get(f"/sites/{MOCK_SITE_ID}/analytics")
+        second = await ac.get(f"/sites/{MOCK_SITE_ID}/analytics")
+        mock_redis.get.return_value = "8"
+        await ac.get(f"/sites/{MOCK_SITE_ID}/analytics")
+
+    assert first.status_code == codes.OK
+    assert first.json() == second.json()
+    assert first.json()["count"] == 1
+    assert first.json()["max"] == MOCK_PAYLOAD["power_reading"]
+    assert mock_redis.lrange.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_site_analytics_of_consumer_stored_readings() -> None:
+    payloads = [
+        {**MOCK_PAYLOAD, "power_reading": power, "timestamp": timestamp}
+        for power, timestamp in [
+            (10.0, "2024-01-15T10:00:00Z"),
+            (30.0, "2024-01-15T10:30:00Z"),
+        ]
+    ]
+    mock_redis = AsyncMock()
+    mock_redis.get.return_value = "7"
+    mock_redis.lrange.return_value = await stored_by_consumer(*payloads)
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(f"/sites/{MOCK_SITE_ID}/analytics")
+
+    assert response.status_code == codes.OK
+    analytics = response.json()
+    assert (analytics["count"], analytics["min"], analytics["max"]) == (2, 10, 30)
+    assert analytics["energy"] == pytest.approx(10)
+
+
+# --- Live Tests ---
+
+
+@pytest.mark.asyncio
+async def test_process_messages_publishes_site_readings() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, MOCK_PAYLOAD)])
+
+    pipe.publish.assert_called_once_with(
+        f"readings:live:site:{MOCK_SITE_ID}", f"[{json.dumps(MOCK_PAYLOAD)}]"
+    )
+
+
+def started_hub(queue_size: int) -> tuple[LiveHub, MagicMock]:
+    """A hub on a mocked pub/sub connection that never receives messages."""
+
+    async def idle(**kwargs: object) -> None:
+        await asyncio.sleep(0.01)
+
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.unsubscribe = AsyncMock()
+    pubsub.aclose = AsyncMock()
+    pubsub.get_message = idle
+    mock_redis = MagicMock()
+    mock_redis.pubsub.return_value = pubsub
+    hub = LiveHub(queue_size)
+    hub.start(mock_redis)
+    return hub, pubsub
+
+
+@pytest.mark.asyncio
+async def test_live_hub_fans_out_one_subscription() -> None:
+    hub, pubsub = started_hub(queue_size=10)
+    channel = f"readings:live:site:{MOCK_SITE_ID}"
+
+    async with hub.subscribe(MOCK_SITE_ID) as first:
+        async with hub.subscribe(MOCK_SITE_ID) as second:
+            hub.dispatch(channel, "[1]")
+            hub.dispatch("readings:live:site:other", "[2]")
+            assert first.get_nowait() == second.get_nowait() == "[1]"
+            assert first.empty()
+        pubsub.unsubscribe.assert_not_awaited()
+
+    pubsub.subscribe.assert_awaited_once_with(channel)
+    pubsub.unsubscribe.assert_awaited_once_with(channel)
+    assert hub.followed_sites == 0
+    await hub.stop()
+
+
+@pytest.mark.asyncio
+async def test_live_events_resync_slow_client() -> None:
+    hub, _pubsub = started_hub(queue_size=1)
+    events = iter_live_events(hub, MOCK_SITE_ID)
+    channel = f"readings:live:site:{MOCK_SITE_ID}"
+
+    assert await anext(events) == "retry: 1000\n\n"
+    hub.dispatch(channel, "[1]")
+    assert await anext(events) == "event: readings\ndata: [1]\n\n"
+    hub.dispatch(channel, "[2]")
+    hub.dispatch(channel, "[3]")  # the client did not read [2] yet
+    assert await anext(events) == "event: resync\ndata: {}\n\n"
+    with pytest.raises(StopAsyncIteration):
+        await anext(events)
+    assert hub.followed_sites == 0
+    await hub.stop()
+
+
+def test_lttb_keeps_ends_and_spike() -> None:
+    epochs = np.arange(1000, dtype=np.int64) * 60
+    power = np.sin(np.arange(1000) / 50)
+    power[500] = 10
+
+    kept = lttb_indices(epochs, power, 50)
+
+    assert len(kept) == 50
+    assert kept[0] == 0 and kept[-1] == 999
+    assert 500 in kept
+    assert np.all(np.diff(kept) > 0)
+
+
+def test_minmax_keeps_extremes_of_each_bucket() -> None:
+    power = np.array([1.0, 5, 3, 2, 0, 4, 9, 8])
+
+    kept = minmax_indices(power, 4)
+
+    # buckets [1, 5, 3, 2] and [0, 4, 9, 8]
+    assert kept.tolist() == [0, 1, 4, 6]
+
+
+@pytest.mark.asyncio
+async def test_get_site_series_downsampled_oldest_first() -> None:
+    stored = [stored_reading("dev1", i, 59 - i) for i in range(60)]
+    mock_redis = AsyncMock()
+    mock_redis.get.return_value = "7"
+    mock_redis.lrange.return_value = stored
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/series",
+            params={"points": 10, "method": "minmax"},
+        )
+
+    series = response.json()
+    assert series["count"] == 60
+    assert len(series["epochs"]) == len(series["power"]) == 10
+    assert series["epochs"] == sorted(series["epochs"])
+    assert series["power"][-1] == 0  # the latest reading, stored first
+
+
+@pytest.mark.asyncio
+async def test_get_site_series_of_consumer_stored_readings() -> None:
+    payloads = [
+        {
+            **MOCK_PAYLOAD,
+            "power_reading": minute % 7,
+            "timestamp": f"2024-01-15T10:{minute:02d}:00Z",
+        }
+        for minute in range(60)
+    ]
+    mock_redis = AsyncMock()
+    mock_redis.get.return_value = "7"
+    mock_redis.lrange.return_value = await stored_by_consumer(*payloads)
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get(f"/sites/{MOCK_SITE_ID}/series", params={"points": 10})
+
+    assert response.status_code == codes.OK
+    series = response.json()
+    assert series["count"] == 60
+    assert len(series["power"]) == 10
+    assert series["power"][0] == 0  # LTTB keeps the oldest and latest readings
+    assert series["power"][-1] == 59 % 7
+
+
+# --- Read Cache Tests ---
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_served_from_cache_until_version_changes() -> None:
+    mock_redis = AsyncMock()
+    mock_redis.get.return_value = "7"
+    mock_redis.lrange.return_value = [json.dumps(MOCK_PAYLOAD)]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        first = await ac.get(f"/sites/{MOCK_SITE_ID}/readings")
+        second = await ac.get(f"/sites/{MOCK_SITE_ID}/readings")
+        mock_redis.get.return_value = "8"  # a batch was written to the site
+        third = await ac.get(f"/sites/{MOCK_SITE_ID}/readings")
+
+    assert first.json() == second.json() == third.json() == [MOCK_PAYLOAD]
+    assert first.headers["ETag"] == second.headers["ETag"]
+    assert first.headers["ETag"] != third.headers["ETag"]
+    assert mock_redis.lrange.await_count == 2
+    mock_redis.get.assert_awaited_with(f"readings:version:site:{MOCK_SITE_ID}")
+    assert read_cache.stats.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_get_site_readings_if_none_match_not_modified() -> None:
+    mock_redis = AsyncMock()
+    mock_redis.get.return_value = "7"
+    mock_redis.lrange.return_value = [json.dumps(MOCK_PAYLOAD)]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        first = await ac.get(f"/sites/{MOCK_SITE_ID}/readings")
+        second = await ac.get(
+            f"/sites/{MOCK_SITE_ID}/readings",
+            headers={"If-None-Match": first.headers["ETag"]},
+        )
+
+    assert second.status_code == codes.NOT_MODIFIED
+    assert second.content == b""
+    mock_redis.lrange.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_process_messages_bumps_version_and_invalidates_cache() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    read_cache.put(MOCK_SITE_ID, "query", "7", "[]", {})
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, MOCK_PAYLOAD)])
+
+    pipe.incr.assert_called_once_with(f"readings:version:site:{MOCK_SITE_ID}")
+    assert len(read_cache) == 0
+    assert read_cache.stats.invalidations == 1
+
+
+def test_response_cache_lru_eviction() -> None:
+    cache = ResponseCache(max_entries=2, ttl_s=60)
+    cache.put("a", 1, "0", "[1]", {})
+    cache.put("b", 1, "0", "[2]", {})
+    assert cache.get("a", 1, "0") is not None  # "b" is now least recently used
+    cache.put("c", 1, "0", "[3]", {})
+
+    assert cache.get("b", 1, "0") is None
+    assert cache.get("a", 1, "0") is not None
+    assert cache.stats.evictions == 1
+
+
+@pytest.mark.asyncio
+async def test_process_messages_strips_schema_marker() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    marked = {**MOCK_PAYLOAD, STREAM_SCHEMA_FIELD: STREAM_SCHEMA_VERSION}
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, marked)])
+
+    pipe.lpush.assert_called_once_with(
+        f"readings:site:{MOCK_SITE_ID}", json.dumps(MOCK_PAYLOAD)
+    )
+
+
+@pytest.mark.asyncio
+async def test_process_messages_compact_entry() -> None:
+    """Compact entries are stored like field entries and sharded by site."""
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    reading = ReadingInput.model_validate(MOCK_PAYLOAD)
+    compact = to_stream_entry(reading, StreamFormat.COMPACT)
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, compact)])
+
+    stored = json.loads(pipe.lpush.call_args.args[1])
+    assert stored == {**MOCK_PAYLOAD, "power_reading": "50.5"}
+    compact_shards = shard_by_site([(MOCK_STREAM_ID, compact)], 4)
+    field_shards = shard_by_site([(MOCK_STREAM_ID, MOCK_PAYLOAD)], 4)
+    assert [bool(s) for s in compact_shards] == [bool(s) for s in field_shards]
+
+
+def sample(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_process_messages_counts_outcomes() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    acked = sample("consumer_messages_total", outcome="acked")
+    invalid = sample("consumer_messages_total", outcome="invalid")
+    failed = sample("consumer_messages_total", outcome="failed")
+    messages = [(MOCK_STREAM_ID, MOCK_PAYLOAD), ("2-0", {"malformed": "data"})]
+
+    await process_messages(mock_redis, messages)
+    pipe.execute.side_effect = RedisError("Storage Full")
+    await process_messages(mock_redis, messages)
+
+    assert sample("consumer_messages_total", outcome="acked") == acked + 1
+    assert sample("consumer_messages_total", outcome="invalid") == invalid + 1
+    assert sample("consumer_messages_total", outcome="failed") == failed + 2
+
+
+@pytest.mark.asyncio
+async def test_drop_duplicates_keeps_new_and_own_claims() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    # new, stored by another message, claimed by this message before
+    pipe.execute.return_value = [None, "9-0", "3-0"]
+    readings = [
+        (ReadingInput(**{**MOCK_PAYLOAD, "device_id": f"dev{i}"}), f"v{i}")
+        for i in range(3)
+    ]
+
+    kept, kept_ids, duplicates = await dedup.drop_duplicates(
+        mock_redis, {MOCK_SITE_ID: readings}, {MOCK_SITE_ID: ["1-0", "2-0", "3-0"]}
+    )
+
+    assert kept == {MOCK_SITE_ID: [readings[0], readings[2]]}
+    assert kept_ids == {MOCK_SITE_ID: ["1-0", "3-0"]}
+    assert duplicates == 1
+    mock_redis.pipeline.assert_called_once_with(transaction=False)
+    pipe.set.assert_any_call(
+        f"readings:dedup:{MOCK_SITE_ID}:dev0:{MOCK_EPOCH}",
+        "1-0",
+        nx=True,
+        ex=dedup.DEDUP_TTL_S,
+        get=True,
+    )
+
+
+@pytest.mark.asyncio
+async def test_process_messages_acks_duplicates_without_storing(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(consumer_main, "DEDUP_ENABLED", True)
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    # the claim pipeline, then the store transaction
+    pipe.execute.side_effect = [["0-1"], []]
+    duplicate = sample("consumer_messages_total", outcome="duplicate")
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, MOCK_PAYLOAD)])
+
+    pipe.lpush.assert_not_called()
+    pipe.xack.assert_called_once_with(STREAM_NAME, CONSUMER_GROUP, MOCK_STREAM_ID)
+    assert sample("consumer_messages_total", outcome="duplicate") == duplicate + 1
+
+
+@pytest.mark.asyncio
+async def test_release_claims_keeps_claims_of_other_messages() -> None:
+    r = FakeAsyncRedis(decode_responses=True)
+    own = ReadingInput(**MOCK_PAYLOAD)
+    other = ReadingInput(**{**MOCK_PAYLOAD, "device_id": "dev789"})
+    await r.set(dedup.dedup_key(own), "1-0")
+    await r.set(dedup.dedup_key(other), "9-0")
+
+    released = await dedup.release_claims(r, [(own, "1-0"), (other, "2-0")])
+
+    assert released == 1
+    assert await r.get(dedup.dedup_key(own)) is None
+    assert await r.get(dedup.dedup_key(other)) == "9-0"
+    await r.aclose()
+
+
+@pytest.mark.asyncio
+async def test_process_messages_store_failure_releases_claims(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(consumer_main, "DEDUP_ENABLED", True)
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    release = AsyncMock(return_value=1)
+    mock_redis.register_script = MagicMock(return_value=release)
+    # the claim pipeline, then the store transaction
+    pipe.execute.side_effect = [[None], RedisError("Storage Full")]
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, MOCK_PAYLOAD)])
+
+    release.assert_awaited_once_with(
+        keys=[dedup.dedup_key(ReadingInput(**MOCK_PAYLOAD))], args=[MOCK_STREAM_ID]
+    )
+
+
+@pytest.mark.asyncio
+async def test_dead_lettered_message_releases_its_claim(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(consumer_main, "DEDUP_ENABLED", True)
+    mock_redis = AsyncMock()
+    mock_pipeline(mock_redis)
+    release = AsyncMock(return_value=1)
+    mock_redis.register_script = MagicMock(return_value=release)
+    mock_redis.xautoclaim.return_value = ["0-0", [("1-1", MOCK_PAYLOAD)], []]
+    mock_redis.xpending_range.return_value = [pending_entry("1-1", MAX_DELIVERIES)]
+
+    await autoclaim_idle(mock_redis)
+
+    release.assert_awaited_once_with(
+        keys=[dedup.dedup_key(ReadingInput(**MOCK_PAYLOAD))], args=["1-1"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_group_gauges_from_xinfo_groups() -> None:
+    mock_redis = AsyncMock()
+    mock_redis.xinfo_groups.return_value = [
+        {"name": "other_group", "pending": 99, "lag": 99},
+        {"name": CONSUMER_GROUP, "pending": 3, "lag": 42},
+    ]
+
+    await update_group_gauges(mock_redis)
+
+    assert sample("consumer_group_pending", stream=STREAM_NAME) == 3
+    assert sample("consumer_group_lag", stream=STREAM_NAME) == 42
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get("/metrics")
+    assert f'consumer_group_lag{{stream="{STREAM_NAME}"}} 42.0' in response.text
+
+
+@pytest.mark.asyncio
+async def test_consume_stream_reads_assigned_partitions(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """One XREADGROUP covers every partition, each batch is ACKed on its own."""
+    partitions = ["energy_readings:{0}", "energy_readings:{2}"]
+    monkeypatch.setattr(consumer_main, "CONSUMER_STREAMS", partitions)
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    mock_redis.xreadgroup.side_effect = [
+        [
+            (partitions[0], [("1-0", MOCK_PAYLOAD)]),
+            (partitions[1], [("2-0", MOCK_PAYLOAD)]),
+        ],
+        asyncio.CancelledError(),
+    ]
     app.state.redis = mock_redis
 
     with pytest.raises(asyncio.CancelledError):
         await consume_stream(app)
 
-    # ACK should still happen based on your code logic
-    mock_redis.xack.assert_called_once_with(ANY, ANY, MOCK_STREAM_ID)
+    assert mock_redis.xreadgroup.call_args_list[0].args[2] == dict.fromkeys(
+        partitions, ">"
+    )
+    assert [c.args for c in pipe.xack.call_args_list] == [
+        (partitions[0], CONSUMER_GROUP, "1-0"),
+        (partitions[1], CONSUMER_GROUP, "2-0"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_process_messages_transaction_keys_share_partition_slot(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Every key of the store and ACK transaction has the partition hash tag."""
+    monkeypatch.setattr(partitions, "STREAM_PARTITIONS", 4)
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", storage.StorageBackend.ZSET)
+    stream = partitions.site_stream(MOCK_SITE_ID)
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+
+    await process_messages(mock_redis, [(MOCK_STREAM_ID, MOCK_PAYLOAD)], stream)
+
+    # the first argument of the commands, PUBLISH has a channel, not a key
+    keys = [
+        call.args[0]
+        for call in pipe.mock_calls
+        if call.args
+        and not call[0].startswith("__")
+        and call[0] not in ("publish", "evalsha")
+    ]
+    keys += [call.args[2] for call in pipe.evalsha.call_args_list]
+    assert storage.site_index_key(MOCK_SITE_ID) in keys
+    assert {key_slot(key.encode()) for key in keys} == {key_slot(stream.encode())}
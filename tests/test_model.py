@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+import pytest
+from pydantic import ValidationError
+
+from shared_lib.model import (
+    DATE_FORMAT,
+    ReadingInput,
+    batch_now,
+    parse_timestamp,
+    timestamp_to_epoch,
+)
+
+MOCK_READING_INPUT = ReadingInput(
+    site_id="site123",
+    device_id="device456",
+    power_reading=42.5,
+    timestamp="2024-01-15T10:30:00Z",
+)
+
+
+@pytest.mark.parametrize(
+    "timestamp",
+    [
+        "2024-01-15T10:30:00Z",
+        "2024-1-5T1:2:3Z",  # strptime accepts values that are not zero padded
+        "2024-02-29T23:59:59Z",
+    ],
+)
+def test_parse_timestamp_matches_strptime(timestamp: str) -> None:
+    assert parse_timestamp(timestamp) == datetime.strptime(timestamp, DATE_FORMAT)
+
+
+@pytest.mark.parametrize(
+    "timestamp",
+    ["", "2024-51-51T10:30:00Z", "2023-02-29T10:30:00Z", "2024-01-15 10:30:00"],
+)
+def test_parse_timestamp_rejects_like_strptime(timestamp: str) -> None:
+    with pytest.raises(ValueError):
+        datetime.strptime(timestamp, DATE_FORMAT)
+    with pytest.raises(ValueError):
+        parse_timestamp(timestamp)
+
+
+def test_timestamp_to_epoch_is_utc() -> None:
+    assert timestamp_to_epoch("2024-01-15T10:30:00Z") == 1705314600
+
+
+def test_batch_now_is_shared_by_the_batch() -> None:
+    with batch_now():
+        later = (datetime.now() + timedelta(seconds=30)).strftime(DATE_FORMAT)
+        with pytest.raises(ValidationError, match="datetime is in the future"):
+            ReadingInput(**{**MOCK_READING_INPUT.model_dump(), "timestamp": later})
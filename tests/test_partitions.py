@@ -0,0 +1,65 @@
+import pytest
+
+from shared_lib import partitions
+from shared_lib.config import DEAD_LETTER_STREAM, STREAM_NAME
+from shared_lib.partitions import (
+    dead_letter_key,
+    parse_partitions,
+    partition_of,
+    site_stream,
+    site_tag,
+    stream_key,
+    stream_keys,
+    untag_site,
+)
+
+
+def test_single_partition_keeps_stream_name() -> None:
+    assert stream_key(0, 1) == STREAM_NAME
+    assert site_stream("site123") == STREAM_NAME
+    assert stream_keys() == [STREAM_NAME]
+    assert dead_letter_key(STREAM_NAME) == DEAD_LETTER_STREAM
+
+
+def test_partition_keys_are_cluster_hash_tags(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(partitions, "STREAM_PARTITIONS", 4)
+
+    assert stream_keys() == [f"{STREAM_NAME}:{{{p}}}" for p in range(4)]
+    stream = site_stream("site123")
+    assert stream == stream_key(partition_of("site123", 4), 4)
+    # the dead letters share the hash tag, so the slot, of their partition
+    assert dead_letter_key(stream) == f"{stream}:dead"
+
+
+def test_partition_of_is_stable_and_spread() -> None:
+    sites = [f"site-{i}" for i in range(1000)]
+    first = [partition_of(site, 8) for site in sites]
+
+    assert first == [partition_of(site, 8) for site in sites]
+    assert set(first) == set(range(8))
+
+
+@pytest.mark.parametrize(
+    ("spec", "expected"),
+    [("", [0, 1, 2, 3, 4, 5, 6, 7]), ("0-2,7", [0, 1, 2, 7]), (" 3 , 1 ", [1, 3])],
+)
+def test_parse_partitions(spec: str, expected: list[int]) -> None:
+    assert parse_partitions(spec, 8) == expected
+
+
+@pytest.mark.parametrize("spec", ["8", "3-1", "a", "-1"])
+def test_parse_partitions_invalid(spec: str) -> None:
+    with pytest.raises(ValueError):
+        parse_partitions(spec, 8)
+
+
+def test_site_tag_is_the_partition_hash_tag(monkeypatch: pytest.MonkeyPatch) -> None:
+    assert site_tag("site123") == ""
+    monkeypatch.setattr(partitions, "STREAM_PARTITIONS", 4)
+
+    tag = site_tag("site123")
+
+    assert tag == f"{{{partition_of('site123', 4)}}}:"
+    assert site_stream("site123").endswith(tag.removesuffix(":"))
+    # the tag comes first, braces in the site_id do not change it
+    assert untag_site(site_tag("a{b}") + "a{b}") == "a{b}"
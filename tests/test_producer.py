@@ -1,10 +1,22 @@
+import asyncio
+import json
+import threading
+from collections.abc import AsyncIterator
 from datetime import datetime, timedelta
-from unittest.mock import AsyncMock
+from pathlib import Path
+from unittest.mock import ANY, AsyncMock, MagicMock
 
 import pytest
 from httpx import ASGITransport, AsyncClient, codes
+from prometheus_client import REGISTRY
+from redis.exceptions import RedisError
 
-from services.producer.main import app
+from services.producer import main
+from services.producer.admission import AdmissionControl
+from services.producer.main import RETRY_AFTER_S, admission, app, flush_spool_batch
+from services.producer.spool import Spool, SpoolRecord
+from shared_lib import partitions
+from shared_lib.config import CONSUMER_GROUP
 from shared_lib.model import (
     DATE_FORMAT,
     HEALTH_CHECK_DICT,
@@ -12,6 +24,7 @@ from shared_lib.model import (
     ReadingOutput,
     ReadingStatus,
 )
+from shared_lib.stream import STREAM_SCHEMA_FIELD
 
 MOCK_STRAM_ID = "1234567890-0"
 MOCK_READING_INPUT = ReadingInput(
@@ -25,6 +38,22 @@ MOCK_READING_OUTPUT = ReadingOutput(
 )
 
 
+def mock_pipeline(mock_redis: AsyncMock) -> MagicMock:
+    """Attach a pipeline mock usable as `async with r.pipeline() as pipe`."""
+    pipe = MagicMock()
+    pipe.__aenter__.return_value = pipe
+    pipe.execute = AsyncMock()
+    mock_redis.pipeline = MagicMock(return_value=pipe)
+    return pipe
+
+
+@pytest.fixture(autouse=True)
+def disable_admission(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Admission probes the stream, tests of it enable it on their own."""
+    admission.reset()
+    monkeypatch.setattr(admission, "high_water", 0)
+
+
 @pytest.mark.asyncio
 async def test_health_check_success() -> None:
     async with AsyncClient(
@@ -50,7 +79,9 @@ async def test_create_reading_success() -> None:
 
     assert response.status_code == codes.CREATED
     assert response.json() == MOCK_READING_OUTPUT.model_dump()
-    mock_redis.xadd.assert_called_once()
+    mock_redis.xadd.assert_called_once_with(
+        ANY, {**MOCK_READING_INPUT.model_dump(), STREAM_SCHEMA_FIELD: ANY}
+    )
 
 
 @pytest.mark.parametrize(
@@ -138,3 +169,450 @@ async def test_create_reading_illogical_future_datetime_value() -> None:
 
     assert response.status_code == codes.UNPROCESSABLE_ENTITY
     mock_redis.xadd.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_create_readings_batch_success() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    pipe.execute.return_value = ["1-0", "1-1"]
+    app.state.redis = mock_redis
+
+    payload = [MOCK_READING_INPUT.model_dump(), MOCK_READING_INPUT.model_dump()]
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post("/readings/batch", json=payload)
+
+    assert response.status_code == codes.OK
+    body = response.json()
+    assert body["accepted"] == 2
+    assert body["rejected"] == 0
+    assert [r["stream_id"] for r in body["results"]] == ["1-0", "1-1"]
+    assert pipe.xadd.call_count == 2
+    pipe.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_create_readings_batch_partial_rejection() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    pipe.execute.return_value = ["1-0"]
+    app.state.redis = mock_redis
+
+    invalid = MOCK_READING_INPUT.model_dump()
+    invalid.update(timestamp="2024-51-51T10:30:00Z")
+    payload = [invalid, MOCK_READING_INPUT.model_dump()]
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post("/readings/batch", json=payload)
+
+    assert response.status_code == codes.OK
+    results = response.json()["results"]
+    assert results[0]["status"] == ReadingStatus.REJECTED
+    assert results[0]["errors"][0]["loc"] == ["timestamp"]
+    assert results[1] == {
+        "index": 1,
+        "status": ReadingStatus.ACCEPTED,
+        "stream_id": "1-0",
+        "errors": None,
+    }
+    pipe.xadd.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_create_readings_batch_ndjson() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    pipe.execute.return_value = ["1-0"]
+    app.state.redis = mock_redis
+
+    body = json.dumps(MOCK_READING_INPUT.model_dump()) + "\n{not json\n"
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/readings/batch",
+            content=body,
+            headers={"content-type": "application/x-ndjson"},
+        )
+
+    assert response.status_code == codes.OK
+    body_json = response.json()
+    assert body_json["accepted"] == 1
+    assert body_json["results"][1]["errors"][0]["type"] == "json_invalid"
+
+
+@pytest.mark.asyncio
+async def test_create_readings_batch_ndjson_too_large_stops_reading(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(main, "MAX_BATCH_SIZE", 2)
+    app.state.redis = AsyncMock()
+    line = (json.dumps(MOCK_READING_INPUT.model_dump()) + "\n").encode()
+    sent = 0
+
+    async def body() -> AsyncIterator[bytes]:
+        nonlocal sent
+        for _ in range(100):
+            sent += 1
+            yield line
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/readings/batch",
+            content=body(),
+            headers={"content-type": "application/x-ndjson"},
+        )
+
+    assert response.status_code == codes.REQUEST_ENTITY_TOO_LARGE
+    assert sent == 3
+
+
+@pytest.mark.parametrize("content_type", ["application/json", "application/x-ndjson"])
+@pytest.mark.asyncio
+async def test_create_readings_batch_body_too_large_stops_reading(
+    content_type: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(main, "MAX_BATCH_BYTES", 1000)
+    app.state.redis = AsyncMock()
+    sent = 0
+
+    async def body() -> AsyncIterator[bytes]:
+        nonlocal sent
+        for _ in range(100):
+            sent += 1
+            yield b" " * 99 + b"\n"
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/readings/batch", content=body(), headers={"content-type": content_type}
+        )
+
+    assert response.status_code == codes.REQUEST_ENTITY_TOO_LARGE
+    assert sent == 11
+
+
+@pytest.mark.asyncio
+async def test_create_readings_batch_ndjson_line_too_large(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(main, "MAX_LINE_BYTES", 100)
+    app.state.redis = AsyncMock()
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/readings/batch",
+            content=b'{"site_id": "' + b"x" * 200,
+            headers={"content-type": "application/x-ndjson"},
+        )
+
+    assert response.status_code == codes.REQUEST_ENTITY_TOO_LARGE
+    assert "line" in response.json()["detail"]
+
+
+@pytest.mark.parametrize(
+    ("content", "expected_status"),
+    [
+        ("{not json", codes.BAD_REQUEST),
+        ('{"site_id": "site123"}', codes.UNPROCESSABLE_ENTITY),
+    ],
+)
+@pytest.mark.asyncio
+async def test_create_readings_batch_invalid_body(
+    content: str, expected_status: int
+) -> None:
+    mock_redis = AsyncMock()
+    mock_pipeline(mock_redis)
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/readings/batch",
+            content=content,
+            headers={"content-type": "application/json"},
+        )
+
+    assert response.status_code == expected_status
+    mock_redis.pipeline.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_create_readings_batch_redis_error() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    pipe.execute.side_effect = RedisError("Connection lost")
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post(
+            "/readings/batch", json=[MOCK_READING_INPUT.model_dump()]
+        )
+
+    assert response.status_code == codes.INTERNAL_SERVER_ERROR
+
+
+def sample(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_metrics_count_batch_readings_and_redis_calls() -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    pipe.execute.return_value = ["1-0"]
+    app.state.redis = mock_redis
+    invalid = {**MOCK_READING_INPUT.model_dump(), "site_id": ""}
+    accepted = sample("producer_readings_total", status="accepted")
+    rejected = sample("producer_readings_total", status="rejected")
+    calls = sample("redis_operation_seconds_count", operation="xadd_batch")
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        await ac.post(
+            "/readings/batch", json=[MOCK_READING_INPUT.model_dump(), invalid]
+        )
+        response = await ac.get("/metrics")
+
+    assert response.status_code == codes.OK
+    assert "redis_operation_seconds_bucket" in response.text
+    assert sample("producer_readings_total", status="accepted") == accepted + 1
+    assert sample("producer_readings_total", status="rejected") == rejected + 1
+    assert sample("redis_operation_seconds_count", operation="xadd_batch") == calls + 1
+
+
+@pytest.mark.asyncio
+async def test_create_reading_throttled_above_high_water(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(admission, "high_water", 100)
+    mock_redis = AsyncMock()
+    mock_redis.xinfo_groups.return_value = [
+        {"name": CONSUMER_GROUP, "pending": 0, "lag": 100}
+    ]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        first = await ac.post("/readings", json=MOCK_READING_INPUT.model_dump())
+        batch = await ac.post("/readings/batch", json=[MOCK_READING_INPUT.model_dump()])
+
+    for response in (first, batch):
+        assert response.status_code == codes.SERVICE_UNAVAILABLE
+        assert response.headers["Retry-After"] == str(RETRY_AFTER_S)
+    mock_redis.xadd.assert_not_called()
+    # the probe is cached between requests
+    mock_redis.xinfo_groups.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_create_reading_admitted_below_high_water(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(admission, "high_water", 100)
+    mock_redis = AsyncMock()
+    mock_redis.xinfo_groups.return_value = [
+        {"name": CONSUMER_GROUP, "pending": 500, "lag": 99}
+    ]
+    mock_redis.xadd.return_value = MOCK_STRAM_ID
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post("/readings", json=MOCK_READING_INPUT.model_dump())
+
+    assert response.status_code == codes.CREATED
+
+
+@pytest.mark.asyncio
+async def test_admission_probe_falls_back_to_stream_length() -> None:
+    mock_redis = AsyncMock()
+    # lag is nil after entries were trimmed or deleted
+    mock_redis.xinfo_groups.return_value = [{"name": CONSUMER_GROUP, "lag": None}]
+    mock_redis.xlen.return_value = 7
+
+    assert await AdmissionControl.probe(mock_redis, "stream", CONSUMER_GROUP) == 7
+
+
+@pytest.mark.asyncio
+async def test_admission_fails_open_on_probe_error() -> None:
+    control = AdmissionControl(high_water=1, probe_interval_s=60)
+    mock_redis = AsyncMock()
+    mock_redis.xinfo_groups.side_effect = RedisError("Connection lost")
+
+    assert await control.admit(mock_redis, ["stream"], CONSUMER_GROUP)
+
+
+@pytest.mark.asyncio
+async def test_create_reading_routes_to_site_partition(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(partitions, "STREAM_PARTITIONS", 8)
+    mock_redis = AsyncMock()
+    mock_redis.xadd.return_value = MOCK_STRAM_ID
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        await ac.post("/readings", json=MOCK_READING_INPUT.model_dump())
+
+    partition = partitions.partition_of(MOCK_READING_INPUT.site_id, 8)
+    assert mock_redis.xadd.call_args.args[0] == partitions.stream_key(partition, 8)
+
+
+@pytest.fixture
+def spool(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Spool:
+    spool = Spool(tmp_path, 1 << 20, 1 << 20, fsync=False)
+    spool.open()
+    monkeypatch.setattr(main, "spool", spool)
+    return spool
+
+
+@pytest.mark.asyncio
+async def test_create_reading_spooled_on_redis_error(spool: Spool) -> None:
+    mock_redis = AsyncMock()
+    mock_redis.xadd.side_effect = RedisError("Connection refused")
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post("/readings", json=MOCK_READING_INPUT.model_dump())
+
+    assert response.status_code == codes.ACCEPTED
+    assert response.json() == {"status": ReadingStatus.SPOOLED, "stream_id": None}
+    records, _position = spool.peek(10)
+    assert [record.entry["site_id"] for record in records] == ["site123"]
+
+
+@pytest.mark.asyncio
+async def test_create_reading_queued_behind_spool(spool: Spool) -> None:
+    mock_redis = AsyncMock()
+    mock_redis.xadd.side_effect = [RedisError("Connection refused"), MOCK_STRAM_ID]
+    app.state.redis = mock_redis
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        await ac.post("/readings", json=MOCK_READING_INPUT.model_dump())
+        # Redis is back, but the first reading still waits in the spool
+        response = await ac.post("/readings", json=MOCK_READING_INPUT.model_dump())
+
+    assert response.status_code == codes.ACCEPTED
+    assert mock_redis.xadd.call_count == 1
+    assert spool.depth == 2
+
+
+@pytest.mark.asyncio
+async def test_create_reading_append_off_event_loop_keeps_order(
+    spool: Spool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    mock_redis = AsyncMock()
+    mock_redis.xadd.side_effect = [RedisError("Connection refused"), MOCK_STRAM_ID]
+    app.state.redis = mock_redis
+    appending, release = threading.Event(), threading.Event()
+    append = spool.append
+
+    def slow_append(records: list[SpoolRecord]) -> None:
+        appending.set()
+        release.wait(5)
+        append(records)
+
+    monkeypatch.setattr(spool, "append", slow_append)
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        body = MOCK_READING_INPUT.model_dump()
+        first = asyncio.create_task(ac.post("/readings", json=body))
+        await asyncio.to_thread(appending.wait, 5)
+        # the event loop is free while the first append writes
+        second = asyncio.create_task(
+            ac.post("/readings", json={**body, "device_id": "second"})
+        )
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        release.set()
+        responses = await asyncio.gather(first, second)
+
+    assert [response.status_code for response in responses] == [codes.ACCEPTED] * 2
+    assert mock_redis.xadd.call_count == 1
+    records, _position = spool.peek(10)
+    assert [record.entry["device_id"] for record in records] == [
+        "device456",
+        "second",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_create_readings_batch_spooled_on_redis_error(spool: Spool) -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    pipe.execute.side_effect = RedisError("Connection refused")
+    app.state.redis = mock_redis
+    body = [MOCK_READING_INPUT.model_dump(), {"site_id": "bad"}]
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.post("/readings/batch", json=body)
+
+    assert response.status_code == codes.OK
+    items = response.json()["results"]
+    assert items[0]["status"] == ReadingStatus.SPOOLED
+    assert items[0]["stream_id"] is None
+    assert items[1]["status"] == ReadingStatus.REJECTED
+    assert spool.depth == 1
+
+
+@pytest.mark.asyncio
+async def test_flush_spool_batch_writes_and_commits(spool: Spool) -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    mock_redis.xadd.side_effect = RedisError("Connection refused")
+    app.state.redis = mock_redis
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        for _ in range(3):
+            await ac.post("/readings", json=MOCK_READING_INPUT.model_dump())
+
+    flushed = await flush_spool_batch(mock_redis, spool)
+
+    assert flushed == 3
+    mock_redis.pipeline.assert_called_once_with(transaction=True)
+    assert pipe.xadd.call_count == 3
+    assert spool.depth == 0
+    assert await flush_spool_batch(mock_redis, spool) == 0
+
+
+@pytest.mark.asyncio
+async def test_flush_spool_batch_keeps_records_on_redis_error(spool: Spool) -> None:
+    mock_redis = AsyncMock()
+    pipe = mock_pipeline(mock_redis)
+    pipe.execute.side_effect = RedisError("Connection refused")
+    mock_redis.xadd.side_effect = RedisError("Connection refused")
+    app.state.redis = mock_redis
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        await ac.post("/readings", json=MOCK_READING_INPUT.model_dump())
+
+    with pytest.raises(RedisError):
+        await flush_spool_batch(mock_redis, spool)
+    assert spool.depth == 1
@@ -0,0 +1,85 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+import redis.asyncio as redis
+from redis.exceptions import ConnectionError, ResponseError
+
+from shared_lib.redis_client import AutoBatchRedis, stream_reply
+
+
+@pytest.fixture
+def client() -> AutoBatchRedis:
+    # never connects, round-trips are mocked
+    return AutoBatchRedis(connection_pool=redis.ConnectionPool())
+
+
+def mock_pipeline(client: AutoBatchRedis, replies: list[object]) -> MagicMock:
+    """Attach a pipeline mock usable as `async with r.pipeline() as pipe`."""
+    pipe = MagicMock()
+    pipe.__aenter__.return_value = pipe
+    pipe.execute = AsyncMock(return_value=replies)
+    client.pipeline = MagicMock(return_value=pipe)  # type: ignore[method-assign]
+    return pipe
+
+
+@pytest.fixture
+def single_command(monkeypatch: pytest.MonkeyPatch) -> AsyncMock:
+    """The round-trip of a command sent on its own."""
+    execute = AsyncMock(return_value="single")
+    monkeypatch.setattr(redis.Redis, "execute_command", execute)
+    return execute
+
+
+async def test_concurrent_commands_share_one_pipeline(
+    client: AutoBatchRedis, single_command: AsyncMock
+) -> None:
+    error = ResponseError("WRONGTYPE")
+    pipe = mock_pipeline(client, ["v1", None, error])
+
+    results = await asyncio.gather(
+        client.get("k1"), client.get("k2"), client.incr("k3"), return_exceptions=True
+    )
+
+    assert list(results) == ["v1", None, error]
+    pipe.execute.assert_awaited_once_with(raise_on_error=False)
+    assert [call.args for call in pipe.execute_command.call_args_list] == [
+        ("GET", "k1"),
+        ("GET", "k2"),
+        ("INCRBY", "k3", 1),
+    ]
+    single_command.assert_not_called()
+
+
+async def test_lone_and_blocking_commands_are_sent_as_is(
+    client: AutoBatchRedis, single_command: AsyncMock
+) -> None:
+    pipe = mock_pipeline(client, [])
+
+    single = await client.get("k1")
+    blocking: object = await client.xreadgroup("g", "c", {"s": ">"}, block=100)
+
+    assert single == blocking == "single"
+    pipe.execute.assert_not_called()
+    assert single_command.await_count == 2
+
+
+async def test_failed_round_trip_raises_for_every_command(
+    client: AutoBatchRedis, single_command: AsyncMock
+) -> None:
+    pipe = mock_pipeline(client, [])
+    pipe.execute.side_effect = ConnectionError("connection reset")
+
+    results = await asyncio.gather(
+        client.get("k1"), client.get("k2"), return_exceptions=True
+    )
+
+    assert [type(result) for result in results] == [ConnectionError] * 2
+
+
+def test_stream_reply_accepts_resp2_and_resp3() -> None:
+    messages = [("1-0", {"site_id": "site1"})]
+
+    assert stream_reply([["s", messages]]) == [("s", messages)]
+    assert stream_reply({"s": [messages]}) == [("s", messages)]
+    assert stream_reply(None) == []
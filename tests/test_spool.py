@@ -0,0 +1,135 @@
+from pathlib import Path
+
+import pytest
+
+from services.producer.spool import Spool, SpoolFullError, SpoolRecord
+
+
+def make_spool(directory: Path, segment_bytes: int = 1 << 20) -> Spool:
+    spool = Spool(directory, segment_bytes, max_bytes=1 << 20, fsync=False)
+    spool.open()
+    return spool
+
+
+def records(count: int, start: int = 0) -> list[SpoolRecord]:
+    return [
+        SpoolRecord("readings", {"site_id": f"site{i}"}, 1700000000.0 + i)
+        for i in range(start, start + count)
+    ]
+
+
+def test_peek_returns_records_in_order(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path)
+    spool.append(records(3))
+    spool.append(records(2, start=3))
+
+    peeked, _position = spool.peek(4)
+
+    assert peeked == records(4)
+    assert spool.depth == 5
+    assert spool.oldest_spooled_at == 1700000000.0
+
+
+def test_commit_advances_and_deletes_flushed_segments(tmp_path: Path) -> None:
+    # every append after the first starts a new segment
+    spool = make_spool(tmp_path, segment_bytes=1)
+    for i in range(3):
+        spool.append(records(1, start=i))
+
+    peeked, position = spool.peek(2)
+    spool.commit(position, len(peeked))
+
+    assert spool.depth == 1
+    assert spool.peek(10)[0] == records(1, start=2)
+    assert len(list(tmp_path.glob("*.log"))) == 2
+    assert spool.oldest_spooled_at == 1700000002.0
+
+
+def test_reopen_resumes_from_checkpoint(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path)
+    spool.append(records(4))
+    peeked, position = spool.peek(3)
+    spool.commit(position, len(peeked))
+    spool.close()
+
+    reopened = make_spool(tmp_path)
+
+    assert reopened.depth == 1
+    assert reopened.peek(10)[0] == records(1, start=3)
+
+
+def test_reopen_drops_torn_record(tmp_path: Path) -> None:
+    spool = make_spool(tmp_path)
+    spool.append(records(2))
+    spool.close()
+    segment = next(tmp_path.glob("*.log"))
+    with segment.open("ab") as f:
+        f.write(b'{"s": "readings", "e": {"si')
+
+    reopened = make_spool(tmp_path)
+    reopened.append(records(1, start=2))
+
+    assert reopened.depth == 3
+    assert reopened.peek(10)[0] == records(3)
+
+
+def test_append_over_max_bytes_raises(tmp_path: Path) -> None:
+    spool = Spool(tmp_path, 1 << 20, max_bytes=100, fsync=False)
+    spool.open()
+
+    with pytest.raises(SpoolFullError):
+        spool.append(records(10))
+    assert spool.depth == 0
+
+
+def test_processes_claim_separate_slots(tmp_path: Path) -> None:
+    first = make_spool(tmp_path)
+    second = make_spool(tmp_path)
+    first.append(records(1))
+    second.append(records(2, start=1))
+
+    assert first.directory == tmp_path
+    assert second.directory == tmp_path / "1"
+    assert first.peek(10)[0] == records(1)
+    assert second.peek(10)[0] == records(2, start=1)
+
+    # a closed slot is taken over, with the records it holds
+    second.close()
+    third = make_spool(tmp_path)
+    assert third.directory == tmp_path / "1"
+    assert third.peek(10)[0] == records(2, start=1)
+
+
+def test_open_merges_slots_left_by_fewer_workers(tmp_path: Path) -> None:
+    first = make_spool(tmp_path)
+    second = make_spool(tmp_path)
+    third = make_spool(tmp_path)
+    second.append(records(2))
+    third.append(records(3, start=2))
+    peeked, position = third.peek(1)
+    third.commit(position, len(peeked))
+    for spool in (first, second, third):
+        spool.close()
+
+    # restarted with a single worker
+    merged = make_spool(tmp_path)
+
+    assert merged.directory == tmp_path
+    assert merged.depth == 4
+    assert merged.peek(10)[0] == records(2) + records(2, start=3)
+    assert not list((tmp_path / "1").glob("*.log"))
+    assert not list((tmp_path / "2").glob("*.log"))
+    merged.close()
+    assert make_spool(tmp_path).depth == 4
+
+
+def test_open_does_not_merge_held_slots(tmp_path: Path) -> None:
+    first = make_spool(tmp_path)
+    second = make_spool(tmp_path)
+    second.append(records(2))
+    first.close()
+
+    reopened = make_spool(tmp_path)
+
+    assert reopened.depth == 0
+    assert second.peek(10)[0] == records(2)
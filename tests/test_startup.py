@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+# Cumulative import time of a service module as reported by -X importtime, the
+# best of IMPORT_RUNS runs. It is the part of a pod cold start the code controls
+# (KEDA scale-out waits for it on every new pod), about 0.5s on a laptop. The
+# lifespan startup (Redis pool warm-up, spool) is not covered.
+IMPORT_BUDGET_S = float(os.getenv("IMPORT_BUDGET_S", 1.5))
+IMPORT_RUNS = 3
+
+SERVICES = ["services.consumer.main", "services.producer.main"]
+# loaded by the routes that use them, on first request
+LAZY_MODULES = ["numpy", "pyarrow"]
+
+
+def import_times(module: str, code: str = "") -> dict[str, int]:
+    """
+    Cumulative import time in microseconds of every module loaded by importing
+    `module` then running `code`.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module} as m; {code}"],
+        capture_output=True,
+        check=True,
+        cwd=Path(__file__).parents[1],
+        text=True,
+    )
+    times: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+@pytest.mark.parametrize("module", SERVICES)
+def test_import_within_budget(module: str) -> None:
+    best = min(import_times(module)[module] for _ in range(IMPORT_RUNS)) / 1e6
+
+    assert best < IMPORT_BUDGET_S, f"{module} imports in {best:.2f}s"
+
+
+@pytest.mark.parametrize("module", SERVICES)
+def test_startup_does_not_load_lazy_modules(module: str) -> None:
+    # neither the import nor the app factory
+    loaded = import_times(module, "m.create_app()")
+
+    assert not [name for name in loaded if name.split(".")[0] in LAZY_MODULES]
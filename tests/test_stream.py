@@ -0,0 +1,86 @@
+from unittest.mock import patch
+
+import pytest
+from pydantic import ValidationError
+
+from shared_lib.model import ReadingInput
+from shared_lib.stream import (
+    COMPACT_FIELD,
+    COMPACT_SEPARATOR,
+    STREAM_SCHEMA_FIELD,
+    STREAM_SCHEMA_VERSION,
+    StreamFormat,
+    decode_stream_entry,
+    from_stream_entry,
+    stream_entry_site_id,
+    to_stream_entry,
+)
+
+MOCK_READING_INPUT = ReadingInput(
+    site_id="site123",
+    device_id="device456",
+    power_reading=42.5,
+    timestamp="2024-01-15T10:30:00Z",
+)
+
+
+def redis_round_trip(entry: dict[str, object]) -> dict[str, str]:
+    """redis returns every stream field as a string"""
+    return {k: str(v) for k, v in entry.items()}
+
+
+@pytest.mark.parametrize("stream_format", list(StreamFormat))
+def test_stream_entry_round_trip_skips_validation(
+    stream_format: StreamFormat,
+) -> None:
+    payload = redis_round_trip(to_stream_entry(MOCK_READING_INPUT, stream_format))
+
+    with patch.object(ReadingInput, "model_validate") as validate:
+        reading, fields = decode_stream_entry(payload)
+
+    validate.assert_not_called()
+    assert reading == MOCK_READING_INPUT
+    # both formats are stored the same way, without the schema marker
+    assert fields == redis_round_trip(MOCK_READING_INPUT.model_dump())
+    assert stream_entry_site_id(payload) == MOCK_READING_INPUT.site_id
+
+
+def test_compact_entry_is_a_single_field() -> None:
+    entry = to_stream_entry(MOCK_READING_INPUT, StreamFormat.COMPACT)
+
+    assert entry == {
+        COMPACT_FIELD: COMPACT_SEPARATOR.join(
+            ["2", "site123", "device456", "42.5", "1705314600"]
+        )
+    }
+
+
+def test_compact_entry_falls_back_for_separator_in_ids() -> None:
+    reading = MOCK_READING_INPUT.model_copy(
+        update={"site_id": f"site{COMPACT_SEPARATOR}123"}
+    )
+
+    entry = to_stream_entry(reading, StreamFormat.COMPACT)
+
+    assert entry[STREAM_SCHEMA_FIELD] == STREAM_SCHEMA_VERSION
+    assert from_stream_entry(redis_round_trip(entry)) == reading
+
+
+def test_stream_entry_without_marker_is_validated() -> None:
+    with pytest.raises(ValidationError):
+        from_stream_entry({"site_id": "site123"})
+    # a broken trusted entry still fails validation instead of being stored
+    with pytest.raises(ValidationError):
+        from_stream_entry({STREAM_SCHEMA_FIELD: STREAM_SCHEMA_VERSION})
+    with pytest.raises(ValidationError):
+        from_stream_entry({COMPACT_FIELD: "2\x1fsite\x1fdevice\x1fhigh\x1f0"})
+    # an epoch out of the platform time range
+    with pytest.raises(ValidationError):
+        from_stream_entry({COMPACT_FIELD: "2\x1fs\x1fd\x1f1.0\x1f" + "9" * 20})
+
+
+def test_trusted_entry_with_bad_timestamp_is_validated() -> None:
+    entry = redis_round_trip(to_stream_entry(MOCK_READING_INPUT))
+
+    with pytest.raises(ValidationError):
+        from_stream_entry({**entry, "timestamp": "garbage"})
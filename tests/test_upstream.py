@@ -0,0 +1,132 @@
+import asyncio
+from collections.abc import AsyncIterator
+
+import httpx
+import pytest
+
+from services.frontend.upstream import UpstreamClient
+
+URL = "http://consumer/sites/site1/readings"
+
+
+class SlowBackend:
+    """Counts the requests it serves, each answered after `release` is set."""
+
+    def __init__(self, status_code: int = httpx.codes.OK) -> None:
+        self.status_code = status_code
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        await self.release.wait()
+        return httpx.Response(self.status_code, json=[{"call": self.calls}])
+
+
+@pytest.fixture
+def backend() -> SlowBackend:
+    return SlowBackend()
+
+
+@pytest.fixture
+async def upstream(backend: SlowBackend) -> AsyncIterator[UpstreamClient]:
+    client = UpstreamClient(httpx.Limits(), timeout=1.0, ttl_s=60.0, max_entries=2)
+    client.start(httpx.MockTransport(backend.handle))
+    yield client
+    await client.stop()
+
+
+async def test_concurrent_identical_gets_are_coalesced(
+    upstream: UpstreamClient, backend: SlowBackend
+) -> None:
+    waiters = [
+        asyncio.create_task(upstream.get_site("site1", URL, {"limit": 10}))
+        for _ in range(5)
+    ]
+    await asyncio.sleep(0)
+    backend.release.set()
+    responses = await asyncio.gather(*waiters)
+
+    assert backend.calls == 1
+    assert {id(response) for response in responses} == {id(responses[0])}
+    assert upstream.stats.coalesced == 4
+
+
+async def test_cached_until_invalidated(
+    upstream: UpstreamClient, backend: SlowBackend
+) -> None:
+    backend.release.set()
+    await upstream.get_site("site1", URL, {"limit": 10})
+    cached = await upstream.get_site("site1", URL, {"limit": 10})
+    other = await upstream.get_site("site1", URL, {"limit": 20})
+
+    upstream.invalidate("site1")
+    refreshed = await upstream.get_site("site1", URL, {"limit": 10})
+
+    assert cached.json() == [{"call": 1}]
+    assert other.json() == [{"call": 2}]
+    assert refreshed.json() == [{"call": 3}]
+    assert upstream.stats.hits == 1
+
+
+async def test_errors_are_not_cached(backend: SlowBackend) -> None:
+    backend.status_code = httpx.codes.SERVICE_UNAVAILABLE
+    backend.release.set()
+    upstream = UpstreamClient(httpx.Limits(), timeout=1.0, ttl_s=60.0, max_entries=2)
+    upstream.start(httpx.MockTransport(backend.handle))
+
+    await upstream.get_site("site1", URL)
+    response = await upstream.get_site("site1", URL)
+    await upstream.stop()
+
+    assert response.status_code == httpx.codes.SERVICE_UNAVAILABLE
+    assert backend.calls == 2
+
+
+async def test_cancelled_caller_does_not_cancel_the_others(
+    upstream: UpstreamClient, backend: SlowBackend
+) -> None:
+    first = asyncio.create_task(upstream.get_site("site1", URL))
+    second = asyncio.create_task(upstream.get_site("site1", URL))
+    await asyncio.sleep(0)
+    first.cancel()
+    backend.release.set()
+
+    response = await second
+
+    assert response.json() == [{"call": 1}]
+    assert first.cancelled()
+
+
+async def test_response_in_flight_at_invalidate_is_not_cached(
+    upstream: UpstreamClient, backend: SlowBackend
+) -> None:
+    before = asyncio.create_task(upstream.get_site("site1", URL))
+    await asyncio.sleep(0)
+    upstream.invalidate("site1")
+    # sent after the write, does not join the request sent before it
+    after = asyncio.create_task(upstream.get_site("site1", URL))
+    await asyncio.sleep(0)
+    backend.release.set()
+
+    stale, fresh = await asyncio.gather(before, after)
+
+    assert stale is not fresh
+    assert await upstream.get_site("site1", URL) is fresh
+    assert backend.calls == 2
+    assert upstream.stats.coalesced == 0
+
+
+async def test_fetch_completing_after_invalidate_is_dropped(
+    upstream: UpstreamClient, backend: SlowBackend
+) -> None:
+    pending = asyncio.create_task(upstream.get_site("site1", URL))
+    await asyncio.sleep(0)
+    upstream.invalidate("site1")
+    backend.release.set()
+    await pending
+
+    refreshed = await upstream.get_site("site1", URL)
+
+    assert refreshed.json() == [{"call": 2}]
+    assert upstream.stats.hits == 0